@@ -6,9 +6,21 @@ VAL_LEN = 50000
 TEST_LEN = 50000
 DATA_SIZE = TRAIN_LEN + VAL_LEN + TEST_LEN
 
-CPP_JAVA_INDEX_BUFFER = 162
+# First reserved identifier id of the c++ token encoding for each token id
+# layout, see preprocessing/token_encoder.py. Corpora that don't record a
+# layout, including everything encode_tokens.c writes, use the legacy one.
+TOKEN_LAYOUT_INDEX_BUFFERS = {1: 162, 2: 225}
+LEGACY_TOKEN_LAYOUT = 1
+CPP_JAVA_INDEX_BUFFER = TOKEN_LAYOUT_INDEX_BUFFERS[LEGACY_TOKEN_LAYOUT]
 
 os.environ["TF_KERAS"] = '1' 
 
-from auth_ident.generic_execute import GenericExecute
+
+def __getattr__(name):
+    # GenericExecute pulls in tensorflow, so only import it when asked for.
+    # Preprocessing and packing scripts just need the package constants.
+    if name == "GenericExecute":
+        from auth_ident.generic_execute import GenericExecute
+        return GenericExecute
+    raise AttributeError(f"module 'auth_ident' has no attribute '{name}'")
 
@@ -3,8 +3,8 @@ import pandas as pd
 import numpy as np
 import tensorflow as tf
 from time import perf_counter
-import sentencepiece as spm
-from auth_ident import CPP_JAVA_INDEX_BUFFER
+from auth_ident.packed_corpus import load_corpus
+from auth_ident.encodings import get_encoding, START, END
 
 
 class ClosedDataset:
@@ -30,53 +30,40 @@ class ClosedDataset:
         self.rng = np.random.default_rng(1)
 
         # For one-hot
-        chars_to_encode = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM\n\r\t " + r"1234567890-=!@#$%^&*()_+[]{}|;':\",./<>?"
-        self.start = "<start>"
-        self.end = "<end>"
-        chars_to_encode = [self.start, self.end] + list(chars_to_encode)
-
-        if encoding_type == "spm":
-            sp = spm.SentencePieceProcessor(model_file=join("data/", spm_model_file))
-            self.len_encoding = sp.vocab_size()
-        elif encoding_type == "tokens":
-            
-            if "cpp" in data_file:
-                self.len_encoding = CPP_JAVA_INDEX_BUFFER
-            elif "java" in data_file:
-                self.len_encoding = CPP_JAVA_INDEX_BUFFER
-            else:
-                assert False, "No python length encoding known"
-
-            # Assume format data/.../{language}_{type}_encoded.h5
-            top_ids_file = "data/" + "_".join(data_file.split("_")[:-2]) + "_top_identifiers.txt"
-            with open(top_ids_file) as f:
-                num_reserved_identifiers = sum([1 for line in f])
-
-            self.len_encoding += num_reserved_identifiers
-            print(f"ENCODING_LEN: {self.len_encoding}")
-        else:
-            self.len_encoding = len(chars_to_encode) + 1
-
-        chars_index = [i for i in range(len(chars_to_encode))]
-
-        char_map = tf.lookup.KeyValueTensorInitializer(chars_to_encode,
-                                                       chars_index,
-                                                       key_dtype=tf.string,
-                                                       value_dtype=tf.int64)
-        self.table = tf.lookup.StaticVocabularyTable(char_map,
-                                                     num_oov_buckets=1)
-
-        # Load dataframe
+        encoding = get_encoding(encoding_type, data_file, spm_model_file)
+        self.start = START
+        self.end = END
+        self.len_encoding = encoding.len_encoding
+        self.table = encoding.table
+
+        # Load corpus, memory-mapped read-only so concurrent processes share
+        # one copy
         f = join("data/", data_file)
-        self.dataframe = pd.read_hdf(f)
+        self.corpus = load_corpus(f)
+        print(f"Corpus memory usage: {self.memory_usage()}")
 
         self.bos_id = 1
         self.eos_id = 2
 
-    def get_dataset(self, return_file_indicies=False):
-        return list(self.get_two(self.dataframe, return_file_indicies))
+    def memory_usage(self):
+        """Resident-memory footprint of the loaded corpus, in bytes."""
+        return self.corpus.memory_usage()
+
+    def get_dataset(self, return_file_indicies=False,
+                    align_file_indicies=False):
+        return list(self.get_two(self.corpus, return_file_indicies,
+                                 align_file_indicies))
+
+    def get_indicies(self):
+        """
+        The files get_dataset would encode, in row order, and their labels,
+        without cropping or encoding anything.
+        """
+        files, cross_val_indicies, y = self.select_files(self.corpus)
+        return files[cross_val_indicies], y
 
-    def get_two(self, df, return_file_indicies=False):
+    def get_two(self, corpus, return_file_indicies=False,
+                align_file_indicies=False):
         """
         Generate file pairings where each file is equally likely to be
         included in a pairing.
@@ -96,13 +83,40 @@ class ClosedDataset:
         files = k files from all authors with >= k files
         for i in len(files)
             y[i] = author(files[i])
+
+        X is built in one gather from the packed corpus as an int32 matrix.
+        With return_file_indicies the selected files are returned too, in
+        author order by default, or lined up row for row with X when
+        align_file_indicies is set.
+        """
+        files, cross_val_indicies, y = self.select_files(corpus)
+
+        print("encoding")
+        fold_files = files[cross_val_indicies]
+        X = corpus.crop_batch(fold_files, self.crop_length, self.eos_id)
+        print("finished dataset")
+
+        print(f"num_authors {len(self.authors_with_k)}")
+
+        if return_file_indicies and align_file_indicies:
+            return X, y, fold_files
+        elif return_file_indicies:
+            return X, y, files
+        else:
+            return X, y
+
+    def select_files(self, corpus):
         """
+        Pick k files from up to max_authors authors with at least k files.
 
-        # TODO Make faster
+        Returns the selected files in author order, the permutation that
+        puts them in cross validation order (fold i holds the i-th file of
+        every author) and the labels in that order.
+        """
 
         # Mapping from author names to file index
         # ["tom"] -> [1, 17, 37]
-        self.files_by_auth_name = df.groupby(['username']).indices
+        self.files_by_auth_name = corpus.files_by_author()
 
         # Map from authors with >= k files to their files (indx)
         #  ["Larry"] -> [4, 34, 67, 231, 453, 768]
@@ -123,48 +137,24 @@ class ClosedDataset:
         # each author has exactly k files
         files = np.concatenate(list(self.authors_with_k.values()))
 
-        # Generate labels
-        y = np.floor(np.arange(len(files)) / self.k_cross_val)
-
-        # Create indices to grab one of each author in each fold
-        cross_val_indicies = np.zeros(len(files), dtype=np.int32)
+        # Create indices to grab one of each author in each fold. Laid out
+        # as (author, fold), the transpose walks fold by fold.
         # files should always be divizable by k
-        print("folding")
-        fold_size = int(len(files) / self.k_cross_val)
-        for i in range(self.k_cross_val):
-            cross_val_indicies[i * fold_size:(i + 1) * fold_size] = np.arange(
-                i, len(files), self.k_cross_val)
-
-        print("reorganizing")
-        # Reorganize labels
-        y = y[cross_val_indicies]
-
-        # crop = np.vectorize(self.random_crop)
-        # files = crop(files, self.crop_length, df)
-        print("encoding")
-        X = np.zeros([cross_val_indicies.shape[0], self.crop_length])
-        print(f"len encoding: {cross_val_indicies.shape}")
-        for i, cross_val_index in enumerate(cross_val_indicies):
-            print(i, end="\r")
-            cropped = self.crop(files[cross_val_index],
-                                       self.crop_length, df)
-            X[i, :cropped.shape[0] + 1] = self.add_end_tokens(cropped)
-        print("finished dataset")
+        cross_val_indicies = np.arange(len(files)).reshape(
+            -1, self.k_cross_val).T.ravel()
 
-        print(f"num_authors {len(self.authors_with_k)}")
+        # Labels in cross validation order
+        y = np.floor(cross_val_indicies / self.k_cross_val)
 
-        if return_file_indicies:
-            return X, y, files
-        else:
-            return X, y
+        return files, cross_val_indicies, y
 
-    def crop(self, file_indx, crop_length, df):
+    def crop(self, file_indx, crop_length, corpus):
         """
         Return a crop from the file at the provided index. If
         crop_length is longer than the length of the file, then the entire
         file will be returned.
         """
-        contents = np.array(df['file_content'][file_indx])
+        contents = np.array(corpus.file(file_indx))
         # Minus two to account for bos and eso tokens
         max_crop = min(len(contents), crop_length) - 1
         cropped_contents = contents[:max_crop]
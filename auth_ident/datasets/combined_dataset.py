@@ -1,16 +1,15 @@
 import tensorflow as tf
 from auth_ident.preprocessing import PairAuthors
 from auth_ident.preprocessing import load_data
+from auth_ident.encodings import get_encoding
 
 
 class CombinedDataset:
 
     def __init__(self, max_code_length, batch_size, binary_encoding=False):
 
-        chars_to_encode = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM\n\r\t " + r"1234567890-=!@#$%^&*()_+[]{}|;':\",./<>?"
-        chars_to_encode = list(chars_to_encode)
-        self.len_encoding = len(chars_to_encode)
-        chars_index = [i for i in range(self.len_encoding)]
+        encoding = get_encoding(vocabulary="chars")
+        self.len_encoding = len(encoding.vocabulary)
         self.binary_encoding_len = 8
 
         self.binary_encoding = binary_encoding
@@ -18,8 +17,7 @@ class CombinedDataset:
         if binary_encoding:
             self.len_encoding = self.binary_encoding_len
 
-        char_map = tf.lookup.KeyValueTensorInitializer(chars_to_encode, chars_index, key_dtype=tf.string, value_dtype=tf.int64)
-        self.table = tf.lookup.StaticVocabularyTable(char_map, num_oov_buckets=1)
+        self.table = encoding.table
 
         self.max_code_length = max_code_length
         self.batch_size = batch_size
@@ -3,10 +3,79 @@ import tensorflow as tf
 from os.path import join
 import os
 
-from auth_ident.generators import SimCLRGen
-import sentencepiece as spm
+from functools import partial
+
+from auth_ident.generators import (SimCLRGen, SPMSampleGen, SharedMemoryLoader,
+                                   HardNegativeSimCLRGen)
+from auth_ident.generators.simclr_generator import simclr_shard
+from auth_ident.packed_corpus import load_corpus
+from auth_ident.encodings import get_encoding, START, END
 import auth_ident
-from auth_ident import CPP_JAVA_INDEX_BUFFER
+
+
+class HardNegativeRefresh(tf.keras.callbacks.Callback):
+    """
+    Rebuilds the author neighbour graph of a HardNegativeSimCLRGen with the
+    model being trained every refresh_interval training batches.
+
+    The encoder is the model's first input branch up to layer_name. The
+    time spent refreshing during an epoch is logged as
+    hard_negative_refresh_s.
+    """
+    def __init__(self, generator, refresh_interval,
+                 layer_name="output_embedding", predict_batch_size=256):
+        super().__init__()
+        self.generator = generator
+        self.refresh_interval = refresh_interval
+        self.layer_name = layer_name
+        self.predict_batch_size = predict_batch_size
+        self.encoder = None
+        self.num_batches = 0
+        self.epoch_seconds = 0.0
+
+    def embed(self, crops):
+        if self.encoder is None:
+            self.encoder = tf.keras.Model(
+                inputs=self.model.inputs[0],
+                outputs=self.model.get_layer(self.layer_name).get_output_at(0))
+        return self.encoder.predict(crops, batch_size=self.predict_batch_size)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_seconds = 0.0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.num_batches += 1
+        if self.num_batches % self.refresh_interval == 0:
+            seconds = self.generator.refresh(self.embed)
+            self.epoch_seconds += seconds
+            print(f"\nHard negative refresh {len(self.generator.refresh_times)}"
+                  f" took {seconds:.2f}s", flush=True)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            logs['hard_negative_refresh_s'] = self.epoch_seconds
+
+
+class LoaderMetrics(tf.keras.callbacks.Callback):
+    """
+    Logs the stall metrics of a SharedMemoryLoader (see
+    SharedMemoryLoader.metrics) for each epoch as loader_<metric>, so
+    TensorBoard and the training history show whether training waited on
+    the workers (consumer stalls) or the workers on training (producer
+    stalls).
+    """
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+        self.epoch_start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = self.loader.metrics()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            for name, value in self.loader.metrics().items():
+                logs[f'loader_{name}'] = value - self.epoch_start[name]
 
 
 class SimCLRDataset:
@@ -15,49 +84,85 @@ class SimCLRDataset:
                  batch_size,
                  data_file=None,
                  encoding_type='char',
-                 spm_model_file=None):
+                 spm_model_file=None,
+                 generator='sample',
+                 spm_alpha=0.1,
+                 spm_nbest_size=-1,
+                 num_workers=None,
+                 num_shards=None,
+                 queue_depth=None,
+                 plan_dir=None,
+                 plan_seed=1,
+                 plan_epoch=0,
+                 plan_step=0,
+                 refresh_interval=1000,
+                 hard_fraction=0.5,
+                 probe_authors=2048):
+        """
+        generator selects how SimCLRGen feeds the pipeline:
+            'sample' yields one pair at a time and batches in tf.data.
+            'batch' yields whole batches built with array ops.
+            'spm_sample' yields whole batches like 'batch' from a normalized
+                text corpus (convert_hdf --normalized), sampling a new spm
+                segmentation with spm_alpha and spm_nbest_size every time a
+                file is drawn, in num_workers processes.
+            'sharded' yields whole batches like 'batch' from num_shards
+                (default: one per cpu) SimCLRGen shards with independent
+                random streams, interleaved in parallel by tf.data.
+            'multiprocess' yields whole batches like 'batch' from num_workers
+                (default: one per cpu) SimCLRGen shards running in worker
+                processes, through a ring of queue_depth shared memory
+                slots (see SharedMemoryLoader and loader_metrics).
+            'plan' yields whole batches like 'batch' by streaming epoch plans
+                precomputed in plan_dir from plan_seed (see
+                SimCLRGen.use_epoch_plans). A training split resumes at
+                plan_epoch and plan_step, val and test always start from
+                the beginning.
+            'hard_negative' yields whole batches like 'batch', filling
+                hard_fraction of each batch with authors whose centroids
+                are close under the current model (see
+                HardNegativeSimCLRGen). The centroids of probe_authors
+                authors are recomputed every refresh_interval training
+                batches by the callback from callbacks(). Only a training
+                split mines hard negatives, val and test are built like
+                'batch' so their losses stay comparable across runs.
+        """
         print("\nIn INIT\n", flush=True)
 
         self.max_code_length = max_code_length
         self.batch_size = batch_size
         self.data_file = data_file
         self.encoding_type = encoding_type
+        self.generator = generator
+        self.spm_model_file = spm_model_file
+        self.spm_alpha = spm_alpha
+        self.spm_nbest_size = spm_nbest_size
+        self.num_workers = num_workers
+        self.num_shards = num_shards or os.cpu_count()
+        self.queue_depth = queue_depth
+        self.plan_dir = plan_dir
+        self.plan_seed = plan_seed
+        self.plan_epoch = plan_epoch
+        self.plan_step = plan_step
+        self.refresh_interval = refresh_interval
+        self.hard_fraction = hard_fraction
+        self.probe_authors = probe_authors
+        self.pg = None
+        self.corpus = None
+        self.loader = None
 
-        chars_to_encode = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM\n\r\t " + r"1234567890-=!@#$%^&*()_+[]{}|;':\",./<>?"
-        self.start = "<start>"
-        self.end = "<end>"
-        chars_to_encode = [self.start, self.end] + list(chars_to_encode)
-        
-        if self.encoding_type == "spm":
-            sp = spm.SentencePieceProcessor(model_file=join("data/", spm_model_file))
-            self.len_encoding = sp.vocab_size()
-        elif self.encoding_type == "tokens":
-            
-            if "cpp" in data_file:
-                self.len_encoding = CPP_JAVA_INDEX_BUFFER
-            elif "java" in data_file:
-                self.len_encoding = CPP_JAVA_INDEX_BUFFER
-            else:
-                assert False, "No python length encoding known"
-
-            # Assume format data/.../{language}_{type}_encoded.h5
-            top_ids_file = "data/" + "_".join(data_file.split("_")[:-2]) + "_top_identifiers.txt"
-            with open(top_ids_file) as f:
-                num_reserved_identifiers = sum([1 for line in f])
-
-            self.len_encoding += num_reserved_identifiers
-            print(f"ENCODING_LEN: {self.len_encoding}")
-        else:
-            self.len_encoding = len(chars_to_encode) + 1
-
-        chars_index = [i for i in range(len(chars_to_encode))]
+        if self.generator == 'spm_sample':
+            assert self.encoding_type == "spm", \
+                "the spm_sample generator needs encoding_type spm"
+        if self.generator == 'plan':
+            assert self.plan_dir is not None, \
+                "the plan generator needs a plan_dir"
 
-        char_map = tf.lookup.KeyValueTensorInitializer(chars_to_encode,
-                                                       chars_index,
-                                                       key_dtype=tf.string,
-                                                       value_dtype=tf.int64)
-        self.table = tf.lookup.StaticVocabularyTable(char_map,
-                                                     num_oov_buckets=1)
+        encoding = get_encoding(encoding_type, data_file, spm_model_file)
+        self.start = START
+        self.end = END
+        self.len_encoding = encoding.len_encoding
+        self.table = encoding.table
 
     def encode_to_one_hot(self, code_to_embed):
         reshaped = tf.concat(
@@ -75,6 +180,45 @@ class SimCLRDataset:
 
         return encoding
 
+    def memory_usage(self):
+        """Resident-memory footprint of the loaded corpus, in bytes."""
+        if self.corpus is None:
+            return None
+        return self.corpus.memory_usage()
+
+    def loader_metrics(self):
+        """Stall metrics of the 'multiprocess' loader, if there is one."""
+        if self.loader is None:
+            return None
+        return self.loader.metrics()
+
+    def close(self):
+        """
+        Shut down any worker processes the generator started and free the
+        shared memory of the 'multiprocess' loader.
+        """
+        if isinstance(self.pg, SPMSampleGen):
+            self.pg.close()
+        if self.loader is not None:
+            self.loader.close()
+            self.loader = None
+
+    def callbacks(self):
+        """
+        Keras callbacks the generator needs during training, and the one
+        that logs the 'multiprocess' loader's stall metrics.
+        """
+        if self.generator in ('hard_negative', 'multiprocess'):
+            assert self.pg is not None or self.loader is not None, \
+                "create_dataset must be called first"
+        callbacks = []
+        if isinstance(self.pg, HardNegativeSimCLRGen):
+            callbacks.append(HardNegativeRefresh(self.pg,
+                                                 self.refresh_interval))
+        if self.loader is not None:
+            callbacks.append(LoaderMetrics(self.loader))
+        return callbacks
+
     def create_dataset(self):
 
         def encode_one_hot(files, label):
@@ -97,33 +241,122 @@ class SimCLRDataset:
         f = join("data/", self.data_file)
         print(os.path.exists(f))
         print(f)
-        df = pd.read_hdf(f)
-        pg = SimCLRGen(df,
-                       crop_length=self.max_code_length,
-                       batch_size=self.batch_size,
-                       samples_per_epoch=num_samples)
+        self.corpus = load_corpus(f)
+        print(f"Corpus memory usage: {self.memory_usage()}")
+        if self.generator == 'spm_sample':
+            pg = SPMSampleGen(self.corpus,
+                              crop_length=self.max_code_length,
+                              model_file=join("data/", self.spm_model_file),
+                              alpha=self.spm_alpha,
+                              nbest_size=self.spm_nbest_size,
+                              batch_size=self.batch_size,
+                              samples_per_epoch=num_samples,
+                              num_workers=self.num_workers)
+        elif self.generator == 'hard_negative' and 'train' in self.data_file:
+            pg = HardNegativeSimCLRGen(self.corpus,
+                                       crop_length=self.max_code_length,
+                                       batch_size=self.batch_size,
+                                       samples_per_epoch=num_samples,
+                                       probe_authors=self.probe_authors,
+                                       hard_fraction=self.hard_fraction)
+        elif self.generator != 'multiprocess':
+            # The 'multiprocess' workers build their own generators
+            pg = SimCLRGen(self.corpus,
+                           crop_length=self.max_code_length,
+                           batch_size=self.batch_size,
+                           samples_per_epoch=num_samples)
+        else:
+            pg = None
+        self.pg = pg
+        if self.generator == 'hard_negative' and \
+                not isinstance(pg, HardNegativeSimCLRGen):
+            print(f"Hard negatives are only mined for training, sampling "
+                  f"{self.data_file} like 'batch'", flush=True)
 
         print("Generating Data...", flush=True)
 
-        shape = [self.max_code_length]
+        shape = [self.batch_size, self.max_code_length]
+        batch_types = ({"input_1": tf.int32, "input_2": tf.int32}, tf.bool)
+        batch_shapes = ({
+            "input_1": tf.TensorShape(shape),
+            "input_2": tf.TensorShape(shape)
+        }, tf.TensorShape([self.batch_size]))
+
+        if self.generator == 'multiprocess':
+            num_workers = self.num_workers or os.cpu_count()
+            self.loader = SharedMemoryLoader(
+                partial(simclr_shard, self.corpus.path, self.max_code_length,
+                        self.batch_size, num_samples, num_workers),
+                self.batch_size,
+                self.max_code_length,
+                num_workers=num_workers,
+                queue_depth=self.queue_depth)
+            dataset = tf.data.Dataset.from_generator(self.loader.gen_batches,
+                                                     batch_types,
+                                                     output_shapes=batch_shapes)
+
+            print("Data Generated.", flush=True)
+        elif self.generator == 'sharded':
+            shards = pg.shards(self.num_shards)
+            print(f"Interleaving {len(shards)} generator shards", flush=True)
+
+            def shard_dataset(shard):
+                return tf.data.Dataset.from_generator(
+                    lambda shard: shards[shard].gen_batches(),
+                    batch_types,
+                    output_shapes=batch_shapes,
+                    args=(shard,)).repeat()
+
+            dataset = tf.data.Dataset.range(len(shards)).interleave(
+                shard_dataset,
+                cycle_length=len(shards),
+                block_length=1,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=False)
+
+            print("Data Generated.", flush=True)
+        elif self.generator == 'plan':
+            if 'train' in self.data_file:
+                pg.use_epoch_plans(self.plan_dir, self.plan_seed,
+                                   self.plan_epoch, self.plan_step)
+            else:
+                pg.use_epoch_plans(self.plan_dir, self.plan_seed)
+            dataset = tf.data.Dataset.from_generator(pg.gen_plan_batches,
+                                                     batch_types,
+                                                     output_shapes=batch_shapes)
+
+            print("Data Generated.", flush=True)
+
+            dataset = dataset.repeat()
+        elif self.generator in ('batch', 'spm_sample', 'hard_negative'):
+            dataset = tf.data.Dataset.from_generator(pg.gen_batches,
+                                                     batch_types,
+                                                     output_shapes=batch_shapes)
+
+            print("Data Generated.", flush=True)
+
+            dataset = dataset.repeat()
+        else:
+            shape = [self.max_code_length]
+
+            dataset = tf.data.Dataset.from_generator(pg.gen, ({
+                "input_1": tf.int32,
+                "input_2": tf.int32
+            }, tf.bool),
+                output_shapes=({
+                    "input_1":
+                    tf.TensorShape(shape),
+                    "input_2":
+                    tf.TensorShape(shape)
+                }, tf.TensorShape([])))
 
-        dataset = tf.data.Dataset.from_generator(pg.gen, ({
-            "input_1": tf.int32,
-            "input_2": tf.int32
-        }, tf.bool),
-            output_shapes=({
-                "input_1":
-                tf.TensorShape(shape),
-                "input_2":
-                tf.TensorShape(shape)
-            }, tf.TensorShape([])))
+            print("Data Generated.", flush=True)
 
-        print("Data Generated.", flush=True)
+            dataset = dataset.repeat()
 
-        dataset = dataset.repeat()
+            print(f"batch_size {self.batch_size}")
+            dataset = dataset.batch(self.batch_size)
 
-        print(f"batch_size {self.batch_size}")
-        dataset = dataset.batch(self.batch_size)
         dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
         return dataset
@@ -4,6 +4,8 @@ import os
 
 from auth_ident.preprocessing import load_data
 from auth_ident.generators import PairGen
+from auth_ident.packed_corpus import load_corpus
+from auth_ident.encodings import get_encoding, START, END
 import auth_ident
 from tensorflow.keras.layers.experimental.preprocessing import TextVectorization
 from bpe import Encoder
@@ -16,30 +18,48 @@ class SplitDataset:
                  batch_size,
                  encoding_type='bpe',
                  flip_labels=False,
-                 language='python'):
+                 language='python',
+                 generator='sample',
+                 data_file=None):
+        """
+        data_file is the corpus to pair, relative to data/ and named after
+        its split (train, val or test). Without it create_dataset takes a
+        language and split and reads data/loaded/<language>_<split>.h5.
+
+        generator selects how PairGen feeds the pipeline:
+            'sample' yields one pair of strings at a time and batches in
+                tf.data.
+            'batch' yields whole batches of code points built with array
+                ops (PairGen.gen_batches), one-hot encoded a batch at a
+                time. Only for the 'one_hot' encoding.
+        """
         
         self.max_code_length = max_code_length
         self.batch_size = batch_size
         self.encoding_type = encoding_type
         self.flip_labels = flip_labels
+        self.generator = generator
+        self.language = language
+        self.data_file = data_file
+        self.corpus = None
 
         print("\nIn INIT\n", flush=True)
-        chars_to_encode = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM\n\r\t " + r"1234567890-=!@#$%^&*()_+[]{}|;':\",./<>?"
-        self.start = "<start>"
-        self.end = "<end>"
-        chars_to_encode = [self.start, self.end] + list(chars_to_encode)
-        self.len_encoding = len(chars_to_encode)
-        chars_index = [i for i in range(self.len_encoding)]
+        encoding = get_encoding(vocabulary="start_end")
+        self.start = START
+        self.end = END
+        self.len_encoding = len(encoding.vocabulary)
+        self.table = encoding.table
+        self.code_point_ids = encoding.code_point_ids()
+        self.start_id = encoding.vocabulary.index(START)
+        self.end_id = encoding.vocabulary.index(END)
 
-        char_map = tf.lookup.KeyValueTensorInitializer(chars_to_encode,
-                                                       chars_index,
-                                                       key_dtype=tf.string,
-                                                       value_dtype=tf.int64)
-        self.table = tf.lookup.StaticVocabularyTable(char_map,
-                                                     num_oov_buckets=1)
+        if self.generator == 'batch':
+            assert self.encoding_type == 'one_hot', \
+                "the batch generator needs encoding_type one_hot"
 
-        pickleFile = open(os.path.join('data/loaded/encoders', language + "_encoder.pkl"), 'rb')
-        self.encoder = pickle.load(pickleFile)
+        if self.encoding_type == 'bpe':
+            pickleFile = open(os.path.join('data/loaded/encoders', language + "_encoder.pkl"), 'rb')
+            self.encoder = pickle.load(pickleFile)
 
 
     def encode_to_one_hot(self, code_to_embed):
@@ -58,6 +78,25 @@ class SplitDataset:
 
         return encoding
 
+    def encode_batch_to_one_hot(self, code_points):
+        """
+        encode_to_one_hot for a (batch, max_code_length) batch of zero
+        padded code points. Code point 0 encodes like the '\\0' padding of
+        PairGen.gen.
+        """
+        ids = tf.gather(self.code_point_ids,
+                        tf.minimum(code_points, len(self.code_point_ids) - 1))
+        batch_size = tf.shape(ids)[0]
+        ids = tf.concat([tf.fill([batch_size, 1], self.start_id), ids,
+                         tf.fill([batch_size, 1], self.end_id)], axis=1)
+        return tf.one_hot(ids, self.len_encoding)
+
+    def memory_usage(self):
+        """Resident-memory footprint of the loaded corpus, in bytes."""
+        if self.corpus is None:
+            return None
+        return self.corpus.memory_usage()
+
     def bpe_encode(self, code_to_encode):
         
         lines = [line.splt('\n') for line in code_to_encode]
@@ -70,7 +109,7 @@ class SplitDataset:
             label = 1
         return files, label
 
-    def create_dataset(self, language, split):
+    def create_dataset(self, language=None, split=None):
 
         def bpe_encode_both(files, labels):
             files['input_1'] = self.bpe_encode(files['input_1'])
@@ -100,6 +139,18 @@ class SplitDataset:
             label = label
             return files, label
 
+        if self.flip_labels:
+            print(
+                "ERROR: Flip Labels not supported: split_dataset.create_dataset"
+            )
+            exit(1)
+
+        if language is None:
+            language = self.language
+        if split is None:
+            split = next((s for s in ('train', 'val', 'test')
+                          if s in self.data_file), None)
+
         if split == 'train':
             num_samples = auth_ident.TRAIN_LEN
         elif split == 'val':
@@ -109,49 +160,79 @@ class SplitDataset:
         else:
             print(
                 "ERROR: Invalid split type in split_dataset.create_dataset: " +
-                split)
+                str(split))
+            exit(1)
 
-        f = "data/loaded/" + language + "_" + split + ".h5"
-        df = pd.read_hdf(f)
-        pg = PairGen(df,
+        if self.data_file is not None:
+            f = os.path.join("data/", self.data_file)
+        else:
+            f = "data/loaded/" + language + "_" + split + ".h5"
+        self.corpus = load_corpus(f)
+        print(f"Corpus memory usage: {self.memory_usage()}")
+        pg = PairGen(self.corpus,
                      crop_length=self.max_code_length,
                      samples_per_epoch=num_samples)
 
         print("Generating Data...", flush=True)
-        dataset = tf.data.Dataset.from_generator(
-            pg.gen, 
-            ({
-                "input_1": tf.string,
-                "input_2": tf.string
-            }, tf.bool),
-            output_shapes=(
-                {
-                    "input_1":
-                    tf.TensorShape([]),
-                    "input_2":
-                    tf.TensorShape([])
-                }, 
-                tf.TensorShape([]))
-        )
-
-        print("Data Generated.", flush=True)
-
-        dataset = dataset.repeat()
-
-        if self.encoding == 'bpe':
-            dataset = dataset.batch(self.batch_size)
-            dataset = dataset.map(self.bpe_encode, tf.data.experimental.AUTOTUNE)
-            dataset = dataset.map(set_batch_shape, tf.data.experimental.AUTOTUNE)
-        elif self.encoding == 'one_hot':
-            dataset = dataset.map(encode_one_hot)
-            dataset = dataset.map(set_shape, tf.data.experimental.AUTOTUNE)
-            dataset = dataset.batch(self.batch_size)
-
-        if self.flip_labels:
-            print(
-                "ERROR: Flip Labels not supported: split_dataset.create_dataset"
+        if self.generator == 'batch':
+            shape = [self.batch_size, self.max_code_length]
+            dataset = tf.data.Dataset.from_generator(
+                lambda: pg.gen_batches(self.batch_size),
+                ({
+                    "input_1": tf.int32,
+                    "input_2": tf.int32
+                }, tf.bool),
+                output_shapes=(
+                    {
+                        "input_1": tf.TensorShape(shape),
+                        "input_2": tf.TensorShape(shape)
+                    },
+                    tf.TensorShape([self.batch_size])))
+
+            print("Data Generated.", flush=True)
+
+            dataset = dataset.repeat()
+
+            def encode_batch_one_hot(files, label):
+                files["input_1"] = self.encode_batch_to_one_hot(
+                    files["input_1"])
+                files["input_2"] = self.encode_batch_to_one_hot(
+                    files["input_2"])
+                return files, label
+
+            dataset = dataset.map(encode_batch_one_hot,
+                                  tf.data.experimental.AUTOTUNE)
+            dataset = dataset.map(set_batch_shape,
+                                  tf.data.experimental.AUTOTUNE)
+        else:
+            dataset = tf.data.Dataset.from_generator(
+                pg.gen, 
+                ({
+                    "input_1": tf.string,
+                    "input_2": tf.string
+                }, tf.bool),
+                output_shapes=(
+                    {
+                        "input_1":
+                        tf.TensorShape([]),
+                        "input_2":
+                        tf.TensorShape([])
+                    }, 
+                    tf.TensorShape([]))
             )
-            exit(1)
+
+            print("Data Generated.", flush=True)
+
+            dataset = dataset.repeat()
+
+            if self.encoding_type == 'bpe':
+                dataset = dataset.batch(self.batch_size)
+                dataset = dataset.map(self.bpe_encode, tf.data.experimental.AUTOTUNE)
+                dataset = dataset.map(set_batch_shape, tf.data.experimental.AUTOTUNE)
+            elif self.encoding_type == 'one_hot':
+                dataset = dataset.map(encode_one_hot)
+                dataset = dataset.map(set_shape, tf.data.experimental.AUTOTUNE)
+                dataset = dataset.batch(self.batch_size)
 
         dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
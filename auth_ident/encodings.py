@@ -0,0 +1,180 @@
+"""
+Shared vocabularies and encoding sizes for the dataset classes.
+
+Every vocabulary and lookup table is built once per process and handed to
+every dataset that asks for it. For 'spm' and 'tokens' datasets the
+encoding length is also saved in a small sidecar next to the dataset,
+
+    data/<data_file>.encoding.json
+
+so later runs don't have to load the spm model or count the lines of the
+top identifiers file again. The sidecar records the file it was derived
+from, and for 'tokens' the token id layout of the dataset, and is rebuilt
+when either changes.
+"""
+import json
+import os
+from os.path import join
+
+import numpy as np
+
+from auth_ident import TOKEN_LAYOUT_INDEX_BUFFERS, LEGACY_TOKEN_LAYOUT
+from auth_ident.packed_corpus import corpus_info
+
+
+DATA_DIR = "data/"
+
+CHARS = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM\n\r\t " + r"1234567890-=!@#$%^&*()_+[]{}|;':\",./<>?"
+START = "<start>"
+END = "<end>"
+
+# Character vocabularies used by the datasets, by name
+VOCABULARIES = {
+    # SimCLRDataset, ClosedDataset and SplitDataset
+    "start_end": [START, END] + list(CHARS),
+    # CombinedDataset
+    "chars": list(CHARS),
+    # ByLineDataset, '\0' pads short lines
+    "null_padded": ['\0'] + list(CHARS),
+}
+
+
+class Encoding:
+    """
+    A character vocabulary with its tf lookup table (built on first use,
+    one out of vocabulary bucket) and the encoding length models should use.
+    """
+    def __init__(self, vocabulary, len_encoding):
+        self.vocabulary = VOCABULARIES[vocabulary]
+        self.len_encoding = len_encoding
+        self._table = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            import tensorflow as tf
+
+            char_map = tf.lookup.KeyValueTensorInitializer(
+                self.vocabulary,
+                list(range(len(self.vocabulary))),
+                key_dtype=tf.string,
+                value_dtype=tf.int64)
+            self._table = tf.lookup.StaticVocabularyTable(char_map,
+                                                          num_oov_buckets=1)
+        return self._table
+
+    def code_point_ids(self):
+        """
+        numpy version of table for single characters: the id of every
+        code point below 128 (all vocabulary characters are ascii) and one
+        more entry, the out of vocabulary id, for anything at or above it.
+        """
+        ids = np.full(129, len(self.vocabulary), dtype=np.int32)
+        for i, token in enumerate(self.vocabulary):
+            if len(token) == 1:
+                ids[ord(token)] = i
+        return ids
+
+
+# Encodings already built by this process, keyed by get_encoding's arguments
+_encodings = {}
+
+
+def get_encoding(encoding_type='char', data_file=None, spm_model_file=None,
+                 vocabulary="start_end"):
+    """
+    The shared Encoding for a dataset.
+
+    len_encoding is the spm vocab size for 'spm', the index buffer of the
+    dataset's token id layout (TOKEN_LAYOUT_INDEX_BUFFERS) plus the number
+    of top identifiers for 'tokens' and the vocabulary plus the out of
+    vocabulary bucket for anything else.
+    """
+    key = (encoding_type, data_file, spm_model_file, vocabulary)
+    if key not in _encodings:
+        if encoding_type in ("spm", "tokens"):
+            len_encoding = cached_len_encoding(encoding_type, data_file,
+                                               spm_model_file)
+        else:
+            len_encoding = len(VOCABULARIES[vocabulary]) + 1
+        _encodings[key] = Encoding(vocabulary, len_encoding)
+    return _encodings[key]
+
+
+def sidecar_path(data_file):
+    return os.path.normpath(join(DATA_DIR, data_file)) + ".encoding.json"
+
+
+def top_identifiers_file(data_file):
+    # Assume format data/.../{language}_{type}_encoded.h5
+    return DATA_DIR + "_".join(data_file.split("_")[:-2]) + \
+        "_top_identifiers.txt"
+
+
+def token_layout(data_file):
+    """
+    Token id layout a 'tokens' dataset was encoded with, as recorded in its
+    corpus_info. Datasets that don't record one use the legacy layout.
+    """
+    return corpus_info(join(DATA_DIR, data_file)).get("token_layout",
+                                                      LEGACY_TOKEN_LAYOUT)
+
+
+def cached_len_encoding(encoding_type, data_file, spm_model_file=None):
+    """
+    len_encoding of an 'spm' or 'tokens' dataset, read from its sidecar
+    when that is still valid and computed (and saved) otherwise.
+    """
+    if encoding_type == "spm":
+        source = join(DATA_DIR, spm_model_file)
+        layout = None
+    else:
+        source = top_identifiers_file(data_file)
+        layout = token_layout(data_file)
+    source_mtime = os.path.getmtime(source)
+
+    sidecar = sidecar_path(data_file) if data_file is not None else None
+    if sidecar is not None and os.path.exists(sidecar):
+        with open(sidecar) as f:
+            info = json.load(f)
+        if (info.get("encoding_type") == encoding_type and
+                info.get("source") == source and
+                info.get("source_mtime") == source_mtime and
+                info.get("token_layout") == layout):
+            return info["len_encoding"]
+
+    if encoding_type == "spm":
+        import sentencepiece as spm
+
+        len_encoding = spm.SentencePieceProcessor(
+            model_file=source).vocab_size()
+    else:
+        if "cpp" in data_file:
+            len_encoding = TOKEN_LAYOUT_INDEX_BUFFERS[layout]
+        elif "java" in data_file:
+            len_encoding = TOKEN_LAYOUT_INDEX_BUFFERS[layout]
+        else:
+            assert False, "No python length encoding known"
+
+        with open(source) as f:
+            num_reserved_identifiers = sum([1 for line in f])
+        len_encoding += num_reserved_identifiers
+    print(f"ENCODING_LEN: {len_encoding}")
+
+    if sidecar is not None:
+        info = {"encoding_type": encoding_type,
+                "len_encoding": len_encoding,
+                "source": source,
+                "source_mtime": source_mtime,
+                "token_layout": layout}
+        # Write under a temporary name so a reader never sees half a file
+        tmp_sidecar = f"{sidecar}.tmp-{os.getpid()}"
+        try:
+            with open(tmp_sidecar, 'w') as f:
+                json.dump(info, f, indent=4)
+            os.replace(tmp_sidecar, sidecar)
+        except OSError:
+            # Read-only data directory, just recompute next time
+            pass
+
+    return len_encoding
@@ -1,2 +1,5 @@
 from auth_ident.generators.simclr_generator import SimCLRGen
 from auth_ident.generators.pairs_generator import PairGen
+from auth_ident.generators.spm_sample_generator import SPMSampleGen
+from auth_ident.generators.shared_memory_loader import SharedMemoryLoader
+from auth_ident.generators.hard_negative_generator import HardNegativeSimCLRGen
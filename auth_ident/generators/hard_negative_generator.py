@@ -0,0 +1,125 @@
+import time
+
+import numpy as np
+
+from auth_ident.generators.simclr_generator import SimCLRGen
+
+
+class HardNegativeSimCLRGen(SimCLRGen):
+    """
+    SimCLRGen that fills batches with authors the current encoder confuses,
+    so every batch carries informative negatives without needing a huge
+    batch size.
+
+    refresh(embed) embeds files_per_author random files of probe_authors
+    authors (drawn by file count) with the current encoder, averages them
+    into l2-normalized author centroids and keeps each probed author's
+    batch_size - 1 nearest centroids. Until the first refresh batches are
+    drawn exactly like SimCLRGen.
+
+    After a refresh, hard_fraction of every batch is built from a random
+    probed author and its neighbours (moving on to another probed author's
+    group if that runs out) and the rest is drawn like SimCLRGen. Authors in
+    a batch are always distinct.
+
+    refresh is meant to be called from the training loop while gen_batches
+    runs in the tf.data thread, so it draws from its own random stream and
+    swaps the new neighbour graph in with a single assignment.
+    """
+    def __init__(self,
+                 corpus,
+                 crop_length,
+                 batch_size=64,
+                 samples_per_epoch=1000,
+                 probe_authors=2048,
+                 files_per_author=4,
+                 hard_fraction=0.5,
+                 seed=1):
+        super().__init__(corpus, crop_length, batch_size, samples_per_epoch,
+                         seed)
+        self.probe_authors = min(probe_authors, len(self.authors))
+        self.files_per_author = files_per_author
+        self.num_hard = min(int(round(hard_fraction * batch_size)),
+                            self.probe_authors)
+
+        self.refresh_rng = np.random.default_rng(
+            np.random.SeedSequence([seed, 1]))
+        # (probed author indices, neighbour rows into those indices)
+        self.graph = None
+        self.refresh_times = []
+
+    def refresh(self, embed):
+        """
+        Rebuild the author neighbour graph.
+
+        embed maps an int32 (n, crop_length) batch of crops to (n, d)
+        embeddings. Returns the seconds the refresh took, which is also
+        appended to refresh_times.
+        """
+        start = time.perf_counter()
+
+        probe = self.refresh_rng.choice(len(self.authors),
+                                        self.probe_authors,
+                                        replace=False,
+                                        p=self.author_probs,
+                                        shuffle=False)
+        counts = self.author_counts[probe, None]
+        picks = (self.refresh_rng.random(
+            (len(probe), self.files_per_author)) * counts).astype(np.int64)
+        files = self.author_files[self.author_starts[probe, None] + picks]
+
+        crops = self.corpus.crop_batch(files.ravel(), self.crop_length,
+                                       self.eos_id)
+        embeddings = np.asarray(embed(crops), dtype=np.float32)
+        embeddings = l2_normalize(embeddings).reshape(
+            len(probe), self.files_per_author, -1)
+        centroids = l2_normalize(embeddings.mean(axis=1))
+
+        similarities = centroids @ centroids.T
+        np.fill_diagonal(similarities, -np.inf)
+        k = min(self.batch_size, len(probe)) - 1
+        neighbors = np.argpartition(-similarities, k - 1, axis=1)[:, :k] \
+            if k > 0 else np.empty((len(probe), 0), dtype=np.int64)
+        rows = np.arange(len(probe))[:, None]
+        order = np.argsort(-similarities[rows, neighbors], axis=1,
+                           kind='stable')
+        neighbors = neighbors[rows, order]
+
+        self.graph = (probe, neighbors)
+
+        seconds = time.perf_counter() - start
+        self.refresh_times.append(seconds)
+        return seconds
+
+    def sample_pairs(self):
+        graph = self.graph
+        if graph is None or self.num_hard == 0:
+            return super().sample_pairs()
+        probe, neighbors = graph
+
+        taken = np.zeros(len(self.authors), dtype=bool)
+        hard = []
+        num_hard = 0
+        while num_hard < self.num_hard:
+            group_seed = self.rng.integers(len(probe))
+            group = probe[np.concatenate([[group_seed],
+                                          neighbors[group_seed]])]
+            group = group[~taken[group]][:self.num_hard - num_hard]
+            taken[group] = True
+            hard.append(group)
+            num_hard += len(group)
+
+        # The rest by file count, like plan_epoch, skipping the hard authors
+        keys = np.log(self.rng.random(len(self.authors))) / self.author_probs
+        keys[taken] = -np.inf
+        num_rest = self.batch_size - num_hard
+        rest = np.argpartition(-keys, num_rest - 1)[:num_rest] \
+            if num_rest > 0 else np.empty(0, dtype=np.int64)
+
+        return self.pairs_for_authors(np.concatenate(hard + [rest]))
+
+
+def l2_normalize(X):
+    norms = np.linalg.norm(X, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return X / norms
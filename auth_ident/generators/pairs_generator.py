@@ -5,21 +5,32 @@ import pandas as pd
 import numpy as np
 import itertools
 
+from auth_ident.packed_corpus import (PackedCorpus, load_corpus,
+                                      code_points_to_text)
+
 
 class PairGen:
-    def __init__(self, dataframe, crop_length, match_rate=.5,
+    """
+    corpus is a 'text' PackedCorpus (possibly memory-mapped), a dataframe
+    of raw file contents or the path of either.
+    """
+    def __init__(self, corpus, crop_length, match_rate=.5,
                  samples_per_epoch=1000):
-        self.dataframe = dataframe
+        if isinstance(corpus, str):
+            corpus = load_corpus(corpus)
+        elif isinstance(corpus, pd.DataFrame):
+            corpus = PackedCorpus.from_dataframe(corpus)
+        self.corpus = corpus
         self.crop_length = crop_length
         self.match_rate = match_rate
         self.samples_per_epoch = samples_per_epoch
 
         self.rng = np.random.default_rng(1)
 
-        self.num_files = len(dataframe)
+        self.num_files = len(corpus)
 
         # Mapping from author names to file index
-        self.files_by_auth_name = dataframe.groupby(['username']).indices
+        self.files_by_auth_name = corpus.files_by_author()
 
         # reverse file to author mapping
         self.indx_to_auth = {}
@@ -27,6 +38,27 @@ class PairGen:
             for indx in item[1]:
                 self.indx_to_auth[indx] = item[0]
 
+        # Author index of every file, and files grouped by author so the
+        # files of author i are
+        # author_files[author_starts[i]:author_starts[i] + author_counts[i]]
+        self.file_to_author = np.empty(self.num_files, dtype=np.int64)
+        for i, indices in enumerate(self.files_by_auth_name.values()):
+            self.file_to_author[indices] = i
+        self.author_counts = np.array(
+            [len(indices) for indices in self.files_by_auth_name.values()])
+        self.author_starts = np.concatenate(
+            [[0], np.cumsum(self.author_counts)[:-1]])
+        self.author_files = np.concatenate(
+            list(self.files_by_auth_name.values()))
+
+        # gen's non-matching pairs are uniform over pairs of files by
+        # different authors, so a file is the first of one with probability
+        # proportional to the number of files by other authors.
+        self.non_match_cdf = np.cumsum(
+            self.num_files - self.author_counts[self.file_to_author],
+            dtype=np.float64)
+        self.non_match_cdf /= self.non_match_cdf[-1]
+
         # Store all of the files by authors with more than one file.
         self.files_with_pairs = np.array(list(itertools.chain.from_iterable(
             filter(
@@ -75,6 +107,79 @@ class PairGen:
                                                 self.crop_length)},
                    matching_pair)
 
+    def gen_batches(self, batch_size):
+        """
+        Batch-native version of gen. Yields
+        ({'input_1': int32 (batch_size, crop_length), 'input_2': ...},
+        labels (batch_size,)) batches of random crops as code points, zero
+        padded, drawn with the same distribution as gen but with array ops.
+
+        Matching pairs pick a file from files_with_pairs, then two distinct
+        files by its author. Non-matching pairs pick a first file weighted
+        by the files of other authors, then one of those num_files - count
+        files: an index into
+        the files grouped by author with the first author's block removed,
+        shifted past that block, so no pair is ever redrawn.
+        """
+        for _ in range(self.samples_per_epoch // batch_size):
+            matching = self.rng.random(batch_size) < self.match_rate
+            first = np.empty(batch_size, dtype=np.int64)
+            second = np.empty(batch_size, dtype=np.int64)
+
+            num_matching = np.count_nonzero(matching)
+            rand_file = self.files_with_pairs[
+                self.rng.integers(len(self.files_with_pairs),
+                                  size=num_matching)]
+            rand_auth = self.file_to_author[rand_file]
+            counts = self.author_counts[rand_auth]
+            starts = self.author_starts[rand_auth]
+            file_1 = (self.rng.random(num_matching) * counts).astype(np.int64)
+            file_2 = (self.rng.random(num_matching) *
+                      (counts - 1)).astype(np.int64)
+            file_2 += file_2 >= file_1
+            first[matching] = self.author_files[starts + file_1]
+            second[matching] = self.author_files[starts + file_2]
+
+            num_other = batch_size - num_matching
+            rand_file = np.minimum(
+                np.searchsorted(self.non_match_cdf,
+                                self.rng.random(num_other), side='right'),
+                self.num_files - 1)
+            rand_auth = self.file_to_author[rand_file]
+            counts = self.author_counts[rand_auth]
+            starts = self.author_starts[rand_auth]
+            other = (self.rng.random(num_other) *
+                     (self.num_files - counts)).astype(np.int64)
+            other += (other >= starts) * counts
+            first[~matching] = rand_file
+            second[~matching] = self.author_files[other]
+
+            yield ({'input_1': self.random_crop_batch(first, self.crop_length),
+                    'input_2': self.random_crop_batch(second,
+                                                      self.crop_length)},
+                   matching)
+
+    def random_crop_batch(self, file_indices, crop_length):
+        """
+        random_crop of every file in file_indices at once, as an int32
+        (len(file_indices), crop_length) array of code points padded with 0.
+        """
+        offsets = self.corpus.offsets
+        starts = offsets[file_indices]
+        lengths = offsets[file_indices + 1] - starts
+        starts = starts + (self.rng.random(len(file_indices)) *
+                           (np.maximum(lengths - crop_length, 0) + 1)
+                           ).astype(np.int64)
+        lengths = np.minimum(lengths, crop_length)
+
+        columns = np.arange(crop_length)
+        body = columns[np.newaxis, :] < lengths[:, np.newaxis]
+        positions = starts[:, np.newaxis] + columns[np.newaxis, :]
+
+        cropped = np.zeros((len(file_indices), crop_length), dtype=np.int32)
+        cropped[body] = self.corpus.tokens[positions[body]]
+        return cropped
+
     def random_crop(self, file_indx, crop_length):
         """
         Return a random crop from the file at the provided index. If
@@ -82,11 +187,11 @@ class PairGen:
         file will be returned.
         """
 
-        contents = self.dataframe['file_content'][file_indx]
+        contents = self.corpus.file(file_indx)
         if len(contents) > crop_length:
             start = self.rng.integers(0, len(contents) - crop_length + 1)
             contents = contents[start:start + crop_length]
-        return contents.ljust(crop_length, '\0')
+        return code_points_to_text(contents).ljust(crop_length, '\0')
 
 
 if __name__ == "__main__":
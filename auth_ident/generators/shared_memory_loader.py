@@ -0,0 +1,180 @@
+"""
+Multi-process batch loader over a ring of shared memory slots.
+
+Generator workers run in their own processes and write finished
+({'input_1', 'input_2'}, labels) batches straight into shared memory, so
+the training process only hands slot numbers around and never pickles a
+batch or runs generator code under its GIL.
+"""
+from multiprocessing import shared_memory
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+
+def _slot_arrays(buf, slot, batch_size, crop_length, label_dtype):
+    """input_1, input_2 and labels views of one slot of the ring."""
+    input_bytes = batch_size * crop_length * 4
+    slot_bytes = 2 * input_bytes + batch_size * np.dtype(label_dtype).itemsize
+    offset = slot * slot_bytes
+    shape = (batch_size, crop_length)
+
+    input_1 = np.ndarray(shape, np.int32, buf, offset)
+    input_2 = np.ndarray(shape, np.int32, buf, offset + input_bytes)
+    labels = np.ndarray((batch_size,), label_dtype, buf,
+                        offset + 2 * input_bytes)
+    return input_1, input_2, labels
+
+
+def _worker(make_generator, worker_id, shm_name, batch_size, crop_length,
+            label_dtype, free_slots, ready_slots, producer_wait,
+            producer_stalls):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    generator = make_generator(worker_id)
+
+    try:
+        while True:
+            for inputs, labels in generator.gen_batches():
+                try:
+                    slot = free_slots.get_nowait()
+                except queue.Empty:
+                    # Every slot is full: the consumer is the bottleneck
+                    start = time.perf_counter()
+                    slot = free_slots.get()
+                    with producer_wait.get_lock():
+                        producer_wait.value += time.perf_counter() - start
+                        producer_stalls.value += 1
+
+                input_1, input_2, slot_labels = _slot_arrays(
+                    shm.buf, slot, batch_size, crop_length, label_dtype)
+                input_1[...] = inputs['input_1']
+                input_2[...] = inputs['input_2']
+                slot_labels[...] = labels
+                del input_1, input_2, slot_labels
+
+                ready_slots.put(slot)
+    finally:
+        shm.close()
+
+
+class SharedMemoryLoader:
+    """
+    Runs num_workers generator processes that fill a ring of queue_depth
+    shared memory batch slots.
+
+    make_generator(worker_id) must be picklable (a module level function
+    or a functools.partial of one) and return an object whose gen_batches()
+    yields ({'input_1': int32 (batch_size, crop_length),
+    'input_2': ...}, labels (batch_size,)) batches, e.g. a SimCLRGen shard.
+    Workers start over with gen_batches() whenever it runs out.
+
+    Each batch is copied out of its slot, and the slot goes straight back to
+    the workers, so a batch stays valid however long tf.data (prefetch,
+    shuffle buffers, ...) holds on to it. metrics() reports how long the
+    consumer waited for batches (workers too slow) and how long workers
+    waited for a free slot (training too slow).
+    """
+    def __init__(self, make_generator, batch_size, crop_length,
+                 num_workers=4, queue_depth=None, label_dtype=bool):
+        self.batch_size = batch_size
+        self.crop_length = crop_length
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth or 2 * num_workers
+        self.label_dtype = np.dtype(label_dtype)
+
+        slot_bytes = (2 * batch_size * crop_length * 4 +
+                      batch_size * self.label_dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=slot_bytes * self.queue_depth)
+
+        # Spawned rather than forked, the training process has tensorflow
+        # threads running
+        context = multiprocessing.get_context("spawn")
+        self.free_slots = context.Queue()
+        self.ready_slots = context.Queue()
+        for slot in range(self.queue_depth):
+            self.free_slots.put(slot)
+
+        self.producer_wait = context.Value('d', 0.0)
+        self.producer_stalls = context.Value('q', 0)
+        self.consumer_wait = 0.0
+        self.consumer_stalls = 0
+        self.num_batches = 0
+
+        self.workers = [
+            context.Process(target=_worker,
+                            args=(make_generator, worker_id, self.shm.name,
+                                  batch_size, crop_length, self.label_dtype,
+                                  self.free_slots, self.ready_slots,
+                                  self.producer_wait, self.producer_stalls),
+                            daemon=True)
+            for worker_id in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def next_batch(self):
+        """The next finished batch, copied out of its shared memory slot."""
+        try:
+            slot = self.ready_slots.get_nowait()
+        except queue.Empty:
+            # Nothing ready: the workers are the bottleneck
+            start = time.perf_counter()
+            slot = None
+            while slot is None:
+                try:
+                    slot = self.ready_slots.get(timeout=1.0)
+                except queue.Empty:
+                    failed = [w.exitcode for w in self.workers
+                              if w.exitcode not in (None, 0)]
+                    if failed:
+                        raise RuntimeError(
+                            f"loader workers exited with codes {failed}")
+            self.consumer_wait += time.perf_counter() - start
+            self.consumer_stalls += 1
+
+        self.num_batches += 1
+        input_1, input_2, labels = _slot_arrays(self.shm.buf, slot,
+                                                self.batch_size,
+                                                self.crop_length,
+                                                self.label_dtype)
+        batch = ({'input_1': input_1.copy(), 'input_2': input_2.copy()},
+                 labels.copy())
+        del input_1, input_2, labels
+        self.free_slots.put(slot)
+        return batch
+
+    def gen_batches(self):
+        """Endless generator of batches, for tf.data.Dataset.from_generator."""
+        while True:
+            yield self.next_batch()
+
+    def metrics(self):
+        return {
+            "batches": self.num_batches,
+            "consumer_stalls": self.consumer_stalls,
+            "consumer_wait_s": self.consumer_wait,
+            "producer_stalls": self.producer_stalls.value,
+            "producer_wait_s": self.producer_wait.value,
+        }
+
+    def close(self):
+        if self.shm is None:
+            return
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
@@ -1,46 +1,79 @@
+import copy
+import multiprocessing
+import os
+
 import pandas as pd
 import numpy as np
 
+from auth_ident.packed_corpus import PackedCorpus, load_corpus
+
 
-def just_multi_authors(frame):
-    files_by_auth_name = frame.groupby(['username']).indices
-    matches = [len(files_by_auth_name[name]) > 1 for name in frame['username']]
-    return frame.loc[matches].reset_index(drop=True)
+def multi_file_authors(files_by_auth_name):
+    """Keep only the authors that have more than one file."""
+    return {name: files for name, files in files_by_auth_name.items()
+            if len(files) > 1}
 
 
 class SimCLRGen:
     """
     Code for creating on-the-fly random file pairings for Sim-CLR training.
+
+    corpus can be a PackedCorpus (possibly memory-mapped), a dataframe or
+    the path of either.
     """
     def __init__(self,
-                 dataframe,
+                 corpus,
                  crop_length,
                  batch_size=64,
-                 samples_per_epoch=1000):
+                 samples_per_epoch=1000,
+                 seed=1):
         self.samples_per_epoch = samples_per_epoch
         self.crop_length = crop_length
         self.batch_size = batch_size
         self.num_batches = samples_per_epoch // self.batch_size
 
-        self.rng = np.random.default_rng(1)
+        self.rng = np.random.default_rng(seed)
 
-        self.dataframe = just_multi_authors(dataframe)
+        if isinstance(corpus, str):
+            corpus = load_corpus(corpus)
+        elif isinstance(corpus, pd.DataFrame):
+            corpus = PackedCorpus.from_dataframe(corpus)
+        self.corpus = corpus
 
-        self.num_files = len(self.dataframe)
+        # Mapping from author names to file index
+        self.files_by_auth_name = multi_file_authors(
+            self.corpus.files_by_author())
 
-        self.authors = np.array(list(set(self.dataframe['username'])))
+        self.authors = np.array(list(self.files_by_auth_name))
 
-        # Mapping from author names to file index
-        self.files_by_auth_name = self.dataframe.groupby(['username']).indices
+        self.num_files = sum(
+            len(files) for files in self.files_by_auth_name.values())
 
         file_counts = np.array(
             [len(self.files_by_auth_name[name]) for name in self.authors])
         self.author_probs = file_counts / self.num_files
         assert np.isclose(np.sum(self.author_probs), 1.0)
 
+        # Files grouped by author, in the same order as self.authors, so the
+        # files of author i are
+        # author_files[author_starts[i]:author_starts[i] + author_counts[i]]
+        self.author_counts = file_counts
+        self.author_starts = np.concatenate([[0], np.cumsum(file_counts)[:-1]])
+        self.author_files = np.concatenate(
+            [self.files_by_auth_name[name] for name in self.authors])
+
         self.bos_id = 1
         self.eos_id = 2
 
+        # Epoch plan state, see use_epoch_plans
+        self.plan_dir = None
+        self.plan_seed = None
+        self.plan_corpus = None
+        self.epoch = 0
+        self.start_step = 0
+        self.background_planning = True
+        self.planners = {}
+
     def gen(self):
         """
         Generate file pairings where each file is equally likely to be
@@ -82,13 +115,190 @@ class SimCLRGen:
             yield ({'input_1': input_1[index], 'input_2': input_2[index]}, 1)
             index = (index + 1) % self.batch_size
 
+    def gen_batches(self):
+        """
+        Batch-native version of gen. Yields whole
+        (batch_size, crop_length) int32 batches instead of single samples,
+        so the tf.data pipeline doesn't need to call .batch().
+
+        All author pairs for a batch are drawn at once and cropped straight
+        out of the packed corpus.
+        """
+        labels = np.ones(self.batch_size, dtype=bool)
+
+        for _ in range(self.num_batches):
+            first, second = self.sample_pairs()
+
+            input_1 = self.corpus.crop_batch(first, self.crop_length,
+                                             self.eos_id)
+            input_2 = self.corpus.crop_batch(second, self.crop_length,
+                                             self.eos_id)
+
+            yield ({'input_1': input_1, 'input_2': input_2}, labels)
+
+    def shards(self, num_shards, seed=1):
+        """
+        Split the epoch into num_shards generators that share this one's
+        corpus and author tables but each draw from their own independent
+        random stream. Every shard's batches still hold distinct authors.
+        """
+        shards = []
+        for shard_seed in np.random.SeedSequence(seed).spawn(num_shards):
+            shard = copy.copy(self)
+            shard.rng = np.random.default_rng(shard_seed)
+            shard.samples_per_epoch = self.samples_per_epoch // num_shards
+            shard.num_batches = shard.samples_per_epoch // self.batch_size
+            shards.append(shard)
+        return shards
+
+    def sample_pairs(self):
+        """
+        Draw batch_size distinct authors according to the file distribution
+        and two distinct files by each of them.
+
+        Returns two arrays of file indices.
+        """
+        rand_auth = self.rng.choice(len(self.authors),
+                                    self.batch_size,
+                                    replace=False,
+                                    p=self.author_probs,
+                                    shuffle=False)
+        return self.pairs_for_authors(rand_auth)
+
+    def pairs_for_authors(self, rand_auth):
+        """Two distinct random files by each author in rand_auth."""
+        counts = self.author_counts[rand_auth]
+        first = (self.rng.random(len(rand_auth)) * counts).astype(np.int64)
+
+        # Choose the second file from the remaining counts - 1 files, then
+        # shift past the first file so the two never match.
+        second = (self.rng.random(len(rand_auth)) *
+                  (counts - 1)).astype(np.int64)
+        second += second >= first
+
+        starts = self.author_starts[rand_auth]
+        return self.author_files[starts + first], self.author_files[starts + second]
+
+    def plan_epoch(self, rng, max_block_elements=1 << 24):
+        """
+        Every batch of one epoch in a single vectorized pass.
+
+        Authors are drawn like sample_pairs, batch_size distinct authors per
+        batch weighted by their number of files, using Efraimidis-Spirakis
+        keys: the batch_size largest log(u) / weight per row. Batches are
+        planned max_block_elements (batches * authors) at a time.
+
+        returns: int32 array of shape (num_batches, batch_size, 2), the two
+        file indices of every pair.
+        """
+        num_authors = len(self.authors)
+        block = max(1, max_block_elements // num_authors)
+        plan = np.empty((self.num_batches, self.batch_size, 2), dtype=np.int32)
+
+        for start in range(0, self.num_batches, block):
+            stop = min(start + block, self.num_batches)
+            keys = np.log(rng.random((stop - start, num_authors))) / \
+                self.author_probs
+            rand_auth = np.argpartition(-keys, self.batch_size - 1,
+                                        axis=1)[:, :self.batch_size]
+
+            counts = self.author_counts[rand_auth]
+            first = (rng.random(rand_auth.shape) * counts).astype(np.int64)
+            second = (rng.random(rand_auth.shape) *
+                      (counts - 1)).astype(np.int64)
+            second += second >= first
+
+            starts = self.author_starts[rand_auth]
+            plan[start:stop, :, 0] = self.author_files[starts + first]
+            plan[start:stop, :, 1] = self.author_files[starts + second]
+
+        return plan
+
+    def use_epoch_plans(self, plan_dir, seed=1, epoch=0, step=0,
+                        background=True):
+        """
+        Make gen_plan_batches stream precomputed epoch plans stored in
+        plan_dir. Epoch e is always planned from seed and e, so a run can
+        be repeated exactly or resumed from (epoch, step). With background
+        the next epoch is planned by another process while the current one
+        is streamed.
+
+        Plan file names include a fingerprint of the corpus (see
+        PackedCorpus.fingerprint), so corpora sharing plan_dir never load
+        each other's plans.
+        """
+        os.makedirs(plan_dir, exist_ok=True)
+        self.plan_dir = plan_dir
+        self.plan_corpus = self.corpus.fingerprint()
+        self.plan_seed = seed
+        self.epoch = epoch
+        self.start_step = step
+        self.background_planning = background
+
+    def plan_path(self, epoch):
+        return os.path.join(
+            self.plan_dir,
+            f"plan_{self.plan_corpus}_s{self.plan_seed}_b{self.batch_size}"
+            f"_n{self.num_batches}_e{epoch}.npy")
+
+    def epoch_rng(self, epoch):
+        return np.random.default_rng(
+            np.random.SeedSequence([self.plan_seed, epoch]))
+
+    def start_planning(self, epoch):
+        """Plan epoch in a background process unless it already exists."""
+        path = self.plan_path(epoch)
+        if os.path.exists(path) or epoch in self.planners:
+            return
+        assert self.corpus.path is not None, \
+            "background planning loads the corpus from disk"
+        planner = multiprocessing.get_context("spawn").Process(
+            target=_write_epoch_plan,
+            args=(self.corpus.path, self.crop_length, self.batch_size,
+                  self.samples_per_epoch, self.plan_seed, epoch, path),
+            daemon=True)
+        planner.start()
+        self.planners[epoch] = planner
+
+    def load_plan(self, epoch):
+        """The plan of epoch, waiting for or computing it as needed."""
+        path = self.plan_path(epoch)
+        planner = self.planners.pop(epoch, None)
+        if planner is not None:
+            planner.join()
+        if not os.path.exists(path):
+            save_plan(path, self.plan_epoch(self.epoch_rng(epoch)))
+        return np.load(path, mmap_mode='r')
+
+    def gen_plan_batches(self):
+        """
+        gen_batches that streams the plan of the current epoch (see
+        use_epoch_plans), starting at the resume step.
+        """
+        plan = self.load_plan(self.epoch)
+        if self.background_planning:
+            self.start_planning(self.epoch + 1)
+        labels = np.ones(self.batch_size, dtype=bool)
+
+        start_step, self.start_step = self.start_step, 0
+        for step in range(start_step, plan.shape[0]):
+            pairs = np.asarray(plan[step])
+            input_1 = self.corpus.crop_batch(pairs[:, 0], self.crop_length,
+                                             self.eos_id)
+            input_2 = self.corpus.crop_batch(pairs[:, 1], self.crop_length,
+                                             self.eos_id)
+
+            yield ({'input_1': input_1, 'input_2': input_2}, labels)
+
+        self.epoch += 1
+
     def crop(self, file_indx, crop_length):
         """
         Return a crop from the file at the provided index. If
         crop_length is longer than the length of the file, then the entire
         file will be returned.
         """
-        contents = np.array(self.dataframe['file_content'][file_indx])
+        contents = np.array(self.corpus.file(file_indx))
         # Minus two to account for bos and eso tokens
         max_crop = min(len(contents), crop_length) - 1
         cropped_contents = contents[:max_crop]
@@ -102,6 +312,32 @@ class SimCLRGen:
         return cropped_contents
 
 
+def save_plan(path, plan):
+    # Write under a temporary name so a reader never sees half a file
+    tmp_path = f"{path}.tmp-{os.getpid()}.npy"
+    np.save(tmp_path, plan)
+    os.replace(tmp_path, path)
+
+
+def _write_epoch_plan(corpus_path, crop_length, batch_size,
+                      samples_per_epoch, seed, epoch, path):
+    generator = SimCLRGen(corpus_path, crop_length, batch_size,
+                          samples_per_epoch)
+    generator.plan_seed = seed
+    save_plan(path, generator.plan_epoch(generator.epoch_rng(epoch)))
+
+
+def simclr_shard(corpus_path, crop_length, batch_size, samples_per_epoch,
+                 num_shards, shard):
+    """
+    Shard `shard` of num_shards of a SimCLRGen over the corpus at
+    corpus_path. Meant for functools.partial, as the make_generator of a
+    SharedMemoryLoader.
+    """
+    return SimCLRGen(corpus_path, crop_length, batch_size,
+                     samples_per_epoch).shards(num_shards)[shard]
+
+
 if __name__ == "__main__":
     import time
 
@@ -0,0 +1,182 @@
+from collections import OrderedDict, deque
+import multiprocessing
+import os
+
+import numpy as np
+import sentencepiece as sp
+
+from auth_ident.generators.simclr_generator import SimCLRGen
+from auth_ident.packed_corpus import (load_corpus, pack_sequences, crop_batch,
+                                      code_points_to_text)
+from auth_ident.preprocessing.convert_hdf import preprocess
+
+
+class SampledEncoder:
+    """
+    Encodes files of a normalized text corpus with a freshly sampled spm
+    segmentation every time.
+
+    Only a prefix of each file is encoded: crop_length * chars_per_token
+    characters, falling back to the whole file if that prefix gives too few
+    tokens for a full crop.
+
+    The preprocessed text of the last cache_size files is kept in an LRU
+    cache along with up to cache_samples of their recent encodings. A
+    cached file is given one of those encodings with probability
+    reuse_prob instead of a new sample, which trades some sampling
+    diversity for speed on frequently drawn files. reuse_prob=0 always
+    samples, and then no encodings are kept unless cache_samples says so.
+    """
+    def __init__(self, corpus, model_file, alpha, nbest_size, crop_length,
+                 chars_per_token=8, cache_size=10000, cache_samples=None,
+                 reuse_prob=0.0, seed=None):
+        if isinstance(corpus, str):
+            corpus = load_corpus(corpus)
+        assert corpus.kind == 'text', "needs a normalized text corpus"
+        self.corpus = corpus
+        self.spm = sp.SentencePieceProcessor(model_file)
+        self.by_line = "by_line" in os.path.basename(model_file)
+        self.alpha = alpha
+        self.nbest_size = nbest_size
+        self.crop_length = crop_length
+        self.max_chars = crop_length * chars_per_token
+        self.cache_size = cache_size
+        if cache_samples is None:
+            cache_samples = 4 if reuse_prob > 0 else 0
+        self.cache_samples = cache_samples
+        self.reuse_prob = reuse_prob
+        self.rng = np.random.default_rng(seed)
+
+        # file index -> (preprocessed text, deque of recent encodings)
+        self.cache = OrderedDict()
+
+    def preprocessed(self, file_indx, max_chars=None):
+        code_points = self.corpus.file(file_indx)
+        truncated = max_chars is not None and len(code_points) > max_chars
+        if truncated:
+            code_points = code_points[:max_chars]
+        return (preprocess(code_points_to_text(code_points), self.by_line),
+                truncated)
+
+    def sample(self, text):
+        encoded = self.spm.encode(text,
+                                  alpha=self.alpha,
+                                  nbest_size=self.nbest_size,
+                                  out_type=int,
+                                  enable_sampling=True)
+        if self.by_line:
+            encoded = [i for line in encoded for i in line]
+        return encoded
+
+    def encode(self, file_indx):
+        if file_indx in self.cache:
+            self.cache.move_to_end(file_indx)
+            text, recent = self.cache[file_indx]
+            if recent and self.rng.random() < self.reuse_prob:
+                return recent[self.rng.integers(len(recent))]
+            encoded = self.sample(text)
+        else:
+            text, truncated = self.preprocessed(file_indx, self.max_chars)
+            encoded = self.sample(text)
+            if truncated and len(encoded) < self.crop_length:
+                text, _ = self.preprocessed(file_indx)
+                encoded = self.sample(text)
+
+            recent = deque(maxlen=self.cache_samples)
+            self.cache[file_indx] = (text, recent)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        recent.append(encoded)
+        return encoded
+
+    def crop_batch(self, file_indices, eos_id):
+        """Sampled encodings of the files, cropped like PackedCorpus.crop_batch."""
+        tokens, offsets = pack_sequences(
+            [self.encode(file_indx) for file_indx in file_indices])
+        return crop_batch(tokens, offsets, np.arange(len(file_indices)),
+                          self.crop_length, eos_id)
+
+
+# Encoder of each SPMSampleGen worker process
+_worker_encoder = None
+
+
+def _init_worker(kwargs):
+    global _worker_encoder
+    _worker_encoder = SampledEncoder(**kwargs)
+
+
+def _encode_pairs(job):
+    first, second, eos_id = job
+    return (_worker_encoder.crop_batch(first, eos_id),
+            _worker_encoder.crop_batch(second, eos_id))
+
+
+class SPMSampleGen(SimCLRGen):
+    """
+    SimCLRGen over a normalized text corpus (see convert_hdf --normalized)
+    that samples a new spm segmentation (subword regularization) each time
+    a file is drawn, instead of reading a pre-encoded corpus.
+
+    Pairs are drawn in this process like SimCLRGen.gen_batches and every
+    batch is encoded by one of num_workers processes, keeping up to
+    prefetch batches in flight.
+    """
+    def __init__(self,
+                 corpus,
+                 crop_length,
+                 model_file,
+                 alpha=0.1,
+                 nbest_size=-1,
+                 batch_size=64,
+                 samples_per_epoch=1000,
+                 num_workers=None,
+                 prefetch=None,
+                 **encoder_kwargs):
+        super().__init__(corpus, crop_length, batch_size, samples_per_epoch)
+        assert self.corpus.path is not None, \
+            "workers load the corpus from disk, it must be a packed corpus"
+
+        self.num_workers = num_workers or os.cpu_count()
+        self.prefetch = prefetch or 2 * self.num_workers
+        self.encoder_kwargs = dict(corpus=self.corpus.path,
+                                   model_file=model_file,
+                                   alpha=alpha,
+                                   nbest_size=nbest_size,
+                                   crop_length=crop_length,
+                                   **encoder_kwargs)
+        self.pool = None
+
+    def start_workers(self):
+        if self.pool is None:
+            self.pool = multiprocessing.get_context("spawn").Pool(
+                self.num_workers, _init_worker, (self.encoder_kwargs,))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def gen_batches(self):
+        """
+        Same batches as SimCLRGen.gen_batches, with sampled encodings. The
+        workers are started on the first batch and kept across epochs, so
+        their models, corpora and encoding caches survive dataset.repeat();
+        close() shuts them down.
+        """
+        self.start_workers()
+        labels = np.ones(self.batch_size, dtype=bool)
+
+        pending = deque()
+        submitted = 0
+        while submitted < self.num_batches or pending:
+            while submitted < self.num_batches and \
+                    len(pending) < self.prefetch:
+                first, second = self.sample_pairs()
+                pending.append(self.pool.apply_async(
+                    _encode_pairs, ((first, second, self.eos_id),)))
+                submitted += 1
+
+            input_1, input_2 = pending.popleft().get()
+            yield ({'input_1': input_1, 'input_2': input_2}, labels)
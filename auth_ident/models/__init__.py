@@ -6,6 +6,7 @@ from auth_ident.models.random_forest import RandomForestSecondaryClassifier
 from auth_ident.models.k_neighbors import KNeighborSecondaryClassifier
 from auth_ident.models.svm import SVMSecondaryClassifier
 from auth_ident.models.cosknn import CosKNNSecondaryClassifier
+from auth_ident.models.author_index import AuthorIndexSecondaryClassifier
 from auth_ident.models.end_to_end_secondary import EndToEndMLP
 #from auth_ident.models.histogram_verifier import HistogramVerifier
 
@@ -18,6 +19,7 @@ model_map = {
     "k_neighbors": KNeighborSecondaryClassifier,
     "svm": SVMSecondaryClassifier,
     "cosknn": CosKNNSecondaryClassifier,
+    "author_index": AuthorIndexSecondaryClassifier,
 #    "histogram_verifier": HistogramVerifier,
     "end_to_end_mlp": EndToEndMLP 
 }
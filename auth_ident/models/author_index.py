@@ -0,0 +1,329 @@
+from auth_ident.models import GenericSecondaryClassifier
+from auth_ident.models.cosknn import l2_normalize, exact_top_k, count_votes
+from auth_ident.datasets import ClosedDataset
+
+from sklearn.model_selection import KFold
+
+import numpy as np
+import os
+import time
+
+
+class IVFFlatIndex:
+    """
+    Inverted file index over cosine similarity.
+
+    A spherical k-means quantizer splits the vectors into nlist lists and a
+    query only scans the nprobe lists whose centroids are closest to it.
+    Vectors are stored uncompressed ("flat"), so the only approximation is
+    which lists get scanned; nprobe == nlist is an exact search.
+
+    Vectors can be added at any time after the quantizer is trained. They
+    are kept in insertion order and regrouped by list lazily on the next
+    query.
+    """
+
+    def __init__(self, nlist=256, nprobe=8, n_iter=10, max_train=100000,
+                 seed=1, max_memory_bytes=1 << 30):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.max_train = max_train
+        self.seed = seed
+        self.max_memory_bytes = max_memory_bytes
+
+        self.centroids = None
+        self.vectors = None
+        self.ids = None
+        self.assignments = None
+        self.next_id = 0
+
+        self.order = None
+        self.list_starts = None
+
+    def __len__(self):
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, X):
+        """Fit the coarse quantizer with spherical k-means on X."""
+        rng = np.random.default_rng(self.seed)
+        X = l2_normalize(X)
+        if X.shape[0] > self.max_train:
+            X = X[rng.choice(X.shape[0], self.max_train, replace=False)]
+        nlist = min(self.nlist, X.shape[0])
+
+        centroids = X[rng.choice(X.shape[0], nlist, replace=False)]
+        for _ in range(self.n_iter):
+            assignments = self.assign(X, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, X)
+            counts = np.bincount(assignments, minlength=nlist)
+
+            # Reseed empty lists with random training vectors
+            empty = counts == 0
+            sums[empty] = X[rng.choice(X.shape[0], empty.sum())]
+            centroids = l2_normalize(sums)
+
+        self.centroids = centroids
+        self.nlist = nlist
+        return self
+
+    def assign(self, X, centroids=None):
+        if centroids is None:
+            centroids = self.centroids
+        nearest, _ = exact_top_k(X, centroids, 1, self.max_memory_bytes,
+                                 normalized=True)
+        return nearest[:, 0]
+
+    def add(self, X, ids=None):
+        """
+        Add vectors to the index. ids default to consecutive integers in
+        insertion order. Trains the quantizer on X if it is not trained yet.
+        """
+        X = l2_normalize(X)
+        if not self.is_trained:
+            self.train(X)
+        if ids is None:
+            ids = np.arange(self.next_id, self.next_id + X.shape[0])
+        ids = np.asarray(ids, dtype=np.int64)
+        assert ids.shape[0] == X.shape[0], "need one id per vector"
+
+        assignments = self.assign(X)
+        if self.vectors is None:
+            self.vectors, self.ids, self.assignments = X, ids, assignments
+        else:
+            self.vectors = np.concatenate([self.vectors, X])
+            self.ids = np.concatenate([self.ids, ids])
+            self.assignments = np.concatenate([self.assignments, assignments])
+        self.next_id = max(self.next_id, int(ids.max()) + 1)
+
+        # Regroup on the next query
+        self.order = None
+        return ids
+
+    def group_lists(self):
+        self.order = np.argsort(self.assignments, kind='stable')
+        self.list_starts = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.assignments,
+                                        minlength=self.nlist))])
+
+    def query(self, X, k, nprobe=None):
+        """
+        Approximate top k by cosine similarity.
+
+        Returns (ids, similarities), both (len(X), k) and ordered
+        closest....furthest. Missing neighbors (fewer than k vectors in the
+        probed lists) have id -1 and similarity -inf.
+        """
+        assert len(self) > 0, "index is empty"
+        if self.order is None:
+            self.group_lists()
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.nlist)
+        X = l2_normalize(X)
+        num_queries = X.shape[0]
+
+        probes, _ = exact_top_k(X, self.centroids, nprobe,
+                                self.max_memory_bytes, normalized=True)
+
+        candidate_rows = np.full((num_queries, nprobe, k), -1, dtype=np.int64)
+        candidate_sims = np.full((num_queries, nprobe, k), -np.inf,
+                                 dtype=np.float32)
+
+        # Visit each list once with every query that probes it
+        flat_probes = probes.ravel()
+        by_list = np.argsort(flat_probes, kind='stable')
+        bounds = np.searchsorted(flat_probes[by_list],
+                                 np.arange(self.nlist + 1))
+        for list_id in np.flatnonzero(np.diff(bounds)):
+            entries = by_list[bounds[list_id]:bounds[list_id + 1]]
+            queries, slots = np.divmod(entries, nprobe)
+            rows = self.order[self.list_starts[list_id]:
+                              self.list_starts[list_id + 1]]
+            if rows.shape[0] == 0:
+                continue
+
+            top_k, sims = exact_top_k(X[queries], self.vectors[rows], k,
+                                      self.max_memory_bytes, normalized=True)
+            found = top_k.shape[1]
+            candidate_rows[queries, slots, :found] = rows[top_k]
+            candidate_sims[queries, slots, :found] = sims
+
+        # Merge the per-list top k
+        candidate_rows = candidate_rows.reshape(num_queries, -1)
+        candidate_sims = candidate_sims.reshape(num_queries, -1)
+        best = np.argsort(-candidate_sims, axis=1, kind='stable')[:, :k]
+        best_rows = np.take_along_axis(candidate_rows, best, axis=1)
+        best_sims = np.take_along_axis(candidate_sims, best, axis=1)
+
+        ids = np.where(best_rows >= 0, self.ids[best_rows], -1)
+        return ids, best_sims
+
+    def save(self, path):
+        np.savez(path,
+                 centroids=self.centroids,
+                 vectors=self.vectors,
+                 ids=self.ids,
+                 assignments=self.assignments,
+                 config=np.array([self.nlist, self.nprobe, self.n_iter,
+                                  self.max_train, self.seed,
+                                  self.max_memory_bytes, self.next_id]))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        nlist, nprobe, n_iter, max_train, seed, max_memory_bytes, next_id = \
+            data['config'].tolist()
+        index = cls(nlist, nprobe, n_iter, max_train, seed, max_memory_bytes)
+        index.centroids = data['centroids']
+        index.vectors = data['vectors']
+        index.ids = data['ids']
+        index.assignments = data['assignments']
+        index.next_id = next_id
+        return index
+
+
+class AuthorIndex:
+    """
+    Author lookup over an IVFFlatIndex of file embeddings: the k nearest
+    files vote for their author. Ties go to the smallest label, as in
+    CosKNN.
+    """
+
+    def __init__(self, k, nlist=256, nprobe=8, max_memory_bytes=1 << 30):
+        self.k = k
+        self.index = IVFFlatIndex(nlist=nlist, nprobe=nprobe,
+                                  max_memory_bytes=max_memory_bytes)
+        self.labels = np.empty(0)
+
+    def fit(self, X, y):
+        self.index = IVFFlatIndex(nlist=self.index.nlist,
+                                  nprobe=self.index.nprobe,
+                                  max_memory_bytes=self.index.max_memory_bytes)
+        # Keep the label dtype of y
+        self.labels = np.asarray(y)[:0]
+        return self.add(X, y)
+
+    def add(self, X, y):
+        """Insert more files. Ids are positions in self.labels."""
+        self.index.add(X, ids=np.arange(len(self.labels),
+                                        len(self.labels) + X.shape[0]))
+        self.labels = np.concatenate([self.labels, np.asarray(y)])
+        return self
+
+    def query(self, X, k=None, nprobe=None):
+        """Nearest files: (file ids, similarities, author labels)."""
+        ids, sims = self.index.query(X, self.k if k is None else k, nprobe)
+        return ids, sims, np.where(ids >= 0, self.labels[ids], -1)
+
+    def vote_counts(self, X, nprobe=None):
+        classes, label_index = np.unique(self.labels, return_inverse=True)
+        ids, _ = self.index.query(X, self.k, nprobe)
+        neighbor_labels = np.where(ids >= 0, label_index[ids], -1)
+        return classes, count_votes(neighbor_labels, len(classes))
+
+    def predict(self, X, nprobe=None):
+        classes, counts = self.vote_counts(X, nprobe)
+        return classes[counts.argmax(axis=1)]
+
+    def predict_proba(self, X, nprobe=None):
+        _, counts = self.vote_counts(X, nprobe)
+        return counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+    def score(self, X, y, nprobe=None):
+        return np.sum(self.predict(X, nprobe) == y) / y.shape[0]
+
+    def save(self, path):
+        self.index.save(path)
+        np.save(os.path.splitext(path)[0] + "_labels.npy", self.labels)
+
+    @classmethod
+    def load(cls, path, k):
+        author_index = cls(k)
+        author_index.index = IVFFlatIndex.load(path)
+        author_index.labels = np.load(
+            os.path.splitext(path)[0] + "_labels.npy", allow_pickle=True)
+        return author_index
+
+
+class AuthorIndexSecondaryClassifier(GenericSecondaryClassifier):
+    """
+    AuthorIndexSecondaryClassifier
+
+    Approximate nearest neighbor author search. train cross validates like
+    CosKNNSecondaryClassifier and also reports recall@k of the index
+    against the exact CosKNN neighbors and query throughput for both.
+    The model kept afterwards indexes all of the given files.
+    """
+    def __init__(self, params, combination, logger, logdir):
+        super().__init__(params, combination, logger, logdir)
+
+        self.name = "author_index"
+        self.dataset = ClosedDataset
+        model_params = params["model_params"]
+        self.n_neighbors = model_params["n_neighbors"]
+        self.nlist = model_params.get("nlist", 256)
+        self.nprobe = model_params.get("nprobe", 8)
+        self.max_memory_bytes = model_params.get("max_memory_bytes", 1 << 30)
+
+        self.model = self.new_index()
+
+    def new_index(self):
+        return AuthorIndex(self.n_neighbors, self.nlist, self.nprobe,
+                           self.max_memory_bytes)
+
+    def train(self, X, y):
+
+        cv = KFold(n_splits=self.params["k_cross_val"], shuffle=False)
+
+        results = {"accuracy": [], "exact_accuracy": [], "recall_at_k": [],
+                   "qps": [], "exact_qps": []}
+        for train_index, test_index in cv.split(X):
+            model = self.new_index().fit(X[train_index], y[train_index])
+            queries = X[test_index]
+
+            start = time.perf_counter()
+            ids, _, _ = model.query(queries)
+            results["qps"].append(len(queries) /
+                                  (time.perf_counter() - start))
+
+            start = time.perf_counter()
+            exact_ids, _ = exact_top_k(queries, X[train_index],
+                                       self.n_neighbors,
+                                       self.max_memory_bytes)
+            results["exact_qps"].append(len(queries) /
+                                        (time.perf_counter() - start))
+
+            # Fraction of the exact top k the index found
+            found = (ids[:, :, None] == exact_ids[:, None, :]).any(axis=1)
+            results["recall_at_k"].append(found.mean())
+
+            results["accuracy"].append(model.score(queries, y[test_index]))
+            classes, label_index = np.unique(y[train_index],
+                                             return_inverse=True)
+            exact_votes = count_votes(label_index[exact_ids], len(classes))
+            results["exact_accuracy"].append(np.mean(
+                classes[exact_votes.argmax(axis=1)] == y[test_index]))
+
+        results = {name: float(np.mean(values))
+                   for name, values in results.items()}
+        self.logger.info(f"author index: {results}")
+
+        self.model = self.new_index().fit(X, y)
+
+        return results
+
+    def evaluate(self, X, y=None):
+
+        if y is None:
+            return self.model.predict(X)
+        else:
+            return self.model.score(X, y)
+
+    def save(self, secondary_logdir):
+
+        super().save(secondary_logdir)
+        self.model.save(os.path.join(secondary_logdir, "author_index.npz"))
@@ -4,33 +4,127 @@ from auth_ident.datasets import ClosedDataset
 from sklearn.model_selection import cross_val_score, train_test_split, KFold
 
 import numpy as np
-from scipy import spatial
-from scipy.stats import mode
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.neighbors._base import NeighborsBase
 
 
+def l2_normalize(X):
+    """Row-normalize X as float32. Zero rows stay zero, as in
+    sklearn's cosine_similarity."""
+    X = np.asarray(X, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return X / norms
+
+
+def query_block_size(num_train, max_memory_bytes):
+    """
+    Number of query rows whose similarity block fits in max_memory_bytes.
+    Each row costs a float32 similarity and an int64 argpartition index
+    per training vector.
+    """
+    return max(1, int(max_memory_bytes // (num_train * 12)))
+
+
+def exact_top_k(X, train_x, k, max_memory_bytes=1 << 30, normalized=False):
+    """
+    Exact cosine top k of every row of X against train_x, computed in query
+    blocks so the full similarity matrix is never held in memory.
+
+    Returns (indices, similarities), both (len(X), k) and ordered
+    closest....furthest.
+    """
+    if not normalized:
+        X = l2_normalize(X)
+        train_x = l2_normalize(train_x)
+    k = min(k, train_x.shape[0])
+
+    indices = np.empty((X.shape[0], k), dtype=np.int64)
+    similarities = np.empty((X.shape[0], k), dtype=np.float32)
+    block = query_block_size(train_x.shape[0], max_memory_bytes)
+    for start in range(0, X.shape[0], block):
+        sims = X[start:start + block] @ train_x.T
+        rows = np.arange(sims.shape[0])[:, None]
+        # Unordered top k, then sort only those k
+        if k < sims.shape[1]:
+            top_k = np.argpartition(sims, -k, axis=1)[:, -k:]
+        else:
+            top_k = np.broadcast_to(np.arange(k), sims.shape).copy()
+        order = np.argsort(-sims[rows, top_k], axis=1, kind='stable')
+        top_k = top_k[rows, order]
+        indices[start:start + block] = top_k
+        similarities[start:start + block] = sims[rows, top_k]
+
+    return indices, similarities
+
+
+def count_votes(labels, num_classes):
+    """
+    Per-row class counts for an (n, k) array of label indices. Indices
+    outside [0, num_classes), e.g. -1 for a missing neighbor, are not
+    counted.
+    """
+    rows = np.arange(labels.shape[0])[:, None]
+    valid = (labels >= 0) & (labels < num_classes)
+    flat = (rows * num_classes + labels)[valid]
+    return np.bincount(flat, minlength=labels.shape[0] * num_classes).reshape(
+        labels.shape[0], num_classes)
+
+
 class CosKNN(NeighborsBase):
+    """
+    k nearest neighbors on cosine similarity with a majority vote. Queries
+    are processed in blocks sized to max_memory_bytes. Ties in the vote go
+    to the smallest label, as with scipy.stats.mode.
+    """
 
-    def __init__(self, k):
+    def __init__(self, k, max_memory_bytes=1 << 30):
         self.k = k
+        self.max_memory_bytes = max_memory_bytes
 
     def fit(self, X, y):
-        self.train_x = X
-        self.train_y = y
+        self.train_x = l2_normalize(X)
+        self.train_y = np.asarray(y)
+        self.classes_, self.train_y_index = np.unique(self.train_y,
+                                                      return_inverse=True)
+        return self
+
+    def vote_blocks(self, X):
+        """
+        Neighbor counts per class, one query block at a time. Yields
+        (start, counts) with counts of shape (block, len(classes_)) for
+        rows start... of X, so callers can reduce each block before the
+        next one is computed.
+        """
+        X = l2_normalize(X)
+        num_classes = len(self.classes_)
+        # Bound the block on both the similarity block and the counts
+        block = query_block_size(self.train_x.shape[0] + num_classes,
+                                 self.max_memory_bytes)
+        for start in range(0, X.shape[0], block):
+            top_k, _ = exact_top_k(X[start:start + block], self.train_x,
+                                   self.k, self.max_memory_bytes,
+                                   normalized=True)
+            yield start, count_votes(self.train_y_index[top_k], num_classes)
+
+    def predict(self, X):
+        prediction = np.empty(X.shape[0], dtype=np.int64)
+        for start, counts in self.vote_blocks(X):
+            # argmax picks the first, i.e. smallest, label on ties
+            prediction[start:start + counts.shape[0]] = counts.argmax(axis=1)
+        return self.classes_[prediction]
+
+    def predict_proba(self, X):
+        proba = np.empty((X.shape[0], len(self.classes_)), dtype=np.float64)
+        for start, counts in self.vote_blocks(X):
+            proba[start:start + counts.shape[0]] = \
+                counts / counts.sum(axis=1, keepdims=True)
+        return proba
 
     def score(self, X, y):
 
-        num_samples = X.shape[0]
-        cos_dist = cosine_similarity(X, self.train_x)
-        # Pull top k choices and reverse list to be closest....furthest
-        top_k = cos_dist.argsort(axis=1)[:, -self.k:][:, ::-1]
-
-        # Get labels of choices
-        top_k_labels = self.train_y[top_k].reshape(num_samples, -1)
-        prediction, _ = mode(top_k_labels, axis=1)
+        prediction = self.predict(X)
 
-        score = np.sum(prediction.flatten() == y) / y.shape[0] 
+        score = np.sum(prediction == y) / y.shape[0]
         return score
 
 
@@ -44,8 +138,10 @@ class CosKNNSecondaryClassifier(GenericSecondaryClassifier):
         self.name = "k_nearest_neighbor"
         self.dataset = ClosedDataset
         self.n_neighbors = params["model_params"]["n_neighbors"]
+        self.max_memory_bytes = params["model_params"].get(
+            "max_memory_bytes", 1 << 30)
 
-        self.model = CosKNN(self.n_neighbors)
+        self.model = CosKNN(self.n_neighbors, self.max_memory_bytes)
 
     def train(self, X, y):
 
@@ -0,0 +1,617 @@
+"""
+Packed on-disk format for encoded (and raw text) corpora.
+
+Every file's tokens live in one flat token buffer and file ``i`` occupies
+``tokens[offsets[i]:offsets[i + 1]]``, so pulling a file out of the buffer
+is a slice instead of a trip through a pandas object column.
+
+A packed corpus is a directory ending in ``.packed`` containing:
+
+    tokens.bin    - the flat token buffer (raw, dtype given in corpus.json)
+    offsets.npy   - int64 offsets, one more entry than there are files
+    metadata.h5   - every column except file_content (username, filepath,
+                    problem, ...), one row per file
+    corpus.json   - dtype, kind and sizes, plus an "info" dict describing
+                    the encoding (e.g. the token id layout, see
+                    corpus_info)
+
+Raw text corpora (kind 'text') store unicode code points, so crops are
+still measured in characters.
+
+load_corpus memory-maps the token buffer read-only, so every training or
+evaluation process on a box shares the same page-cache pages instead of
+holding a private copy of the corpus. Legacy .h5 files are converted to a
+packed corpus next to the .h5 the first time they are loaded.
+"""
+import contextlib
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import shutil
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+
+PACKED_EXTENSION = ".packed"
+
+
+def pack_sequences(sequences, dtype=np.int32):
+    """
+    Pack an iterable of token sequences (lists, arrays or tensors) into a
+    single flat buffer.
+
+    Returns a `(tokens, offsets)` tuple where `offsets` has one more entry
+    than there are sequences.
+    """
+    arrays = [np.asarray(sequence, dtype=dtype).ravel()
+              for sequence in sequences]
+
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([array.shape[0] for array in arrays], out=offsets[1:])
+
+    if arrays:
+        tokens = np.concatenate(arrays)
+    else:
+        tokens = np.zeros(0, dtype=dtype)
+
+    return tokens, offsets
+
+
+def crop_batch(tokens, offsets, file_indices, crop_length, eos_id):
+    """
+    Crop every file in `file_indices` out of the packed buffer at once.
+
+    Mirrors the per-file `crop` + `add_end_tokens` pair used by the
+    generators: a file of length `n` becomes
+    `[eos, t_0, ..., t_(m - 3), eos]` with `m = min(n, crop_length)`,
+    zero padded out to `crop_length`.
+
+    Returns an int32 array of shape `(len(file_indices), crop_length)`.
+    """
+    file_indices = np.asarray(file_indices, dtype=np.int64)
+    starts = offsets[file_indices]
+    lengths = np.minimum(offsets[file_indices + 1] - starts, crop_length)
+
+    columns = np.arange(crop_length)
+    # Column 0 holds the leading end token, so the body is shifted by one.
+    body = ((columns[np.newaxis, :] >= 1) &
+            (columns[np.newaxis, :] < lengths[:, np.newaxis] - 1))
+    positions = starts[:, np.newaxis] + columns[np.newaxis, :] - 1
+
+    cropped = np.zeros((file_indices.shape[0], crop_length), dtype=np.int32)
+    cropped[body] = tokens[positions[body]]
+
+    rows = np.arange(file_indices.shape[0])
+    cropped[rows, 0] = eos_id
+    cropped[rows, np.maximum(lengths - 1, 0)] = eos_id
+
+    return cropped
+
+
+def smallest_dtype(max_token):
+    """Smallest signed integer dtype that can hold max_token."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if max_token <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def text_to_code_points(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<i4')
+
+
+def code_points_to_text(code_points):
+    return np.asarray(code_points, dtype='<i4').tobytes().decode('utf-32-le')
+
+
+def is_packed(path):
+    return os.path.normpath(path).endswith(PACKED_EXTENSION)
+
+
+def packed_path(path):
+    """Packed corpus path that sits next to the given .h5 file."""
+    return os.path.splitext(path)[0] + PACKED_EXTENSION
+
+
+class PackedCorpus:
+    """
+    A corpus of variable length token sequences stored as one flat buffer
+    plus offsets, with the remaining dataframe columns kept as metadata.
+    """
+    def __init__(self, tokens, offsets, metadata, kind='tokens', path=None,
+                 info=None):
+        assert offsets.shape[0] == len(metadata) + 1, \
+            "offsets must have one more entry than there are files"
+
+        self.tokens = tokens
+        self.offsets = offsets
+        self.metadata = metadata
+        self.kind = kind
+        self.path = path
+        self.info = {} if info is None else dict(info)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def fingerprint(self):
+        """
+        Short hash identifying this corpus: its path, number of files and
+        file boundaries. Changes whenever the corpus is rebuilt with
+        different files.
+        """
+        digest = hashlib.sha1()
+        path = os.path.abspath(self.path) if self.path is not None else ""
+        digest.update(f"{path}:{len(self)}:".encode())
+        digest.update(np.ascontiguousarray(self.offsets).tobytes())
+        return digest.hexdigest()[:12]
+
+    def file(self, file_indx):
+        """Zero-copy view of the tokens of one file."""
+        return self.tokens[self.offsets[file_indx]:self.offsets[file_indx + 1]]
+
+    def text(self, file_indx):
+        """Decode one file of a 'text' corpus back into a string."""
+        assert self.kind == 'text', "text() needs a 'text' corpus"
+        return code_points_to_text(self.file(file_indx))
+
+    def crop_batch(self, file_indices, crop_length, eos_id):
+        return crop_batch(self.tokens, self.offsets, file_indices,
+                          crop_length, eos_id)
+
+    def files_by_author(self):
+        """Mapping from author names to file indices."""
+        return self.metadata.groupby(['username']).indices
+
+    def memory_usage(self):
+        """
+        Memory footprint of the corpus in bytes.
+
+        "mapped" is the size of the token buffer and offsets, "resident" how
+        much of it is currently paged in for this process, "shared" how much
+        of that is shared with other processes, and "private" what this
+        process holds on its own (metadata plus any in-memory arrays).
+        """
+        arrays = (self.tokens, self.offsets)
+        mapped = sum(array.nbytes for array in arrays)
+        private = int(self.metadata.memory_usage(deep=True).sum())
+
+        mapped_files = [array.filename for array in arrays
+                        if getattr(array, "filename", None) is not None]
+        usage = mapped_memory(mapped_files) if mapped_files else None
+        if usage is None:
+            usage = {"resident": 0, "shared": 0}
+
+        for array in arrays:
+            if getattr(array, "filename", None) is None:
+                usage["resident"] += array.nbytes
+                private += array.nbytes
+
+        return {"mapped": mapped, **usage, "private": private}
+
+    @classmethod
+    def from_dataframe(cls, frame, dtype=None, info=None):
+        """
+        Pack the file_content column of a dataframe. String columns are
+        packed as a 'text' corpus of code points, anything else (lists,
+        arrays, tensors of token ids) as a 'tokens' corpus.
+        """
+        contents = frame['file_content']
+        metadata = frame.drop(columns=['file_content']).reset_index(drop=True)
+
+        if len(contents) > 0 and isinstance(contents.iloc[0], str):
+            kind = 'text'
+            tokens, offsets = pack_sequences(
+                (text_to_code_points(text) for text in contents),
+                dtype=np.int32)
+        else:
+            kind = 'tokens'
+            tokens, offsets = pack_sequences(contents, dtype=np.int64)
+            if dtype is None:
+                dtype = smallest_dtype(tokens.max() if tokens.size else 0)
+            tokens = tokens.astype(dtype)
+
+        return cls(tokens, offsets, metadata, kind=kind, info=info)
+
+    def save(self, path):
+        with PackedCorpusWriter(path, self.tokens.dtype, self.kind,
+                                self.info) as writer:
+            writer.append_packed(self.tokens, self.offsets, self.metadata)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load a packed corpus. With the default mmap_mode the token buffer
+        and offsets are memory-mapped read-only rather than read into
+        memory.
+        """
+        with open(join(path, "corpus.json")) as f:
+            info = json.load(f)
+
+        dtype = np.dtype(info['dtype'])
+        tokens_file = join(path, "tokens.bin")
+        if mmap_mode is None or info['num_tokens'] == 0:
+            tokens = np.fromfile(tokens_file, dtype=dtype)
+        else:
+            tokens = np.memmap(tokens_file, dtype=dtype, mode=mmap_mode,
+                               shape=(info['num_tokens'],))
+
+        offsets = np.load(join(path, "offsets.npy"), mmap_mode=mmap_mode)
+        metadata = pd.read_hdf(join(path, "metadata.h5"))
+
+        return cls(tokens, offsets, metadata, kind=info['kind'], path=path,
+                   info=info.get('info'))
+
+
+class PackedCorpusWriter:
+    """
+    Incrementally writes a packed corpus. Tokens are appended straight to
+    disk; the corpus is only moved into place by close(), so readers never
+    see a half written directory. info is saved with the corpus, see
+    corpus_info.
+
+    Usage:
+
+        with PackedCorpusWriter("data/foo_train.packed", np.int16) as writer:
+            writer.append(list_of_token_arrays, metadata_frame)
+    """
+    def __init__(self, path, dtype, kind='tokens', info=None):
+        self.path = os.path.normpath(path)
+        self.dtype = np.dtype(dtype)
+        self.kind = kind
+        self.info = {} if info is None else dict(info)
+
+        self.tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        self.tokens_file = open(join(self.tmp_path, "tokens.bin"), 'wb')
+        self.lengths = []
+        self.metadata = []
+        self.num_tokens = 0
+
+    def append(self, sequences, metadata):
+        """
+        Append one chunk of files. `sequences` holds the token arrays (or
+        strings, for a 'text' corpus) and `metadata` the matching rows.
+        """
+        if self.kind == 'text':
+            sequences = [text_to_code_points(text) for text in sequences]
+        tokens, offsets = pack_sequences(sequences, dtype=self.dtype)
+        self.append_packed(tokens, offsets, metadata)
+
+    def append_packed(self, tokens, offsets, metadata):
+        assert offsets.shape[0] == len(metadata) + 1
+
+        np.asarray(tokens, dtype=self.dtype).tofile(self.tokens_file)
+        self.lengths.append(np.diff(offsets))
+        self.metadata.append(metadata.reset_index(drop=True))
+        self.num_tokens += int(offsets[-1] - offsets[0])
+
+    def close(self):
+        self.tokens_file.close()
+
+        lengths = (np.concatenate(self.lengths) if self.lengths
+                   else np.zeros(0, dtype=np.int64))
+        offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(join(self.tmp_path, "offsets.npy"), offsets)
+
+        if self.metadata:
+            metadata = pd.concat(self.metadata, ignore_index=True)
+        else:
+            metadata = pd.DataFrame()
+        metadata.to_hdf(join(self.tmp_path, "metadata.h5"),
+                        key='metadata', mode='w')
+
+        with open(join(self.tmp_path, "corpus.json"), 'w') as f:
+            json.dump({"dtype": self.dtype.name,
+                       "kind": self.kind,
+                       "num_files": int(lengths.shape[0]),
+                       "num_tokens": self.num_tokens,
+                       "info": self.info}, f, indent=4)
+
+        if os.path.exists(self.path):
+            # Move the old corpus aside before removing it, so the path
+            # always holds a complete corpus. Processes that already mapped
+            # the old files keep reading them until they unmap.
+            old_path = f"{self.path}.old-{os.getpid()}"
+            os.rename(self.path, old_path)
+            os.rename(self.tmp_path, self.path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.tokens_file.close()
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+# Corpora already loaded by this process, keyed by (path, mmap_mode).
+_loaded_corpora = {}
+
+
+def load_corpus(path, mmap_mode='r', cache=True):
+    """
+    Load either a packed corpus or a legacy .h5 dataframe as a PackedCorpus.
+
+    With cache=True a .h5 file is converted once into a packed corpus next
+    to it (rebuilt whenever the .h5 is newer), and that copy is
+    memory-mapped. Read-only corpora are also reused within a process.
+
+    Several processes can load the same .h5 at once: the conversion is
+    serialized with a lock file next to the cache, so only the first one
+    converts and the rest map its result.
+    """
+    if not is_packed(path):
+        if not cache:
+            return PackedCorpus.from_dataframe(read_frame(path),
+                                               info=corpus_info(path))
+
+        cache_path = packed_path(path)
+        with file_lock(cache_path + ".lock"):
+            if (not os.path.isdir(cache_path) or
+                    os.path.getmtime(cache_path) < os.path.getmtime(path)):
+                print(f"Packing {path} into {cache_path}", flush=True)
+                pack_frames(path, cache_path)
+        path = cache_path
+
+    key = (os.path.abspath(path), mmap_mode)
+    if mmap_mode != 'r' or key not in _loaded_corpora:
+        corpus = PackedCorpus.load(path, mmap_mode=mmap_mode)
+        if mmap_mode != 'r':
+            return corpus
+        _loaded_corpora[key] = corpus
+
+    return _loaded_corpora[key]
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path (created if missing) across processes."""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def pack_frames(path, cache_path):
+    """
+    Convert a .h5 file into a packed corpus at cache_path, keeping its
+    corpus_info. Chunked files are streamed into the packed corpus one chunk
+    at a time, so they are never held in memory whole (chunked token files
+    are read twice, first for their largest id).
+    """
+    info = corpus_info(path)
+    frames = iter_frames(path)
+    first = next(frames)
+    contents = first['file_content']
+    if len(contents) > 0 and isinstance(contents.iloc[0], str):
+        kind, dtype = 'text', np.int32
+    elif is_chunked(path):
+        kind = 'tokens'
+        max_token = 0
+        for frame in iter_frames(path):
+            for tokens in frame['file_content']:
+                if len(tokens):
+                    max_token = max(max_token, int(np.max(tokens)))
+        dtype = smallest_dtype(max_token)
+    else:
+        PackedCorpus.from_dataframe(pd.concat([first, *frames]),
+                                    info=info).save(cache_path)
+        return
+
+    with PackedCorpusWriter(cache_path, dtype, kind, info) as writer:
+        for frame in itertools.chain([first], frames):
+            writer.append(frame['file_content'].tolist(),
+                          frame.drop(columns=['file_content']))
+
+
+def mapped_memory(paths):
+    """
+    Resident and shared bytes of this process's mappings of the given files,
+    read from /proc/self/smaps. Returns None where smaps isn't available.
+    """
+    paths = {os.path.realpath(path) for path in paths}
+    usage = {"resident": 0, "shared": 0}
+
+    try:
+        smaps = open("/proc/self/smaps")
+    except OSError:
+        return None
+
+    with smaps:
+        in_mapping = False
+        for line in smaps:
+            fields = line.split()
+            if not fields[0].endswith(':'):
+                # Mapping header: address perms offset dev inode [pathname]
+                in_mapping = len(fields) >= 6 and fields[5] in paths
+            elif in_mapping and fields[0] == "Rss:":
+                usage["resident"] += int(fields[1]) * 1024
+            elif in_mapping and fields[0] in ("Shared_Clean:",
+                                              "Shared_Dirty:"):
+                usage["shared"] += int(fields[1]) * 1024
+
+    return usage
+
+
+def write_frame(frame, path, info=None):
+    """
+    Save an encoded dataframe either as a packed corpus (path ending in
+    .packed) or as a .h5 file, with info saved alongside (see corpus_info).
+    """
+    if is_packed(path):
+        PackedCorpus.from_dataframe(frame, info=info).save(path)
+    else:
+        frame.to_hdf(path, key='data', mode='w')
+        if info:
+            with pd.HDFStore(path, mode='a') as store:
+                store.get_storer('data').attrs.corpus_info = dict(info)
+
+
+def corpus_info(path):
+    """
+    The info dict saved with a corpus by write_frame, FrameWriter or
+    PackedCorpusWriter, empty for corpora written without one. For a .h5
+    file it is kept in the attributes of its (first) frame.
+    """
+    if is_packed(path):
+        with open(join(path, "corpus.json")) as f:
+            return json.load(f).get('info', {})
+
+    with pd.HDFStore(path, mode='r') as store:
+        keys = chunk_keys(store) or [key.lstrip('/') for key in store.keys()]
+        if not keys:
+            return {}
+        return dict(getattr(store.get_storer(keys[0]).attrs, 'corpus_info',
+                            {}))
+
+
+class FrameWriter:
+    """
+    Streams rows of a dataframe to disk chunk_size rows at a time, either
+    to a chunked .h5 file or, for a path ending in .packed, to a
+    PackedCorpus of the given kind and dtype (file_content packed,
+    everything else in the metadata). Whole chunks can be written with
+    write_chunk. info is saved with the output, see corpus_info.
+
+    A chunked .h5 file holds every chunk as its own fixed-format frame
+    under the keys chunk_0, chunk_1, ... and is never concatenated into one
+    frame on disk. Read it back with iter_frames (one chunk at a time),
+    read_frame or load_corpus. Fixed format keeps strings as python
+    objects, so unlike table format no row is padded to the widest file.
+
+    Usage:
+
+        with FrameWriter("data/foo_train.h5", columns) as writer:
+            for row in rows:
+                writer.append(row)
+    """
+    def __init__(self, path, columns, chunk_size=10000, info=None,
+                 kind='text', dtype=np.int32):
+        self.path = path
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.info = {} if info is None else dict(info)
+
+        self.rows = []
+        self.num_rows = 0
+        self.num_chunks = 0
+        if is_packed(path):
+            self.store = None
+            self.packed_writer = PackedCorpusWriter(path, dtype, kind=kind,
+                                                    info=self.info)
+        else:
+            self.tmp_path = f"{path}.tmp-{os.getpid()}"
+            self.store = pd.HDFStore(self.tmp_path, mode='w')
+            self.packed_writer = None
+
+    def append(self, row):
+        """Add one row, given as a tuple in column order."""
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        self.write_chunk(pd.DataFrame(self.rows, columns=self.columns))
+        self.rows = []
+
+    def write_chunk(self, frame):
+        """Write a dataframe with a default index as the next chunk."""
+        frame.index += self.num_rows
+        self.num_rows += len(frame)
+
+        if self.packed_writer is not None:
+            self.packed_writer.append(frame['file_content'].tolist(),
+                                      frame.drop(columns='file_content'))
+        else:
+            self.store.put(f"{CHUNK_KEY}{self.num_chunks}", frame,
+                           format='fixed')
+            self.num_chunks += 1
+
+    def close(self):
+        self.flush()
+        if self.packed_writer is not None:
+            self.packed_writer.close()
+        else:
+            if not self.num_chunks:
+                # Keep the columns of an empty split
+                self.write_chunk(pd.DataFrame(columns=self.columns))
+            if self.info:
+                self.store.get_storer(f"{CHUNK_KEY}0").attrs.corpus_info = \
+                    self.info
+            self.store.close()
+            os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.packed_writer is not None:
+            self.packed_writer.__exit__(exc_type, exc_value, traceback)
+        else:
+            self.store.close()
+            os.remove(self.tmp_path)
+
+
+CHUNK_KEY = "chunk_"
+
+
+def iter_frames(path):
+    """
+    Yield the dataframe stored in a .h5 file one chunk at a time. Chunked
+    files written by FrameWriter yield each of their chunks in order, any
+    other .h5 file its single frame.
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        chunks = chunk_keys(store)
+        for key in chunks or []:
+            yield store[key]
+
+    if chunks is None:
+        yield pd.read_hdf(path)
+
+
+def chunk_keys(store):
+    """
+    Keys of the chunks of an open chunked .h5 store, in order, or None if
+    the store doesn't hold a chunked frame.
+    """
+    keys = [key.lstrip('/') for key in store.keys()]
+    if not keys or not all(key.startswith(CHUNK_KEY) for key in keys):
+        return None
+    return sorted(keys, key=lambda key: int(key[len(CHUNK_KEY):]))
+
+
+def is_chunked(path):
+    with pd.HDFStore(path, mode='r') as store:
+        return chunk_keys(store) is not None
+
+
+def read_frame(path):
+    """Read a whole .h5 file, chunked or not, into one dataframe."""
+    frames = list(iter_frames(path))
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames)
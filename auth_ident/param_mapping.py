@@ -27,26 +27,38 @@ def map_dataset(dataset_type, params, data_file):
 
     elif dataset_type == "split":
         if params['loss'] == 'margin':
+            kwargs = {}
+            for name in ("encoding_type", "generator", "flip_labels",
+                         "language"):
+                if name in params:
+                    kwargs[name] = params[name]
+
             dataset = datasets.SplitDataset(
                 max_code_length=params["max_code_length"],
                 batch_size=params['batch_size'],
-                binary_encoding=params['binary_encoding'],
-                data_file=data_file)
+                data_file=data_file,
+                **kwargs)
 
         elif params['loss'] == "simclr":
+            kwargs = {}
             if "spm_model_file" in params:
-                dataset = datasets.SimCLRDataset(
-                    max_code_length=params["max_code_length"],
-                    batch_size=params['batch_size'],
-                    data_file=data_file,
-                    encoding_type=params['encoding_type'],
-                    spm_model_file=params['spm_model_file'])
-            else:
-                dataset = datasets.SimCLRDataset(
-                    max_code_length=params["max_code_length"],
-                    batch_size=params['batch_size'],
-                    data_file=data_file,
-                    encoding_type=params['encoding_type'])
+                kwargs['spm_model_file'] = params['spm_model_file']
+            if "generator" in params:
+                kwargs['generator'] = params['generator']
+            for name in ("spm_alpha", "spm_nbest_size", "num_workers",
+                         "num_shards", "queue_depth", "plan_dir",
+                         "plan_seed", "plan_epoch", "plan_step",
+                         "refresh_interval", "hard_fraction",
+                         "probe_authors"):
+                if name in params:
+                    kwargs[name] = params[name]
+
+            dataset = datasets.SimCLRDataset(
+                max_code_length=params["max_code_length"],
+                batch_size=params['batch_size'],
+                data_file=data_file,
+                encoding_type=params['encoding_type'],
+                **kwargs)
 
     elif dataset_type == 'by_line':
         if params['loss'] == 'margin':
@@ -0,0 +1,104 @@
+"""
+Author level val/test/train splitting shared by save_hdf, save_hdf_codenet
+and PairAuthors.
+
+Authors are turned into categorical codes once (pd.factorize), the split
+is drawn over those codes, and rows are assigned with one array lookup
+instead of a membership test per row.
+"""
+import numpy as np
+import pandas as pd
+
+
+VAL, TEST, TRAIN, UNUSED = 0, 1, 2, -1
+SPLIT_SUFFIXES = np.array(["_val", "_test", "_train"])
+# Indexed by split, so UNUSED (-1) picks the last name
+SPLIT_NAMES = np.array(["val", "test", "train", "unused"])
+
+
+def random_state(seed=None):
+    """
+    The random state a seed stands for: the global numpy random state for
+    None, the seed itself if it already is a RandomState, otherwise a new
+    RandomState(seed).
+    """
+    if seed is None:
+        return np.random
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def split_authors(num_authors, val_test_split, seed=None, layout='choice'):
+    """
+    Randomly assign num_authors authors to the val, test and train splits.
+
+    With layout='choice' the draw is the one save_hdf has always made
+    (shuffle, pick the val authors, then the test authors from the rest,
+    train is what remains). With layout='permutation' it is PairAuthors'
+    (one permutation sliced into train, val and test, the few authors left
+    over by rounding are UNUSED). Both are done on author codes instead of
+    names. seed is anything random_state accepts.
+
+    returns: int8 array, the split (VAL, TEST, TRAIN or UNUSED) of each
+    author code.
+    """
+    rng = random_state(seed)
+
+    if layout == 'permutation':
+        authors = rng.permutation(num_authors)
+        num_train = int((1 - 2 * val_test_split) * num_authors)
+        num_val_test = int(val_test_split * num_authors)
+
+        splits = np.full(num_authors, UNUSED, dtype=np.int8)
+        splits[authors[:num_train]] = TRAIN
+        splits[authors[num_train:num_train + num_val_test]] = VAL
+        splits[authors[num_train + num_val_test:
+                       num_train + 2 * num_val_test]] = TEST
+        return splits
+
+    assert layout == 'choice', f"Unknown split layout {layout}"
+    authors = np.arange(num_authors)
+    rng.shuffle(authors)
+
+    num_val = int(val_test_split * num_authors)
+    num_test = int(val_test_split * num_authors)
+
+    # Determine which authors will be in which set...
+    val_authors = rng.choice(authors, num_val, replace=False)
+    authors = np.setdiff1d(authors, val_authors, assume_unique=True)
+    test_authors = rng.choice(authors, num_test, replace=False)
+
+    # All remaining are in the train set.
+    splits = np.full(num_authors, TRAIN, dtype=np.int8)
+    splits[val_authors] = VAL
+    splits[test_authors] = TEST
+    return splits
+
+
+def assign_splits(usernames, val_test_split, seed=None):
+    """
+    Split the rows of a file listing by author.
+
+    :param usernames: The author of every file (any array like).
+    returns: (row splits, author mapping). Row splits is an int8 array with
+    the split of every row and the mapping is a DataFrame with one
+    "username", "split" row per author, in order of first appearance.
+    """
+    codes, authors = pd.factorize(np.asarray(usernames))
+    author_splits = split_authors(len(authors), val_test_split, seed)
+    return author_splits[codes], author_mapping(authors, author_splits)
+
+
+def author_mapping(authors, author_splits):
+    """
+    DataFrame with one "username", "split" row per author, given the author
+    names and the split of each one from split_authors.
+    """
+    return pd.DataFrame({"username": authors,
+                         "split": SPLIT_NAMES[author_splits]})
+
+
+def save_split(mapping, path):
+    """Save an author to split mapping from assign_splits as csv."""
+    mapping.to_csv(path, index=False)
@@ -2,85 +2,201 @@ from os.path import join
 import re
 import os
 import argparse
-import pandas as pd
+import collections
+import contextlib
+import numpy as np
 import sentencepiece as sp
 import itertools
+import multiprocessing
 from tqdm.auto import tqdm
-tqdm.pandas()
+from auth_ident.packed_corpus import iter_frames, smallest_dtype, \
+    FrameWriter, PackedCorpusWriter
 
 
-def encode_data(model_file, data_file, alpha, length, by_line):
+NULL_CHAR_REGEX = re.compile('\0')
+TAB_REGEX = re.compile(r'\t')
+NEWLINE_REGEX = re.compile(r"\n")
 
-    spm = sp.SentencePieceProcessor(model_file)
+SPLITS = ["train", "val", "test"]
 
-    def encode(program):
 
-        null_char_counter = 0
-        still_null_char_counter = 0
+def normalize(program):
+    """Strip null chars and mark tabs. Line ends are left alone."""
+    program = NULL_CHAR_REGEX.sub("", program)
+    return TAB_REGEX.sub("[TAB]", program)
 
-        if '\0' in program:
-            null_char_counter += 1
-            print(f'Null char {null_char_counter}')
 
-        null_char_regex = re.compile('\0')
-        null_char_repl = null_char_regex.sub("", program)
-        if '\0' in null_char_repl:
-            still_null_char_counter += 1
-            print(f'Still null char {null_char_counter}')
+def preprocess(program, by_line):
+    """
+    Strip null chars and mark tabs and line ends the way the spm models were
+    trained. Returns one string, or a list of lines if by_line.
+    """
+    program = normalize(program)
 
-        tab_regex = re.compile(r'\t')
-        tab_repl = tab_regex.sub("[TAB]", null_char_repl)
+    if not by_line:
+        return NEWLINE_REGEX.sub(r"[EOL]", program)
+    return [split + '[EOL]\n' for split in program.split("\n")]
 
-        if not by_line:
-            _newline_regex = re.compile(r"\n")
-            eol_processed = _newline_regex.sub(r"[EOL]", tab_repl)
-        else:
-            eol_processed = [split + '[EOL]\n' for split in tab_repl.split("\n")]
 
-        encoded = spm.encode(eol_processed,
-                             alpha=alpha,
-                             nbest_size=length,
-                             out_type=int,
-                             enable_sampling=True)
+# State of each encoding worker process, set by _init_worker
+_spm = None
+_by_line = None
 
-        if by_line:
-            encoded = list(itertools.chain.from_iterable(encoded))
 
-        return encoded
+def _init_worker(model_file, by_line):
+    global _spm, _by_line
+    _spm = sp.SentencePieceProcessor(model_file)
+    _by_line = by_line
+
+
+def encode_chunk(task):
+    """
+    Preprocess a chunk of programs once and encode it for every sampling
+    setting, with one batched spm call per setting.
+
+    :param task: (settings, programs)
+    returns: (number of programs with null chars, one list of encoded
+    programs per setting)
+    """
+    settings, programs = task
+    num_null_char = sum('\0' in program for program in programs)
+    processed = [preprocess(program, _by_line) for program in programs]
+
+    if _by_line:
+        lines = list(itertools.chain.from_iterable(processed))
+        bounds = list(itertools.accumulate(map(len, processed), initial=0))
+    else:
+        lines = processed
+
+    encoded_settings = []
+    for alpha, length in settings:
+        encoded = _spm.encode(lines,
+                              alpha=alpha,
+                              nbest_size=length,
+                              out_type=int,
+                              enable_sampling=True)
+        if _by_line:
+            encoded = [list(itertools.chain.from_iterable(encoded[a:b]))
+                       for a, b in zip(bounds[:-1], bounds[1:])]
+        encoded_settings.append(encoded)
+    return num_null_char, encoded_settings
+
+
+def split_chunks(data_file, split, chunk_size):
+    """
+    Yield (split, chunk) for every chunk_size rows of the raw split, read
+    one stored chunk at a time. An empty split still yields one empty chunk.
+    """
+    for frame in iter_frames(f"{data_file}_{split}.h5"):
+        frame = frame.reset_index(drop=True)
+        for i in range(0, max(len(frame), 1), chunk_size):
+            yield split, frame.iloc[i:i + chunk_size]
+
+
+def roundrobin(*iterables):
+    """Take one item from each iterable in turn until all are exhausted."""
+    iterators = [iter(iterable) for iterable in iterables]
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+
+def encode_data(model_file, data_file, alpha=None, length=-1, by_line=False,
+                packed=False, settings=None, workers=None, chunk_size=1000):
+    """
+    Encode the train, val and test splits of data_file with an spm model.
+
+    :param settings: List of (alpha, length) sampling settings. Defaults to
+    [(alpha, length)].
+    :param workers: Number of encoding processes (default: one per cpu).
+
+    The raw text is read once, chunk_size programs at a time, with the
+    chunks of the three splits interleaved so they are encoded and written
+    together. Each worker preprocesses a chunk once and encodes it for
+    every setting, and the results are appended to one writer per split and
+    setting as they arrive. At most two chunks per worker are in flight, so
+    memory stays bounded by the chunk size rather than the split size.
+    """
+    if settings is None:
+        settings = [(alpha, length)]
+    if workers is None:
+        workers = os.cpu_count()
 
     split_path = model_file.split('/')
     loaded_dir = '/'.join(split_path[:-2])
     file_name = split_path[-1].split('.')[0]
+    extension = ".packed" if packed else ".h5"
 
     os.makedirs(join(loaded_dir, 'encoded_data'), exist_ok=True)
 
-    train_data = pd.read_hdf(data_file + "_train.h5")
+    dtype = smallest_dtype(
+        sp.SentencePieceProcessor(model_file).vocab_size() - 1)
+    writers = {}
+    num_null_char = dict.fromkeys(SPLITS, 0)
 
-    train_data['file_content'] = train_data['file_content'].progress_apply(
-        encode, convert_dtype=False)
+    def write(split, chunk, result):
+        chunk_null_char, encoded_settings = result.get()
+        num_null_char[split] += chunk_null_char
 
-    train_output_file = join(loaded_dir, "encoded_data",
-                             f"{file_name}_a{alpha}_l{length}_train.h5")
-    print(f"Output train file: {train_output_file}")
-    train_data.to_hdf(train_output_file, key='data', mode='w')
+        if split not in writers:
+            writers[split] = []
+            for alpha, length in settings:
+                output_file = join(
+                    loaded_dir, "encoded_data",
+                    f"{file_name}_a{alpha}_l{length}_{split}{extension}")
+                print(f"Output {split} file: {output_file}")
+                writers[split].append(stack.enter_context(
+                    FrameWriter(output_file, chunk.columns, kind='tokens',
+                                dtype=dtype)))
 
-    val_data = pd.read_hdf(data_file + "_val.h5")
-    val_data['file_content'] = val_data['file_content'].progress_apply(
-        encode, convert_dtype=False)
+        chunk = chunk.reset_index(drop=True)
+        for writer, encoded in zip(writers[split], encoded_settings):
+            writer.write_chunk(chunk.assign(file_content=encoded))
 
-    val_output_file = join(loaded_dir, "encoded_data",
-                           f"{file_name}_a{alpha}_l{length}_val.h5")
-    print(f"Output val file: {val_output_file}")
-    val_data.to_hdf(val_output_file, key='data', mode='w')
+    tasks = roundrobin(*(split_chunks(data_file, split, chunk_size)
+                         for split in SPLITS))
+    pending = collections.deque()
+    with contextlib.ExitStack() as stack, \
+            multiprocessing.Pool(workers, _init_worker,
+                                 (model_file, by_line)) as pool, \
+            tqdm(desc=f"Encoding {len(settings)} settings",
+                 unit="chunk") as progress:
+        for split, chunk in tasks:
+            programs = chunk['file_content'].tolist()
+            pending.append((split, chunk.drop(columns=['file_content']),
+                            pool.apply_async(encode_chunk,
+                                             ((settings, programs),))))
+            while len(pending) > 2 * workers:
+                write(*pending.popleft())
+                progress.update()
+        while pending:
+            write(*pending.popleft())
+            progress.update()
 
-    test_data = pd.read_hdf(data_file + "_test.h5")
-    test_data['file_content'] = test_data['file_content'].progress_apply(
-        encode, convert_dtype=False)
+    for split, count in num_null_char.items():
+        if count:
+            print(f'Null char in {count} {split} files')
 
-    test_output_file = join(loaded_dir, "encoded_data",
-                            f"{file_name}_a{alpha}_l{length}_test.h5")
-    print(f"Output test file: {test_output_file}")
-    test_data.to_hdf(test_output_file, key='data', mode='w')
+
+def write_normalized(data_file, chunk_size=10000):
+    """
+    Write the normalized text (see normalize) of each split of data_file to
+    a packed text corpus, <data_file>_normalized_<split>.packed. These are
+    what SimCLRDataset's 'spm_sample' generator encodes on the fly, for
+    every spm model and sampling setting.
+    """
+    for split in SPLITS:
+        output_file = f"{data_file}_normalized_{split}.packed"
+        print(f"Output {split} file: {output_file}")
+
+        with PackedCorpusWriter(output_file, np.int32, kind='text') as writer:
+            for _, chunk in split_chunks(data_file, split, chunk_size):
+                writer.append([normalize(program) for program
+                               in chunk['file_content']],
+                              chunk.drop(columns=['file_content']))
 
 
 def main():
@@ -91,37 +207,71 @@ def main():
     parser.add_argument('-data_start', help='Start of data file to use (can give \
         entire path if you only want to use one data file)')
     parser.add_argument('-alpha',
-                        help='The alpha to use for encoding',
+                        help='The alpha to use for encoding. Several can be '
+                        'given, each is combined with every --length',
+                        nargs='+',
                         type=float)
     parser.add_argument('--length',
-                        default=-1,
-                        help='The length to use for encoding',
+                        default=[-1],
+                        help='The length to use for encoding. Several can '
+                        'be given',
+                        nargs='+',
+                        type=int)
+    parser.add_argument('--workers',
+                        default=None,
+                        help='Number of encoding processes (default: one '
+                        'per cpu)',
+                        type=int)
+    parser.add_argument('--chunk_size',
+                        default=1000,
+                        help='Programs per batched spm call',
                         type=int)
+    parser.add_argument('--packed',
+                        action='store_true',
+                        help='Write packed corpora instead of .h5 files')
+    parser.add_argument('--normalized',
+                        action='store_true',
+                        help='Only write the normalized text of each data '
+                        'file, for sampling spm encodings during training')
 
     args = parser.parse_args()
 
+    data_split = args.data_start.split('/')
+    data_dir = "/".join(data_split[:-1])
+    data_prefix = data_split[-1]
+
+    # Each dataset has a _train, _val and _test file, only encode it once
+    data_files = sorted({
+        '_'.join(data_file.split('_')[:-1])
+        for data_file in os.listdir(data_dir)
+        if data_file.startswith(data_prefix) and data_file.endswith(".h5")
+    })
+
+    if args.normalized:
+        for data_file in data_files:
+            write_normalized(join(data_dir, data_file))
+        return
+
     model_split = args.model_start.split('/')
     model_dir = '/'.join(model_split[:-1])
     model_prefix = model_split[-1]
 
-    data_split = args.data_start.split('/')
-    data_dir = "/".join(data_split[:-1])
-    data_prefix = data_split[-1]
+    settings = list(itertools.product(args.alpha, args.length))
 
     for model_file in os.listdir(model_dir):
         if model_file.startswith(model_prefix) and model_file.endswith(".model"):
             by_line = "by_line" in model_file
-            for data_file in os.listdir(data_dir):
-                if data_file.startswith(data_prefix) and data_file.endswith(".h5"):
-                    data_file = '_'.join(data_file.split('_')[:-1])
-                    full_model_path = join(model_dir, model_file)
-                    full_data_path = join(data_dir, data_file)
-                    print(f"Encoding with SPM model : {full_model_path} on Dataset: {full_data_path}")
-                    encode_data(full_model_path,
-                                full_data_path,
-                                alpha=args.alpha,
-                                length=args.length,
-                                by_line=by_line)
+            for data_file in data_files:
+                full_model_path = join(model_dir, model_file)
+                full_data_path = join(data_dir, data_file)
+                print(f"Encoding with SPM model : {full_model_path} on Dataset: {full_data_path}")
+                encode_data(full_model_path,
+                            full_data_path,
+                            by_line=by_line,
+                            packed=args.packed,
+                            settings=settings,
+                            workers=args.workers,
+                            chunk_size=args.chunk_size)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,11 @@
 from os.path import join
 import os
 import argparse
+import numpy as np
 import pandas as pd
 from tqdm.auto import tqdm
-import tensorflow as tf
-tqdm.pandas()
+from auth_ident.packed_corpus import write_frame, read_frame, \
+    PackedCorpusWriter
 
 chars_to_encode = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM\n\r\t " + r"1234567890-=!@#$%^&*()_+[]{}|;':\",./<>?"
 start = "<start>"
@@ -13,67 +14,118 @@ chars_to_encode = [end, start] + list(chars_to_encode)
 
 len_encoding = len(chars_to_encode) + 1
 
-chars_index = [i for i in range(len(chars_to_encode))]
-
-char_map = tf.lookup.KeyValueTensorInitializer(chars_to_encode,
-                                               chars_index,
-                                               key_dtype=tf.string,
-                                               value_dtype=tf.int64)
-table = tf.lookup.StaticVocabularyTable(char_map, num_oov_buckets=1)
+END_ID = chars_to_encode.index(end)
+START_ID = chars_to_encode.index(start)
+# The single out of vocabulary bucket of the old StaticVocabularyTable
+OOV_ID = len(chars_to_encode)
+
+# Id of every utf-8 byte. Every encoded character is ascii, so a lead byte
+# of a multi-byte character stands for the whole (out of vocabulary)
+# character and its continuation bytes (-1) are dropped. This gives one id
+# per code point, the same as tf.strings.unicode_split + table lookup.
+BYTE_TABLE = np.full(256, OOV_ID, dtype=np.int8)
+BYTE_TABLE[0x80:0xC0] = -1
+for i, char in enumerate(chars_to_encode[2:], start=2):
+    BYTE_TABLE[ord(char)] = i
+
+
+def encode_batch(programs):
+    """
+    Encode a batch of programs at once.
+
+    Each program becomes [start, chars..., end] as int8 ids. Returns a
+    packed (tokens, offsets) pair, program i being
+    tokens[offsets[i]:offsets[i + 1]].
+    """
+    encoded = [program.encode('utf-8', errors='surrogatepass')
+               for program in programs]
+    byte_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=byte_offsets[1:])
+
+    ids = BYTE_TABLE[np.frombuffer(b"".join(encoded), dtype=np.uint8)]
+    keep = ids >= 0
+    ids = ids[keep]
+
+    # Characters kept before each byte offset, so per program counts
+    kept_before = np.zeros(keep.shape[0] + 1, dtype=np.int64)
+    np.cumsum(keep, out=kept_before[1:])
+    kept_before = kept_before[byte_offsets]
+    lengths = np.diff(kept_before) + 2
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    tokens = np.empty(offsets[-1], dtype=np.int8)
+    tokens[offsets[:-1]] = START_ID
+    tokens[offsets[1:] - 1] = END_ID
+    # Program i's characters start one past its start token
+    body = (np.repeat(offsets[:-1] + 1 - kept_before[:-1], lengths - 2) +
+            np.arange(ids.shape[0]))
+    tokens[body] = ids
+
+    return tokens, offsets
 
 
 def encode(sentence):
-    reshaped = tf.concat(
-        [[start], tf.strings.unicode_split(sentence, 'UTF-8'), [end]], axis=0)
-    encoding = tf.cast(table.lookup(reshaped), dtype=tf.int8)
-
-    return encoding
-
-
-def encode_data(data_file):
+    tokens, _ = encode_batch([sentence])
+    return tokens
+
+
+def encode_split(data, output_file, chunk_size=10000):
+    """Encode the file_content of one split and write it to output_file."""
+    print(f"Output file: {output_file}")
+    chunks = range(0, len(data), chunk_size)
+
+    if output_file.endswith(".packed"):
+        with PackedCorpusWriter(output_file, np.int8) as writer:
+            for i in tqdm(chunks):
+                chunk = data.iloc[i:i + chunk_size]
+                tokens, offsets = encode_batch(chunk['file_content'])
+                writer.append_packed(tokens, offsets,
+                                     chunk.drop(columns=['file_content']))
+    else:
+        file_content = []
+        for i in tqdm(chunks):
+            tokens, offsets = encode_batch(
+                data['file_content'].iloc[i:i + chunk_size])
+            file_content.extend(np.split(tokens, offsets[1:-1]))
+        data = data.copy()
+        data['file_content'] = file_content
+        write_frame(data, output_file)
+
+
+def encode_data(data_file, packed=False, chunk_size=10000):
 
     split_path = data_file.split('/')
     loaded_dir = '/'.join(split_path[:-2])
     file_name = "char_encoding"
+    extension = ".packed" if packed else ".h5"
 
     os.makedirs(join(loaded_dir, 'char_encoded_data'), exist_ok=True)
 
-    train_data = pd.read_hdf(data_file + "_train.h5")
-
-    train_data['file_content'] = train_data['file_content'].progress_apply(
-        encode, convert_dtype=False)
-    train_output_file = join(loaded_dir, "char_encoded_data",
-                             f"{file_name}_train.h5")
-    print(f"Output train file: {train_output_file}")
-    train_data.to_hdf(train_output_file, key='data', mode='w')
-
-    val_data = pd.read_hdf(data_file + "_val.h5")
-    val_data['file_content'] = val_data['file_content'].progress_apply(
-        encode, convert_dtype=False)
-
-    val_output_file = join(loaded_dir, "char_encoded_data",
-                           f"{file_name}_val.h5")
-    print(f"Output val file: {val_output_file}")
-    val_data.to_hdf(val_output_file, key='data', mode='w')
-
-    test_data = pd.read_hdf(data_file + "_test.h5")
-    test_data['file_content'] = test_data['file_content'].progress_apply(
-        encode, convert_dtype=False)
-
-    test_output_file = join(loaded_dir, "char_encoded_data",
-                            f"{file_name}_test.h5")
-    print(f"Output test file: {test_output_file}")
-    test_data.to_hdf(test_output_file, key='data', mode='w')
+    for split in ["train", "val", "test"]:
+        data = read_frame(data_file + f"_{split}.h5")
+        output_file = join(loaded_dir, "char_encoded_data",
+                           f"{file_name}_{split}{extension}")
+        encode_split(data, output_file, chunk_size)
 
 
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-data_file', help='spm model file')
+    parser.add_argument('--packed',
+                        action='store_true',
+                        help='Write packed corpora instead of .h5 files')
+    parser.add_argument('--chunk_size',
+                        default=10000,
+                        type=int,
+                        help='Files encoded per vectorized batch')
 
     args = parser.parse_args()
 
-    encode_data(args.data_file)
+    encode_data(args.data_file, packed=args.packed,
+                chunk_size=args.chunk_size)
 
 
 if __name__ == "__main__":
@@ -2,38 +2,99 @@ import pandas as pd
 import subprocess
 from tqdm import tqdm
 import os
+import io
+import csv
+import json
+import time
+import multiprocessing
+from collections import Counter
 import numpy as np
 import argparse
+from auth_ident.packed_corpus import write_frame, read_frame, load_corpus, \
+    PackedCorpusWriter, FrameWriter, smallest_dtype
+from auth_ident.preprocessing.token_encoder import TokenEncoder, \
+    top_identifiers, expand_ragged, encode_dataset, TOKEN_LAYOUT, \
+    KEYWORD_INDEX_BUFFERS
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    '-src', help='Path of data with language ex: data/gcj_tokenized/c_cpp')
-parser.add_argument('--n',
-                    default=500,
-                    type=int,
-                    help="Number of identifiers to reserve")
-parser.add_argument(
-    '--raw_data_prefix',
-    default="data/raw/gcj/",
-    help='Prefix to raw data paths from hdf file. Give False if no prefix is needed'
-)
-
-parser.add_argument('--l',
-                    action="store_true",
-                    help='If to load premade tokenization or not')
-
-parser.add_argument('--le',
-                    action="store_true",
-                    help='If to load premade encoding or not')
-
-args = parser.parse_args()
-path = args.src
-num_reserved_identifiers = args.n
-train_path = path + "_train"
-tokenized_train_path = train_path + "_tokenized_csv.csv"
-
-
-def tokenize(type):
+TOKENIZER = "./../Project_CodeNet/tools/tokenizer/tokenize"
+TOKENIZER_FLAGS = ["-lC++", "-mcsv", "-n", "-s", "-1", "-K"]
+
+# Files with this many encoded tokens or fewer are dropped
+MIN_ENCODED_LENGTH = 10
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-src', help='Path of data with language ex: data/gcj_tokenized/c_cpp')
+    parser.add_argument('--n',
+                        default=500,
+                        type=int,
+                        help="Number of identifiers to reserve")
+    parser.add_argument(
+        '--raw_data_prefix',
+        default="data/raw/gcj/",
+        help='Prefix to raw data paths from hdf file. Give False if no prefix is needed'
+    )
+
+    parser.add_argument('--l',
+                        action="store_true",
+                        help='If to load premade tokenization or not')
+
+    parser.add_argument('--le',
+                        action="store_true",
+                        help='If to load premade encoding or not')
+
+    parser.add_argument('--packed',
+                        action="store_true",
+                        help='Write packed corpora instead of .h5 files')
+
+    parser.add_argument('--py_encode',
+                        action="store_true",
+                        help='Encode the tokenized csv files in python '
+                        'with --workers processes instead of running '
+                        'encode_tokens')
+
+    parser.add_argument('--stream',
+                        action="store_true",
+                        help='Tokenize with parallel workers straight into '
+                        'a lexicon corpus and encode from it, without '
+                        'intermediate csv files. Tokenization is reused '
+                        'when it exists, so changing --n only re-encodes.')
+    parser.add_argument('--retokenize',
+                        action="store_true",
+                        help='With --stream, tokenize again even if a '
+                        'lexicon corpus exists')
+    parser.add_argument('--workers',
+                        default=os.cpu_count(),
+                        type=int,
+                        help='Number of tokenizer or encoder processes for '
+                        '--stream and --py_encode')
+    parser.add_argument('--batch_size',
+                        default=1000,
+                        type=int,
+                        help='Files per tokenizer call for --stream')
+    parser.add_argument('--tokenizer',
+                        default=TOKENIZER,
+                        help='Path of the CodeNet tokenize binary')
+    parser.add_argument('--layout',
+                        default=TOKEN_LAYOUT,
+                        type=int,
+                        choices=sorted(KEYWORD_INDEX_BUFFERS),
+                        help='Token id layout written by --stream and '
+                        '--py_encode (see token_encoder.py). encode_tokens '
+                        'always writes layout 1')
+    return parser
+
+
+def raw_file_paths(f, raw_data_prefix):
+    if raw_data_prefix != "False":
+        return f["filepath"].apply(lambda x: raw_data_prefix + x)
+    return f["filepath"]
+
+
+def tokenize(args, type):
+    path = args.src
     type_path = path + "_" + type
     tokenized_path = type_path + "_tokenized_csv.csv"
 
@@ -43,18 +104,17 @@ def tokenize(type):
         os.remove(tokenized_path)
         os.mknod(tokenized_path)
 
-    f = pd.read_hdf(type_path + ".h5")
-    if args.raw_data_prefix != "False":
-        f["filepath"] = f["filepath"].apply(lambda x: args.raw_data_prefix + x)
+    f = read_frame(type_path + ".h5")
+    f["filepath"] = raw_file_paths(f, args.raw_data_prefix)
 
     # Save authors for later use in encoding program
-    np.savetxt(type_path + "_authors.txt", 
+    np.savetxt(type_path + "_authors.txt",
 	       f["username"].to_numpy(),
                fmt="%s",
                delimiter="\n")
 
     command = [
-        "./../Project_CodeNet/tools/tokenizer/tokenize", "-lC++", "-mcsv",
+        args.tokenizer, "-lC++", "-mcsv",
         "-n", "-s", "-1", "-a", "-K", f"-o{tokenized_path}"
     ]
 
@@ -76,30 +136,33 @@ def tokenize(type):
     del data
 
 
-if not args.l and not args.le:
-    tokenize("train")
-    tokenize("val")
-    tokenize("test")
+def count_identifiers(tokenized_path, chunk_size=1000000):
+    """
+    Count identifier tokens in a tokenized csv, chunk_size rows at a time,
+    so memory is bounded by the number of distinct identifiers.
+    """
+    counts = Counter()
+    chunks = pd.read_csv(tokenized_path,
+                         encoding="latin1",
+                         header=None,
+                         names=["class", "token"],
+                         dtype=str,
+                         keep_default_na=False,
+                         chunksize=chunk_size)
+    for chunk in chunks:
+        tokens = chunk["token"][chunk["class"] == "identifier"]
+        counts.update(tokens.value_counts().to_dict())
+    return counts
 
-    # Find top identifiers
-    data = pd.read_csv(tokenized_train_path,
-                       encoding="latin1",
-                       error_bad_lines=True,
-                       header=None,
-                       names=["class", "token"])
-    tokens = data[data['class'] == "identifier"]["token"].to_numpy(dtype="U20")
-    tokens = tokens[:int(tokens.shape[0] / 3)]
 
-    u, counts = np.unique(tokens, return_counts=True)
-    # Add 100 length buffer because we will remove individual letters
-    sorted_count_args = np.argsort(-counts)[:num_reserved_identifiers + 100]
+def find_top_identifiers(args):
+    path = args.src
+    tokenized_train_path = path + "_train_tokenized_csv.csv"
 
-    # Remove alphabet identifiers because we can deal with that seperately
-    alphabet = np.array(
-        list(
-            "_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"))
-    top_ids = np.setdiff1d(u[sorted_count_args], alphabet,
-                           assume_unique=True)[:num_reserved_identifiers]
+    # Find top identifiers over the whole train split. Single letters are
+    # skipped because they are encoded by the alphabet anyway.
+    counts = count_identifiers(tokenized_train_path)
+    top_ids = top_identifiers(counts, args.n)
 
     np.savetxt(path + "_top_identifiers.txt",
                top_ids,
@@ -107,11 +170,64 @@ if not args.l and not args.le:
                delimiter="\n")
 
 
-def encode(type):
+def read_tokenized_files(tokenized_path):
+    """
+    Yield (filename, [(class, token), ...]) for every file of a tokenized
+    csv written by tokenize.
+    """
+    with open(tokenized_path, encoding="latin1", newline="") as f:
+        filename, pairs = None, []
+        for token_class, token in csv.reader(f):
+            if token_class == "filename":
+                if filename is not None:
+                    yield filename, pairs
+                filename, pairs = token, []
+            else:
+                pairs.append((token_class, token))
+        if filename is not None:
+            yield filename, pairs
+
+
+def encode_python(args, type):
+    path = args.src
+    type_path = path + "_" + type
+    f = read_frame(type_path + ".h5")
+    file_paths = raw_file_paths(f, args.raw_data_prefix).tolist()
+    username_of_path = dict(zip(file_paths, f["username"]))
+    with open(path + "_top_identifiers.txt") as top_ids_file:
+        top_ids = top_ids_file.read().splitlines()
+
+    filenames = []
+
+    def files():
+        for filename, pairs in read_tokenized_files(
+                type_path + "_tokenized_csv.csv"):
+            filenames.append(filename)
+            yield pairs
+
+    file_content = encode_dataset(files(), top_ids, workers=args.workers,
+                                  layout=args.layout)
+    return pd.DataFrame({
+        "username": [username_of_path.get(name) for name in filenames],
+        "filename": filenames,
+        "file_content": file_content
+    })
+
+
+def encode(args, type):
+    path = args.src
+    if args.py_encode:
+        f = encode_python(args, type)
+        f = f[f["file_content"].map(len) > MIN_ENCODED_LENGTH].reset_index(drop=True)
+        extension = ".packed" if args.packed else ".h5"
+        write_frame(f, path + f"_{type}_encoded" + extension,
+                    info={"token_layout": args.layout})
+        return
+
     if not args.le:
         subprocess.call([
             "auth_ident/preprocessing/encode_tokens",
-            f"-n{num_reserved_identifiers}", path + f"_{type }"
+            f"-n{args.n}", path + f"_{type }"
         ])
 
     # Load csv and convert to h5
@@ -124,10 +240,219 @@ def encode(type):
                     })
     print(f)
     # Filter out small files
-    f = f[f["file_content"].map(len) > 10].reset_index(drop=True)
-    f.to_hdf(path + f"_{type}_encoded.h5", key='data', mode='w')
+    f = f[f["file_content"].map(len) > MIN_ENCODED_LENGTH].reset_index(drop=True)
+    extension = ".packed" if args.packed else ".h5"
+    write_frame(f, path + f"_{type}_encoded" + extension)
+
+
+def tokenize_batch(job):
+    """
+    Run the tokenizer on a batch of files and parse its csv output as it is
+    produced.
+
+    Returns (lexicon, files): lexicon lists the distinct (class, token)
+    pairs seen in the batch and files maps each file name to the int32
+    array of its tokens as indices into lexicon.
+    """
+    tokenizer, file_paths = job
+    process = subprocess.Popen([tokenizer] + TOKENIZER_FLAGS + file_paths,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    rows = csv.reader(io.TextIOWrapper(process.stdout, encoding="latin1",
+                                       newline=""))
+
+    lexicon = {}
+    files = {}
+    header = None
+    current = None
+    for row in rows:
+        if header is None:
+            header = row
+            class_col = header.index("class")
+            token_col = header.index("token")
+            continue
+        if row == header or len(row) < len(header):
+            continue
+
+        token_class, token = row[class_col], row[token_col]
+        if token_class == "filename":
+            current = files.setdefault(token, [])
+        elif current is not None:
+            key = (token_class, token)
+            current.append(lexicon.setdefault(key, len(lexicon)))
+    process.wait()
+
+    files = {name: np.array(tokens, dtype=np.int32)
+             for name, tokens in files.items()}
+    return list(lexicon), files
+
+
+def tokenize_stream(args, type, lexicon, identifier_counts=None):
+    """
+    Tokenize one split with args.workers tokenizer processes and write it
+    as a lexicon corpus: every token is an index into the shared, growing
+    lexicon of distinct (class, token) pairs. identifier_counts, if given,
+    is updated with the identifier frequencies of the split.
+    """
+    path = args.src
+    type_path = path + "_" + type
+    f = read_frame(type_path + ".h5")
+    file_paths = raw_file_paths(f, args.raw_data_prefix).tolist()
+    row_of_path = {file_path: i for i, file_path in enumerate(file_paths)}
+    usernames = f["username"].to_numpy()
+
+    jobs = [(args.tokenizer, file_paths[i:i + args.batch_size])
+            for i in range(0, len(file_paths), args.batch_size)]
+
+    lexicon_ids = {key: i for i, key in enumerate(lexicon)}
+    is_identifier = np.array([key[0] == "identifier" for key in lexicon],
+                             dtype=bool)
+    num_tokens = 0
+    num_files = 0
+    unmatched = []
+    start = time.perf_counter()
+    with PackedCorpusWriter(type_path + "_lexicon.packed", np.int32) as writer, \
+            multiprocessing.Pool(args.workers) as pool:
+        for batch_lexicon, files in tqdm(pool.imap(tokenize_batch, jobs),
+                                         total=len(jobs)):
+            # Map the batch's lexicon onto the shared one
+            for key in batch_lexicon:
+                if key not in lexicon_ids:
+                    lexicon_ids[key] = len(lexicon)
+                    lexicon.append(key)
+            remap = np.array([lexicon_ids[key] for key in batch_lexicon],
+                             dtype=np.int32)
+            if len(is_identifier) < len(lexicon):
+                is_identifier = np.concatenate([is_identifier, [
+                    key[0] == "identifier"
+                    for key in lexicon[len(is_identifier):]]])
+
+            names = [name for name in files if name in row_of_path]
+            unmatched.extend(name for name in files
+                             if name not in row_of_path)
+            num_files += len(names)
+            sequences = [remap[files[name]] for name in names]
+            rows = [row_of_path[name] for name in names]
+            writer.append(sequences, pd.DataFrame({
+                "username": usernames[rows],
+                "filename": names}))
+
+            if identifier_counts is not None and sequences:
+                tokens = np.concatenate(sequences)
+                ids, counts = np.unique(tokens[is_identifier[tokens]],
+                                        return_counts=True)
+                identifier_counts.update(dict(zip(ids.tolist(),
+                                                  counts.tolist())))
+            num_tokens += sum(len(s) for s in sequences)
+
+    elapsed = time.perf_counter() - start
+    print(f"Tokenized {type}: {num_files} of {len(file_paths)} files, "
+          f"{num_tokens} tokens in {elapsed:.1f}s "
+          f"({num_tokens / max(elapsed, 1e-9):.0f} tokens/sec)")
+    if unmatched:
+        print(f"WARNING: dropped {len(unmatched)} {type} files whose "
+              f"tokenizer file name is not in {type_path}.h5, e.g. "
+              f"{unmatched[:3]}")
+    if num_files + len(unmatched) < len(file_paths):
+        print(f"WARNING: the tokenizer returned no tokens for "
+              f"{len(file_paths) - num_files - len(unmatched)} {type} files")
+
+
+def encode_stream(args, type, encoder, lexicon, chunk_size=10000):
+    """
+    Encode a lexicon corpus with encoder: each distinct lexicon entry is
+    encoded once, and chunk_size files at a time are expanded in one ragged
+    gather and appended to the encoded split.
+    """
+    path = args.src
+    type_path = path + "_" + type
+    corpus = load_corpus(type_path + "_lexicon.packed")
+
+    table_ids, table_offsets = encoder.encode_lexicon(lexicon)
+
+    info = {"token_layout": encoder.layout}
+    if args.packed:
+        writer = PackedCorpusWriter(path + f"_{type}_encoded.packed",
+                                    smallest_dtype(encoder.len_encoding),
+                                    info=info)
+    else:
+        writer = FrameWriter(path + f"_{type}_encoded.h5",
+                             list(corpus.metadata.columns) + ["file_content"],
+                             info=info)
+
+    num_kept = 0
+    with writer:
+        for first in range(0, len(corpus), chunk_size):
+            file_offsets = corpus.offsets[first:first + chunk_size + 1]
+            ids, starts = expand_ragged(
+                corpus.tokens[file_offsets[0]:file_offsets[-1]], table_ids,
+                table_offsets)
+            offsets = starts[file_offsets - file_offsets[0]]
+
+            keep = np.flatnonzero(np.diff(offsets) > MIN_ENCODED_LENGTH)
+            file_content = [ids[offsets[i]:offsets[i + 1]] for i in keep]
+            metadata = corpus.metadata.iloc[first + keep].reset_index(
+                drop=True)
+            if len(keep) == 0:
+                continue
+            if args.packed:
+                writer.append(file_content, metadata)
+            else:
+                writer.write_chunk(metadata.assign(file_content=file_content))
+            num_kept += len(keep)
+
+    print(f"Encoded {type}: {num_kept} of {len(corpus)} files kept")
+
+
+def run_stream(args):
+    path = args.src
+    lexicon_path = path + "_lexicon.json"
+
+    if args.retokenize or not os.path.exists(lexicon_path):
+        lexicon = []
+        identifier_counts = Counter()
+        tokenize_stream(args, "train", lexicon, identifier_counts)
+        tokenize_stream(args, "val", lexicon)
+        tokenize_stream(args, "test", lexicon)
+        with open(lexicon_path, 'w') as f:
+            json.dump({"lexicon": lexicon,
+                       "train_identifier_counts":
+                       {lexicon[i][1]: count
+                        for i, count in identifier_counts.items()}}, f)
+
+    with open(lexicon_path) as f:
+        saved = json.load(f)
+    lexicon = [tuple(key) for key in saved["lexicon"]]
+
+    top_ids = top_identifiers(saved["train_identifier_counts"], args.n)
+    np.savetxt(path + "_top_identifiers.txt",
+               top_ids,
+               fmt="%s",
+               delimiter="\n")
+
+    encoder = TokenEncoder(top_ids, layout=args.layout)
+    for type in ["train", "val", "test"]:
+        encode_stream(args, type, encoder, lexicon)
+
+
+def main():
+    args = make_arg_parser().parse_args()
+
+    if args.stream:
+        run_stream(args)
+        return
+
+    if not args.l and not args.le:
+        tokenize(args, "train")
+        tokenize(args, "val")
+        tokenize(args, "test")
+
+        find_top_identifiers(args)
+
+    encode(args, "train")
+    encode(args, "val")
+    encode(args, "test")
 
 
-encode("train")
-encode("val")
-encode("test")
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import os
 import pandas as pd
 import re
 import time
+from auth_ident.packed_corpus import read_frame
 
 
 def make_text_file(data_file, by_line, text_file):
@@ -12,7 +13,7 @@ def make_text_file(data_file, by_line, text_file):
     os.makedirs(os.path.join(''.join(text_file.split('/')[:-1]), 'text_file'),
                 exist_ok=True)
 
-    data = pd.read_hdf(data_file)
+    data = read_frame(data_file)
 
     with open(text_file, 'w') as f:
 
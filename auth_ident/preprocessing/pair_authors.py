@@ -1,13 +1,17 @@
+import os
 import pandas as pd
 import numpy as np
 import itertools
+from auth_ident.preprocessing.author_split import split_authors, \
+    author_mapping, save_split, random_state, VAL, TEST, TRAIN
 
 class PairAuthors():
     """Generates pairs of authors. Author pairs will be pairs of the same author,
     based on the match rate percentage. The rest of the time Author pairs will be
     of different authors."""
 
-    def __init__(self, filepath, match_rate=0.5, author_val_test_split=0.1, train_samples=1000000, val_test_samples=50000):
+    def __init__(self, filepath, match_rate=0.5, author_val_test_split=0.1, train_samples=1000000, val_test_samples=50000,
+                 seed=None, split_file=None):
         self.total_samples = train_samples + 2 * val_test_samples
         self.train_samples = train_samples
         self.val_test_samples = val_test_samples
@@ -15,9 +19,18 @@ class PairAuthors():
 
         self.author_val_test_split = author_val_test_split
         self.author_train_split = 1 - 2 * author_val_test_split
+        # Every random draw goes through self.rng, so a seed makes the
+        # split and the pairs reproducible
+        self.seed = seed
+        self.rng = random_state(seed)
+        # Where generate_pairs saves the author to split mapping
+        if split_file is None:
+            split_file = os.path.splitext(filepath)[0] + "_author_split.csv"
+        self.split_file = split_file
 
         self.files = pd.read_csv(filepath, keep_default_na=False)
-        self.authors = list(set(self.files['username']))
+        # Sorted so a seeded split is reproducible
+        self.authors = sorted(set(self.files['username']))
         self.auth_to_idx = {self.authors[i]: i for i in range(len(self.authors))}
         self.idx_to_auth = {v: k for k, v in self.auth_to_idx.items()}
 
@@ -31,22 +44,21 @@ class PairAuthors():
 
     def generate_pairs(self):
 
-        # Gets random author permuation of idxs 
-        shuffle_mask = np.random.permutation(len(self.authors))
+        self.rng = random_state(self.seed)
 
-        # Get number of authors for train, val, and test Test size = val size
-        train_auth_len = int(self.author_train_split * self.authors.shape[0])
-        val_test_auth_len = int(self.author_val_test_split * self.authors.shape[0])
-
-        # Grab the correct number of random authors
-        train_mask = shuffle_mask[:train_auth_len]
-        val_mask = shuffle_mask[train_auth_len: train_auth_len + val_test_auth_len]
-        test_mask = shuffle_mask[train_auth_len + val_test_auth_len: train_auth_len + 2 * val_test_auth_len]
+        # Same layout PairAuthors has always used: one random permutation of
+        # the authors sliced into train, val and test
+        author_splits = split_authors(len(self.authors),
+                                      self.author_val_test_split, self.rng,
+                                      layout='permutation')
+        author_names = [self.idx_to_auth[author] for author in self.authors]
+        save_split(author_mapping(author_names, author_splits),
+                   self.split_file)
 
         # Asign the authors
-        train_authors = self.authors[train_mask]
-        val_authors = self.authors[val_mask]
-        test_authors = self.authors[test_mask]
+        train_authors = self.authors[author_splits == TRAIN]
+        val_authors = self.authors[author_splits == VAL]
+        test_authors = self.authors[author_splits == TEST]
 
         # Pair the authors
         train_pairs, train_labels = self.__pair(train_authors, self.train_samples)
@@ -86,7 +98,7 @@ class PairAuthors():
                                  np.zeros(non_matched_combinations.shape[0])])
 
         # Shuffle and resahpe data
-        shuffle_mask = np.random.permutation(data.shape[0])
+        shuffle_mask = self.rng.permutation(data.shape[0])
         data = data[shuffle_mask]
         data = self.files['filepath'].take(data.flatten()).values.reshape(-1, 2)
         labels = np.squeeze(labels[shuffle_mask])
@@ -111,9 +123,9 @@ class PairAuthors():
             if samples_left > len(authors_with_min_idx):
                 authors_to_match.append(authors_with_min_idx)
             else:
-                authors_to_match.append(np.random.choice(authors_with_min_idx,
-                                                         samples_left,
-                                                         replace=False))
+                authors_to_match.append(self.rng.choice(authors_with_min_idx,
+                                                        samples_left,
+                                                        replace=False))
 
             samples_left -= len(authors_with_min_idx)
             index += 1
@@ -149,9 +161,9 @@ class PairAuthors():
         for author in range(len(auth_bin_cnt)):
             print("Number of files", len(file_h_c[author]))
             print("Files requested", auth_bin_cnt[author])
-            combinations_idx.append(np.random.choice(len(file_h_c[author]),
-                                                     auth_bin_cnt[author],
-                                                     replace=False))
+            combinations_idx.append(self.rng.choice(len(file_h_c[author]),
+                                                    auth_bin_cnt[author],
+                                                    replace=False))
 
         # Convert to numpy array
         matched_combinations = np.array([np.array(file_h_c[author][idx])
@@ -169,8 +181,8 @@ class PairAuthors():
          If the first chosen author is 2
          2 >= 2 so 2 => 3. 3 => 4.  4 => 5
          Then the second author actually chooses from: [1, 3, 4, 5]"""
-        first_author = np.squeeze(np.random.choice(authors.shape[0], [num_samples, 1]))
-        second_author = np.squeeze(np.random.choice(authors.shape[0] - 1, [num_samples, 1]))
+        first_author = np.squeeze(self.rng.choice(authors.shape[0], [num_samples, 1]))
+        second_author = np.squeeze(self.rng.choice(authors.shape[0] - 1, [num_samples, 1]))
         bool_mask = second_author >= first_author
         second_author += bool_mask
         first_author = authors[first_author]
@@ -180,7 +192,7 @@ class PairAuthors():
     def choose_files(self, authors, non_matched_length):
         """Maps a set of authors to a set of randomly chosen files"""
         files_len = np.array([self.files_by_auth[author].shape[0] for author in authors])
-        chosen_file = (np.random.rand(*authors.shape) * np.squeeze(files_len)).astype(int)
+        chosen_file = (self.rng.rand(*authors.shape) * np.squeeze(files_len)).astype(int)
         files = self.files_by_auth[authors]
         assert authors.shape[0] == non_matched_length
         files = np.array([files[i][chosen_file[i]] for i in range(authors.shape[0])])
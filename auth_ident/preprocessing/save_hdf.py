@@ -8,10 +8,17 @@ the resultingpandas dataframes will be
 "filepath" - The original relative path for the file.
 "file_content" - The full file contents in unicode.
 
+The .h5 files are written in chunks and never held in memory whole; read
+them with auth_ident.packed_corpus.read_frame (or iter_frames, one chunk at
+a time) rather than pd.read_hdf.
 
-usage: save_hdf.py [-h] [--src-dir SRC_DIR] [--keep-repeats] --out OUT
+
+usage: save_hdf.py [-h] [--src-dir SRC_DIR] [--keep-repeats] [--out OUT]
                    [--extensions [EXTENSIONS [EXTENSIONS ...]]]
                    [--val-test-split VAL_TEST_SPLIT]
+                   [--min-file-size MIN_FILE_SIZE]
+                   [--outputs [OUTPUTS [OUTPUTS ...]]] [--workers WORKERS]
+                   [--packed] [--chunk-size CHUNK_SIZE] [--seed SEED]
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -29,6 +36,21 @@ optional arguments:
                         List of file extensions to keep. (default: ['py'])
   --min-file-size MIN_FILE_SIZE
                         Minimum file size (in bytes) to include. (default: 100)
+  --outputs [OUTPUTS [OUTPUTS ...]]
+                        Several destinations from one pass over the source
+                        tree, each given as OUT:EXT,EXT,... e.g.
+                        data/loaded/java:java. Replaces --out and
+                        --extensions. (default: [])
+  --workers WORKERS     Number of processes used to decode files. (default:
+                        number of cpus)
+  --packed              Write text .packed corpora instead of .h5 files.
+                        (default: False)
+  --chunk-size CHUNK_SIZE
+                        Rows buffered per output file before they are
+                        appended to it. (default: 10000)
+  --seed SEED           Seed for the author split. The author to split
+                        mapping is saved next to the output as
+                        _author_split.csv. (default: None)
 
 This script expects that the gcj folders are organized as follows:
 
@@ -48,11 +70,20 @@ import json
 import numpy as np
 import pandas as pd
 import pickle
+import multiprocessing
+import time
 from bs4 import UnicodeDammit
+from auth_ident.packed_corpus import FrameWriter
+from auth_ident.preprocessing.author_split import assign_splits, save_split, \
+    SPLIT_SUFFIXES
+
+COLUMNS = ["year", "round", "problem", "username", "filepath",
+           "file_content"]
 
 
 def make_hdf(gcj_root, new_hdf, keep_repeats, extensions, val_test_split,
-             min_file_size):
+             min_file_size, workers=1, packed=False, chunk_size=10000,
+             seed=None):
     """
     Create .h5 file(s) from Google code jam submissions.
 
@@ -63,19 +94,64 @@ def make_hdf(gcj_root, new_hdf, keep_repeats, extensions, val_test_split,
     :param val_test_split (float): Fraction of files to set aside for
     each of validation and testing.
     :param min_file_size (int): Minimum file size to keep (in bytes).
+    :param workers (int): Number of processes used to decode files.
+    :param packed (boolean): Write text .packed corpora instead of .h5.
+    :param chunk_size (int): Rows buffered per output file before writing.
+    :param seed (int): Seed for the author split, None for numpy's global
+    random state.
 
     """
-    # mapping from "contest_id/username/problem_id/solution_id"
-    #        or    "contest_id/username/problem_id" if dropping repeats
-    # to a tuple (username, filepath, file_contents)
-    submissions = {}
-    file_count = 0
-    replaced_files = 0
-    loaded_files = 0
+    stats = make_hdfs(gcj_root, {new_hdf: extensions}, keep_repeats,
+                      val_test_split, min_file_size, workers, packed,
+                      chunk_size, seed)
+    return stats[new_hdf]
+
+
+def decode_submission(full_paths):
+    """
+    Decode the newest of several submissions sharing one key, falling back
+    to older ones if decoding fails. Returns (path, unicode, contains
+    replacement characters), unicode being None if nothing decoded.
+    """
+    for full_path in reversed(full_paths):
+        with open(full_path, 'rb') as content_file:
+            contents = content_file.read()
+        dammit = UnicodeDammit(contents)
+        if dammit.unicode_markup is not None:
+            return (full_path, dammit.unicode_markup,
+                    dammit.contains_replacement_characters)
+    return full_paths[-1], None, False
+
+
+def make_hdfs(gcj_root, outputs, keep_repeats, val_test_split,
+              min_file_size, workers=1, packed=False, chunk_size=10000,
+              seed=None):
+    """
+    Create .h5 file(s) for several extension filters from a single walk of
+    the code jam hierarchy. Each kept file is decoded once, in a pool of
+    workers processes, whichever outputs it belongs to.
 
-    contest_dict = get_competition_data()
+    The walk resolves repeats and decides the author split before anything
+    is decoded, so decoded rows are appended straight to their split file
+    chunk_size rows at a time rather than collected in one DataFrame.
+
+    :param outputs (dict): Maps each output filename (.h5 will be
+    appended) to the list of extensions it keeps.
+
+    See make_hdf for the other parameters. Returns a mapping from output
+    filename to (files searched, files loaded, files with replacement
+    chars).
+    """
+    contest_dict, global_problem_index = get_competition_data()
 
+    # Walk once. Submissions are grouped under
+    # "contest_id/username/problem_id/solution_id/file"
+    #     or "contest_id/username/problem_id/file" if dropping repeats,
+    # in walk order, so the last path of each key is the one to keep.
+    file_count = 0
+    submissions = {}
     gcj_root = os.path.normpath(gcj_root)
+    all_extensions = set(ext for exts in outputs.values() for ext in exts)
     for root, dir_names, files in os.walk(gcj_root):
 
         # Make sure we walk the subdirectories in order, so later
@@ -83,103 +159,113 @@ def make_hdf(gcj_root, new_hdf, keep_repeats, extensions, val_test_split,
         # order is arbitrary)
         dir_names[:] = sorted(dir_names)
 
-        for file in files:
+        for file in sorted(files):
 
             file_count += 1
-            if file_count % 1000 == 0:
-                print(".", end="", flush=True)
-
             _, file_extension = os.path.splitext(file)
             full_path = os.path.join(root, file)
-            if (file_extension[1::] in extensions and
+            if (file_extension[1::] in all_extensions and
                     os.path.getsize(full_path) > min_file_size):
 
                 # pull out just the part of the path from constest_id forward
-                local_path = root[len(gcj_root) + 1:]
-                split_path = local_path.split('/')
-
-                contest_id = split_path[0]
-                problem_id = split_path[2]
-
-                contest_dict, global_problem_index = get_competition_data()
-
+                split_path = root[len(gcj_root) + 1:].split('/')
                 if keep_repeats:
                     submission_key = '/'.join(
                         split_path[0:4]) + '/' + file
                 else:
                     submission_key = '/'.join(
                         split_path[0:3]) + '/' + file
-
-                with open(full_path, 'rb') as content_file:
-                    contents = content_file.read()
-                    dammit = UnicodeDammit(contents)
-                    unicode = dammit.unicode_markup
-
-                    if unicode is not None:
-                        # Some contests don't have known problem ids, so we can make them
-                        # on the fly
-                        problems = contest_dict[contest_id][2]
-                        if problem_id in problems.keys(): 
-                            problem = problems[problem_id]
-                        else:
-                            problem = "{:03d} {}".format(global_problem_index, "unknown_name")
-                            problems[problem_id] = problem
-                            global_problem_index += 1
-
-
-                        submissions[submission_key] = (contest_dict[contest_id][0], # Year
-                                                       contest_dict[contest_id][1], # Round
-                                                       problem, # Problem
-                                                       local_path.split('/')[1], # Name
-                                                       os.path.join(local_path,     # Path
-                                                                    file),
-                                                       unicode)                     # code
-                        loaded_files += 1
-                        if dammit.contains_replacement_characters:
-                            replaced_files += 1
-
-    frame = pd.DataFrame({"year": [v[0] for v in submissions.values()],
-                          "round": [v[1] for v in submissions.values()],
-                          "problem": [v[2] for v in submissions.values()],
-                          "username": [v[3] for v in submissions.values()],
-                          "filepath": [v[4] for v in submissions.values()],
-                          "file_content": [v[5] for v in
-                                           submissions.values()]})
-
-    if val_test_split > 0:
-        authors = frame['username'].unique()
-        np.random.shuffle(authors)
-
-        num_val = int(val_test_split * len(authors))
-        num_test = int(val_test_split * len(authors))
-
-        # Determine which authors will be in which set...
-        val_authors = np.random.choice(authors, num_val, replace=False)
-        authors = np.setdiff1d(authors, val_authors,
-                               assume_unique=True)
-        test_authors = np.random.choice(authors, num_test, replace=False)
-
-        # All remaining are in the train set.
-        train_authors = np.setdiff1d(authors, test_authors,
-                                     assume_unique=True)
-
-        # Split into DataFrames according to the selected authors.
-        # Unfortunately, this will double memory usage.
-        val_matches = [name in val_authors for name in frame['username']]
-        test_matches = [name in test_authors for name in frame['username']]
-        train_matches = [name in train_authors for name in frame['username']]
-
-        val_frame = frame.loc[val_matches].reset_index(drop=True)
-        test_frame = frame.loc[test_matches].reset_index(drop=True)
-        train_frame = frame.loc[train_matches].reset_index(drop=True)
-
-        val_frame.to_hdf(new_hdf + "_val.h5", key='df', mode='w')
-        test_frame.to_hdf(new_hdf + "_test.h5", key='df', mode='w')
-        train_frame.to_hdf(new_hdf + "_train.h5", key='df', mode='w')
-    else:
-        frame.to_hdf(new_hdf + ".h5", key='df', mode='w')
-
-    return file_count, loaded_files, replaced_files
+                submissions.setdefault(submission_key, []).append(full_path)
+
+    print(f"Found {len(submissions)} submissions in {file_count} files",
+          flush=True)
+
+    keys = list(submissions)
+    key_outputs = [[name for name, extensions in outputs.items()
+                    if os.path.splitext(key)[1][1:] in extensions]
+                   for key in keys]
+
+    # Decide the author split up front. key_splits holds the split of every
+    # submission key for each output
+    key_splits = {}
+    writers = {}
+    for name in outputs:
+        kept = [i for i, names in enumerate(key_outputs) if name in names]
+        usernames = [keys[i].split('/')[1] for i in kept]
+        key_splits[name] = np.zeros(len(keys), dtype=np.int8)
+        if val_test_split > 0:
+            row_splits, mapping = assign_splits(usernames, val_test_split,
+                                                seed)
+            save_split(mapping, name + "_author_split.csv")
+            key_splits[name][kept] = row_splits
+            split_names = {split: suffix
+                           for split, suffix in enumerate(SPLIT_SUFFIXES)}
+        else:
+            split_names = {0: ""}
+
+        extension = ".packed" if packed else ".h5"
+        writers[name] = {
+            split: FrameWriter(name + suffix + extension, COLUMNS, chunk_size)
+            for split, suffix in split_names.items()}
+
+    loaded_files = {name: 0 for name in outputs}
+    replaced_files = {name: 0 for name in outputs}
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        decoded = pool.imap(decode_submission,
+                            (submissions[key] for key in keys),
+                            chunksize=64)
+        for i, (key, names, (full_path, unicode, replaced)) in \
+                enumerate(zip(keys, key_outputs, decoded)):
+
+            if (i + 1) % 10000 == 0:
+                rate = (i + 1) / (time.perf_counter() - start)
+                print(f"{i + 1}/{len(keys)} submissions, "
+                      f"{rate:.0f} files/sec", flush=True)
+
+            if unicode is None:
+                continue
+
+            local_path = os.path.relpath(full_path, gcj_root)
+            split_path = local_path.split('/')
+            contest_id = split_path[0]
+            problem_id = split_path[2]
+
+            # Some contests don't have known problem ids, so we can make them
+            # on the fly
+            problems = contest_dict[contest_id][2]
+            if problem_id in problems.keys():
+                problem = problems[problem_id]
+            else:
+                problem = "{:03d} {}".format(global_problem_index, "unknown_name")
+                problems[problem_id] = problem
+                global_problem_index += 1
+
+            row = (contest_dict[contest_id][0], # Year
+                   contest_dict[contest_id][1], # Round
+                   problem, # Problem
+                   split_path[1], # Name
+                   local_path, # Path
+                   unicode) # code
+
+            for name in names:
+                writers[name][key_splits[name][i]].append(row)
+                loaded_files[name] += 1
+                if replaced:
+                    replaced_files[name] += 1
+
+    for split_writers in writers.values():
+        for writer in split_writers.values():
+            writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Decoded {len(keys)} submissions in {elapsed:.1f}s "
+          f"({len(keys) / max(elapsed, 1e-9):.0f} files/sec) "
+          f"with {workers} workers", flush=True)
+
+    return {name: (file_count, loaded_files[name], replaced_files[name])
+            for name in outputs}
 
 
 def get_competition_data():
@@ -238,8 +324,8 @@ pandas dataframes will be
     parser.add_argument('--keep-repeats', default=False, action='store_true',
                         help='Keep multiple submissions from the same author '
                              'for the same problem')
-    parser.add_argument('--out', required=True, help='Destination file. (.h5 '
-                                                     'will be appended)')
+    parser.add_argument('--out', help='Destination file. (.h5 '
+                                      'will be appended)')
     parser.add_argument('--extensions', default=['py'], nargs='*',
                         help="List of file extensions to keep.")
     parser.add_argument('--val-test-split', default=0, type=float,
@@ -249,21 +335,52 @@ pandas dataframes will be
                              'and _train appended to the names.')
     parser.add_argument('--min-file-size', default=100, type=int,
                         help='Minimum file size (in bytes) to include.')
+    parser.add_argument('--outputs', nargs='*', default=[],
+                        help='Several destinations from one pass over the '
+                             'source tree, each given as '
+                             'OUT:EXT,EXT,... e.g. data/loaded/java:java. '
+                             'Replaces --out and --extensions.')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int,
+                        help='Number of processes used to decode files.')
+    parser.add_argument('--packed', default=False, action='store_true',
+                        help='Write text .packed corpora instead of .h5 '
+                             'files.')
+    parser.add_argument('--chunk-size', default=10000, type=int,
+                        help='Rows buffered per output file before they '
+                             'are appended to it.')
+    parser.add_argument('--seed', default=None, type=int,
+                        help='Seed for the author split. The author to '
+                             'split mapping is saved next to the output as '
+                             '_author_split.csv.')
 
     args = parser.parse_args()
-    total, loaded, replaced = make_hdf(args.src_dir, args.out,
-                                       args.keep_repeats, args.extensions,
-                                       args.val_test_split, args.min_file_size)
-
-    # Print info about the dataset
-    with open(args.out + ".info", 'w') as f:
-        print("Keep repeats: ", args.keep_repeats, file=f)
-        print("Extensions: ", args.extensions, file=f)
-        print("Fraction for test/val:", args.val_test_split, file=f)
-        print("Min size kept:", args.min_file_size, file=f)
-        print("Files searched: ", total, file=f)
-        print("Files loaded: ", loaded, file=f)
-        print("Files with replacement chars: ", replaced, file=f)
+
+    if args.outputs:
+        outputs = {}
+        for output in args.outputs:
+            out, extensions = output.rsplit(':', 1)
+            outputs[out] = extensions.split(',')
+    elif args.out is not None:
+        outputs = {args.out: args.extensions}
+    else:
+        parser.error("one of --out or --outputs is required")
+
+    stats = make_hdfs(args.src_dir, outputs, args.keep_repeats,
+                      args.val_test_split, args.min_file_size, args.workers,
+                      args.packed, args.chunk_size, args.seed)
+
+    for out, extensions in outputs.items():
+        total, loaded, replaced = stats[out]
+
+        # Print info about the dataset
+        with open(out + ".info", 'w') as f:
+            print("Keep repeats: ", args.keep_repeats, file=f)
+            print("Extensions: ", extensions, file=f)
+            print("Fraction for test/val:", args.val_test_split, file=f)
+            print("Min size kept:", args.min_file_size, file=f)
+            print("Files searched: ", total, file=f)
+            print("Files loaded: ", loaded, file=f)
+            print("Files with replacement chars: ", replaced, file=f)
 
 
 if __name__ == "__main__":
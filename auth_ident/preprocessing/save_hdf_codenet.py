@@ -9,6 +9,9 @@ by Pandas.  The columns in the resulting pandas dataframes will be
 "filepath"
 "file_content" - The full file contents. (Optional)
 
+The .h5 files are written in chunks and never held in memory whole; read
+them with auth_ident.packed_corpus.read_frame (or iter_frames, one chunk at
+a time) rather than pd.read_hdf.
 """
 
 import argparse
@@ -16,6 +19,9 @@ import os
 import re
 import numpy as np
 import pandas as pd
+from auth_ident.packed_corpus import FrameWriter
+from auth_ident.preprocessing.author_split import assign_splits, save_split, \
+    SPLIT_SUFFIXES
 
 
 def get_dups(codenet_path, language):
@@ -44,7 +50,8 @@ def get_dups(codenet_path, language):
 
 
 def make_hdf(codenet_root, new_hdf, keep_repeats, languages, val_test_split,
-             min_file_size, dataset, include_contents):
+             min_file_size, dataset, include_contents, packed=False,
+             chunk_size=10000, seed=None):
     """
     Create .h5 file(s) from Google code jam submissions.
 
@@ -57,8 +64,20 @@ def make_hdf(codenet_root, new_hdf, keep_repeats, languages, val_test_split,
     :param min_file_size (int): Minimum file size to keep (in bytes).
     :param dataset (string): Restrict to single dataset AIZU or AtCoder.
     :param include_contents (boolean): Include full file contents.
+    :param packed (boolean): Write text .packed corpora instead of .h5
+    (requires include_contents).
+    :param chunk_size (int): Rows buffered per output file before writing.
+    :param seed (int): Seed for the author split, None for numpy's global
+    random state.
+
+    The metadata is scanned first to pick the files and decide the author
+    split, then file contents are read and appended to their split file
+    chunk_size rows at a time, so contents are never all in memory.
 
     """
+    assert include_contents or not packed, \
+        "packed output needs --include-contents"
+
     submissions = []
     codenet_root = os.path.normpath(codenet_root)
     metadata_root = os.path.join(codenet_root, 'metadata')
@@ -105,69 +124,44 @@ def make_hdf(codenet_root, new_hdf, keep_repeats, languages, val_test_split,
                              + frame['filename_ext'])
                 local_path = os.path.join(frame['problem_id'],
                                           language, file_name)
-                full_path = os.path.join(data_root, local_path)
-
-                if include_contents:
-                    with open(full_path, 'rb') as content_file:
-                        contents = content_file.read().decode("utf-8")
-                        submission = (frame['problem_id'],
-				      int(frame['user_id'][1:]),
-                                      language,
-                                      local_path,
-                                      contents)
-                else:
-                    submission = (frame['problem_id'],
-                                  int(frame['user_id'][1:]),
-                                  language,
-                                  local_path)
 
-                submissions.append(submission)
+                submission = (frame['problem_id'],
+                              int(frame['user_id'][1:]),
+                              language,
+                              local_path)
 
+                submissions.append(submission)
 
+    columns = ["problem_id", "username", "language", "filepath"]
     if include_contents:
-        frame = pd.DataFrame({"problem_id": [v[0] for v in submissions],
-                              "username": [v[1] for v in submissions],
-                              "language": [v[2] for v in submissions],
-                              "filepath": [v[3] for v in submissions],
-                              "file_content": [v[4] for v in submissions]})
-    else:
-        frame = pd.DataFrame({"problem_id": [v[0] for v in submissions],
-                              "username": [v[1] for v in submissions],
-                              "language": [v[2] for v in submissions],
-                              "filepath": [v[3] for v in submissions]})
+        columns.append("file_content")
 
     if val_test_split > 0:
-        authors = frame['username'].unique()
-        np.random.shuffle(authors)
-
-        num_val = int(val_test_split * len(authors))
-        num_test = int(val_test_split * len(authors))
-
-        # Determine which authors will be in which set...
-        val_authors = np.random.choice(authors, num_val, replace=False)
-        authors = np.setdiff1d(authors, val_authors,
-                               assume_unique=True)
-        test_authors = np.random.choice(authors, num_test, replace=False)
-
-        # All remaining are in the train set.
-        train_authors = np.setdiff1d(authors, test_authors,
-                                     assume_unique=True)
-
-        # Split into DataFrames according to the selected authors.
-        # Unfortunately, this will double memory usage.
-        val_matches = [name in val_authors for name in frame['username']]
-        test_matches = [name in test_authors for name in frame['username']]
-        train_matches = [name in train_authors for name in frame['username']]
-
-        val_frame = frame.loc[val_matches].reset_index(drop=True)
-        test_frame = frame.loc[test_matches].reset_index(drop=True)
-        train_frame = frame.loc[train_matches].reset_index(drop=True)
-	
-        val_frame.to_hdf(new_hdf + "_val.h5", key='df', mode='w')
-        test_frame.to_hdf(new_hdf + "_test.h5", key='df', mode='w')
-        train_frame.to_hdf(new_hdf + "_train.h5", key='df', mode='w')
+        row_splits, mapping = assign_splits([v[1] for v in submissions],
+                                            val_test_split, seed)
+        save_split(mapping, new_hdf + "_author_split.csv")
+        split_names = dict(enumerate(SPLIT_SUFFIXES))
     else:
-        frame.to_hdf(new_hdf + ".h5", key='df', mode='w')
+        row_splits = np.zeros(len(submissions), dtype=np.int8)
+        split_names = {0: ""}
+    extension = ".packed" if packed else ".h5"
+    writers = {split: FrameWriter(new_hdf + suffix + extension, columns,
+                                  chunk_size)
+               for split, suffix in split_names.items()}
+
+    for i, submission in enumerate(submissions):
+        if include_contents:
+            full_path = os.path.join(data_root, submission[3])
+            with open(full_path, 'rb') as content_file:
+                contents = content_file.read().decode("utf-8")
+            submission = submission + (contents,)
+        writers[row_splits[i]].append(submission)
+
+        if (i + 1) % 100000 == 0:
+            print(f"Wrote {i + 1}/{len(submissions)} files", flush=True)
+
+    for writer in writers.values():
+        writer.close()
 
     return total_checked, size_rejected, dup_rejected
 
@@ -214,6 +208,16 @@ The columns in the resulting pandas dataframes will be
                         help='Minimum file size (in bytes) to include.')
     parser.add_argument('--dataset',
                         help='Restrict to just one competition dataset. (AtCoder or AIZU)')
+    parser.add_argument('--packed', default=False, action='store_true',
+                        help='Write text .packed corpora instead of .h5 '
+                             'files. Requires --include-contents.')
+    parser.add_argument('--chunk-size', default=10000, type=int,
+                        help='Rows buffered per output file before they '
+                             'are appended to it.')
+    parser.add_argument('--seed', default=None, type=int,
+                        help='Seed for the author split. The author to '
+                             'split mapping is saved next to the output as '
+                             '_author_split.csv.')
 
     args = parser.parse_args()
     total, size_rejected, dup_rejected = make_hdf(args.src_dir, args.out,
@@ -222,7 +226,10 @@ The columns in the resulting pandas dataframes will be
                                                   args.val_test_split,
                                                   args.min_file_size,
                                                   args.dataset,
-                                                  args.include_contents)
+                                                  args.include_contents,
+                                                  args.packed,
+                                                  args.chunk_size,
+                                                  args.seed)
 
     # Print info about the dataset
     with open(args.out + ".info", 'w') as f:
@@ -0,0 +1,303 @@
+"""
+Python version of the token id mapping in encode_tokens.c.
+
+Ids follow one of two layouts, which only differ in where keywords start:
+
+    0         unknown
+    1, 2      start, end
+    3 - 12    token classes (space, tab, comment, line comment, newline,
+              integer, floating, char, string, preprocessor)
+    13 - 75   identifier characters, one id per character of `alphabet`
+    76 - 129  operators
+
+    layout 1 (legacy, the one encode_tokens.c writes)
+    67 - 161  keywords (13 + number of operators, so they overlap the
+              identifier characters and operators)
+    162 +     reserved (most common) identifiers for c++, 118 + for java
+
+    layout 2 (TOKEN_LAYOUT, every range disjoint from the others)
+    130 - 224 keywords (130 - 180 for java)
+    225 +     reserved (most common) identifiers for c++, 181 + for java
+
+TOKEN_LAYOUT_INDEX_BUFFERS holds the first reserved identifier id for c++,
+which has the most keywords, so it plus the number of reserved identifiers
+bounds the ids of both languages. Encoded corpora record their layout as
+the "token_layout" of their corpus_info; corpora without one are layout 1.
+
+Tokens are matched exactly. The C encoder compares tokens that still end in
+the newline read by fgets, so no operator, keyword or reserved identifier
+ever matches there and identifiers are always spelled out; here they match
+as intended.
+"""
+import heapq
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from auth_ident import TOKEN_LAYOUT_INDEX_BUFFERS
+
+
+ALPHABET = "_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+OPS = [
+    # ops1
+    "{", "}", "[", "]", "(", ")",
+    ";", "?", "~", ",", "@", "<",
+    ":", ".", "-", "+", "*", "/",
+    "%", "^", "&", "|", "=", "!",
+    ">",
+    # ops2
+    "<:", "<%", "<=", "<<", ":>",
+    "::", ".*", "->", "-=", "--",
+    "+=", "++", "*=", "/=", "%>",
+    "%=", "^=", "&=", "&&", "|=",
+    "||", "==", "!=", ">=", ">>",
+    # ops3
+    "...", "<=>", "->*", "<<="
+]
+
+CLASS_IDS = {
+    "s": 3,
+    "t": 4,
+    "c": 5,
+    "lc": 6,
+    "newline": 7,
+    "integer": 8,
+    "floating": 9,
+    "char": 10,
+    "string": 11,
+    "preprocessor": 12,
+}
+
+UNKNOWN_ID = 0
+ALPHABET_INDEX_BUFFER = 13
+OP_INDEX_BUFFER = ALPHABET_INDEX_BUFFER + len(ALPHABET)
+# First keyword id of each token id layout
+KEYWORD_INDEX_BUFFERS = {
+    1: ALPHABET_INDEX_BUFFER + len(OPS),
+    2: OP_INDEX_BUFFER + len(OPS),
+}
+# Layout written by the python encoders
+TOKEN_LAYOUT = 2
+
+KEYWORD_FILES = {
+    "cpp": os.path.join(os.path.dirname(__file__), "c++20.kw"),
+    "java": os.path.join(os.path.dirname(__file__), "java.kw"),
+}
+
+
+def load_keywords(language="cpp"):
+    with open(KEYWORD_FILES[language]) as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def top_identifiers(counts, n):
+    """
+    The n most frequent identifiers in counts (a mapping from identifier to
+    count), skipping single characters from the alphabet since those are
+    spelled out anyway. Ties are broken by the identifier itself so the
+    result does not depend on counting order.
+    """
+    alphabet = set(ALPHABET)
+    candidates = ((count, identifier) for identifier, count in counts.items()
+                  if identifier not in alphabet)
+    top = heapq.nsmallest(n, candidates, key=lambda x: (-x[0], x[1]))
+    return [identifier for _, identifier in top]
+
+
+class TokenEncoder:
+    """
+    Maps (class, token) pairs from the CodeNet tokenizer to token ids. One
+    token can become several ids (an identifier spelled out character by
+    character) or none (a class that isn't encoded). layout picks the token
+    id layout, see the module docstring.
+    """
+    def __init__(self, reserved_identifiers, keywords=None,
+                 layout=TOKEN_LAYOUT):
+        if keywords is None:
+            keywords = load_keywords()
+        self.reserved_identifiers = list(reserved_identifiers)
+        self.keywords = list(keywords)
+        self.layout = layout
+
+        self.keyword_index_buffer = KEYWORD_INDEX_BUFFERS[layout]
+        self.reserved_identifiers_buffer = (self.keyword_index_buffer +
+                                            len(self.keywords))
+        self.op_ids = {op: i + OP_INDEX_BUFFER for i, op in enumerate(OPS)}
+        self.keyword_ids = {keyword: i + self.keyword_index_buffer
+                            for i, keyword in enumerate(self.keywords)}
+        self.identifier_ids = {
+            identifier: i + self.reserved_identifiers_buffer
+            for i, identifier in enumerate(self.reserved_identifiers)}
+        self.char_ids = {c: i + ALPHABET_INDEX_BUFFER
+                         for i, c in enumerate(ALPHABET)}
+
+        # The legacy layout overlaps keywords with characters and operators
+        if layout != 1:
+            ranges = sorted(self.id_ranges().items(),
+                            key=lambda x: x[1].start)
+            for (name, ids), (next_name, next_ids) in zip(ranges,
+                                                          ranges[1:]):
+                assert ids.stop <= next_ids.start, \
+                    f"{name} ids {ids} overlap {next_name} ids {next_ids}"
+        assert (self.reserved_identifiers_buffer <=
+                TOKEN_LAYOUT_INDEX_BUFFERS[layout]), \
+            "TOKEN_LAYOUT_INDEX_BUFFERS must bound the keyword ids"
+
+    def id_ranges(self):
+        """The range of ids used by each kind of token."""
+        class_ids = sorted(CLASS_IDS.values())
+        return {
+            "special": range(UNKNOWN_ID, class_ids[0]),
+            "class": range(class_ids[0], class_ids[-1] + 1),
+            "character": range(ALPHABET_INDEX_BUFFER,
+                               ALPHABET_INDEX_BUFFER + len(ALPHABET)),
+            "operator": range(OP_INDEX_BUFFER, OP_INDEX_BUFFER + len(OPS)),
+            "keyword": range(self.keyword_index_buffer,
+                             self.keyword_index_buffer + len(self.keywords)),
+            "reserved identifier": range(self.reserved_identifiers_buffer,
+                                         self.len_encoding),
+        }
+
+    @property
+    def len_encoding(self):
+        return self.reserved_identifiers_buffer + len(
+            self.reserved_identifiers)
+
+    def encode_token(self, token_class, token):
+        """Ids for one token, as a list."""
+        if token_class in CLASS_IDS:
+            return [CLASS_IDS[token_class]]
+        elif token_class == "operator":
+            return [self.op_ids[token]] if token in self.op_ids else []
+        elif token_class == "keyword":
+            return ([self.keyword_ids[token]] if token in self.keyword_ids
+                    else [])
+        elif token_class == "identifier":
+            if token in self.identifier_ids:
+                return [self.identifier_ids[token]]
+            return [self.char_ids.get(c, UNKNOWN_ID) for c in token]
+        return []
+
+    def encode_lexicon(self, lexicon):
+        """
+        Encode every distinct (class, token) pair once.
+
+        Returns a ragged table (ids, offsets): entry i encodes to
+        ids[offsets[i]:offsets[i + 1]].
+        """
+        encoded = [self.encode_token(token_class, token)
+                   for token_class, token in lexicon]
+        lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64,
+                              count=len(encoded))
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.fromiter((i for ids in encoded for i in ids),
+                          dtype=np.int32, count=int(offsets[-1]))
+        return ids, offsets
+
+    def encode_batch(self, files):
+        """
+        Encode a batch of files, each a sequence of (class, token) pairs.
+
+        Distinct pairs are looked up once for the whole batch and the files
+        are then expanded together, so the per token work is a dict lookup
+        and a vectorized gather. Returns one int32 array per file.
+        """
+        lexicon = {}
+        entries = []
+        file_offsets = [0]
+        for pairs in files:
+            entries.extend(lexicon.setdefault(pair, len(lexicon))
+                           for pair in pairs)
+            file_offsets.append(len(entries))
+
+        table_ids, table_offsets = self.encode_lexicon(list(lexicon))
+        ids, starts = expand_ragged(np.array(entries, dtype=np.int64),
+                                    table_ids, table_offsets)
+        offsets = starts[file_offsets]
+        return [ids[offsets[i]:offsets[i + 1]] for i in range(len(files))]
+
+
+def expand_ragged(entries, table_ids, table_offsets):
+    """
+    Replace every entry index in `entries` by its ids from a ragged table
+    (see TokenEncoder.encode_lexicon), all at once.
+
+    Returns the concatenated ids and, for each input position, where its
+    ids start (one extra entry at the end), so per-file boundaries can be
+    mapped with starts[file_offsets].
+    """
+    entries = np.asarray(entries)
+    lengths = table_offsets[entries + 1] - table_offsets[entries]
+    starts = np.zeros(entries.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=starts[1:])
+
+    # Position of each output id within its entry, added to where that
+    # entry's ids start in the table
+    within = np.arange(starts[-1]) - np.repeat(starts[:-1], lengths)
+    ids = table_ids[np.repeat(table_offsets[entries], lengths) + within]
+    return ids, starts
+
+
+# Encoder of each encode_dataset worker process
+_worker_encoder = None
+
+
+def _init_worker(reserved_identifiers, keywords, layout):
+    global _worker_encoder
+    _worker_encoder = TokenEncoder(reserved_identifiers, keywords, layout)
+
+
+def _encode_worker_batch(files):
+    return _worker_encoder.encode_batch(files)
+
+
+def _batches(files, batch_size, counts):
+    batch = []
+    for pairs in files:
+        counts["tokens"] += len(pairs)
+        batch.append(pairs)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def encode_dataset(files, reserved_identifiers, keywords=None, workers=None,
+                   batch_size=1000, layout=TOKEN_LAYOUT):
+    """
+    Encode every file of a dataset.
+
+    :param files: Iterable of files, each a sequence of (class, token)
+    pairs as produced by the CodeNet tokenizer. It is consumed lazily, one
+    batch at a time.
+    :param workers: Number of encoding processes; None or 1 encodes in this
+    process.
+    :param layout: Token id layout, see TokenEncoder.
+    returns: List of int32 arrays, one per file, in input order.
+    """
+    if keywords is None:
+        keywords = load_keywords()
+
+    counts = {"tokens": 0}
+    batches = _batches(files, batch_size, counts)
+    start = time.perf_counter()
+    if workers is None or workers <= 1:
+        encoder = TokenEncoder(reserved_identifiers, keywords, layout)
+        encoded = [e for batch in batches for e in encoder.encode_batch(batch)]
+    else:
+        with multiprocessing.Pool(workers, _init_worker,
+                                  (reserved_identifiers, keywords,
+                                   layout)) as pool:
+            encoded = [e for batch in pool.imap(_encode_worker_batch, batches)
+                       for e in batch]
+
+    elapsed = time.perf_counter() - start
+    num_tokens = counts["tokens"]
+    print(f"Encoded {len(encoded)} files, {num_tokens} tokens in "
+          f"{elapsed:.1f}s ({num_tokens / max(elapsed, 1e-9):.0f} tokens/sec)")
+    return encoded
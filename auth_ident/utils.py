@@ -2,6 +2,9 @@ from tensorflow.keras import backend as K
 from tensorflow.keras import Model
 import tensorflow as tf
 from auth_ident import param_mapping
+import numpy as np
+import hashlib
+import json
 import os
 
 
@@ -19,6 +22,12 @@ def load_encoder(model, params, combination, logger, logdir):
 
     # Load most recent checkpoint
     logger.info(f"Encoder logdir: {logdir}")
+    encoder.load_weights(get_latest_checkpoint(logdir, combination))
+
+    return encoder
+
+
+def get_latest_checkpoint(logdir, combination):
     checkpoint_dir = os.path.join(logdir, f"combination-{combination}",
                                   "checkpoints")
     checkpoints = [
@@ -28,11 +37,66 @@ def load_encoder(model, params, combination, logger, logdir):
     latest_checkpoint = max(checkpoints, key=os.path.getctime)
     #latest_checkpoint = sorted(checkpoints, key=os.path.getctime)[-6]
 
-    encoder.load_weights(latest_checkpoint)
+    return latest_checkpoint
+
+
+def hash_file(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def embedding_cache_key(checkpoint, output_layer_name, normalize, data_file,
+                        file_indicies, max_code_length):
+    """
+    Key for one set of embeddings. Any change to the weights, the layer read
+    out, normalization, the data file, the sampled files (in row order) or
+    the crop length gives a new key.
+    """
+    key = {
+        'checkpoint': hash_file(checkpoint),
+        'output_layer_name': output_layer_name,
+        'normalize': bool(normalize),
+        'data_file': data_file,
+        'file_indicies': hashlib.sha1(
+            np.ascontiguousarray(file_indicies, dtype=np.int64)).hexdigest(),
+        'max_code_length': int(max_code_length),
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
 
-    return encoder
 
-def get_data(params, dataset, k_nieghbors, data_file, return_file_indicies=False, max_authors=None):
+def embedding_cache_dir(logdir, combination):
+    return os.path.join(logdir, f"combination-{combination}",
+                        "embedding_cache")
+
+
+def embedding_cache_file(params, output_layer_name, normalize, data_file,
+                         file_indicies, combination, logdir):
+    key = embedding_cache_key(get_latest_checkpoint(logdir, combination),
+                              output_layer_name, normalize, data_file,
+                              file_indicies, params["max_code_length"])
+    return os.path.join(embedding_cache_dir(logdir, combination),
+                        f"{key}.npz")
+
+
+def load_cached_embeddings(cache_file, logger):
+    if os.path.isfile(cache_file):
+        logger.info(f"Loading cached embeddings: {cache_file}")
+        return np.load(cache_file)['embeddings']
+    return None
+
+
+def save_cached_embeddings(cache_file, embeddings, logger):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # Write under a temporary name so a reader never sees half a file
+    tmp_file = cache_file + f".tmp-{os.getpid()}.npz"
+    np.savez(tmp_file, embeddings=embeddings)
+    os.replace(tmp_file, cache_file)
+    logger.info(f"Cached embeddings: {cache_file}")
+
+def make_dataset(params, dataset, k_nieghbors, data_file, max_authors=None):
 
     print(params)
     if max_authors is None:
@@ -58,7 +122,16 @@ def get_data(params, dataset, k_nieghbors, data_file, return_file_indicies=False
                           encoding_type=params['encoding_type'])
 
     params['dataset'] = dataset
-    return dataset.get_dataset(return_file_indicies=return_file_indicies)
+    return dataset
+
+
+def get_data(params, dataset, k_nieghbors, data_file, return_file_indicies=False, max_authors=None,
+             align_file_indicies=False):
+
+    dataset = make_dataset(params, dataset, k_nieghbors, data_file,
+                           max_authors)
+    return dataset.get_dataset(return_file_indicies=return_file_indicies,
+                               align_file_indicies=align_file_indicies)
      
 
 def get_model(contrastive_params,
@@ -99,25 +172,117 @@ def get_embeddings(params,
                    logger,
                    logdir,
                    normalize=True,
-                   return_file_indicies=False):
+                   return_file_indicies=False,
+                   align_file_indicies=False,
+                   use_cache=True):
+    """
+    Embed a ClosedDataset sample with the latest checkpoint of a contrastive
+    combination. Embeddings are cached on disk next to the checkpoints,
+    so repeated calls for the same sample skip the encoder.
+    """
+
+    # File indices are always needed for the cache key; they come back
+    # lined up with the rows of X
+    X, y, file_indicies = get_data(params, dataset, k_cross_val, data_file,
+                                   True, max_authors, True)
+
+    embeddings = None
+    if use_cache:
+        cache_file = embedding_cache_file(params, output_layer_name,
+                                          normalize, data_file, file_indicies,
+                                          combination, logdir)
+        embeddings = load_cached_embeddings(cache_file, logger)
+
+    if embeddings is None:
+        embedding_model = get_model(params,
+                                    output_layer_name,
+                                    normalize,
+                                    combination,
+                                    logger,
+                                    logdir)
+
+        embedding_model.compile(loss=lambda a, b, **kwargs: 0.0)
+        embeddings = embedding_model.predict(X, batch_size=params["batch_size"])
+
+        if use_cache:
+            save_cached_embeddings(cache_file, embeddings, logger)
+
+    if return_file_indicies:
+        if not align_file_indicies:
+            # Back to author order, k files per author
+            file_indicies = file_indicies.reshape(k_cross_val, -1).T.ravel()
+        return embeddings, y, file_indicies
+    else:
+        return embeddings, y
+
+
+def embed_split(params,
+                dataset,
+                output_layer_name,
+                data_file,
+                combination,
+                logger,
+                logdir,
+                normalize=True,
+                chunk_size=8192,
+                use_cache=True):
+    """
+    Embed every file in data_file once. Row i of the result is the
+    embedding of file i, so any ClosedDataset selection can be answered
+    with a gather (see subset_embeddings). Files are cropped and encoded
+    chunk_size at a time to bound memory.
+    """
+
+    # max_authors and k_cross_val do not matter here, only the corpus and
+    # the encoding are used
+    dataset = make_dataset(params, dataset, 2, data_file, max_authors=0)
+    corpus = dataset.corpus
+    file_indicies = np.arange(len(corpus))
+
+    embeddings = None
+    if use_cache:
+        cache_file = embedding_cache_file(params, output_layer_name,
+                                          normalize, data_file, file_indicies,
+                                          combination, logdir)
+        embeddings = load_cached_embeddings(cache_file, logger)
+
+    if embeddings is None:
+        embedding_model = get_model(params,
+                                    output_layer_name,
+                                    normalize,
+                                    combination,
+                                    logger,
+                                    logdir)
+        embedding_model.compile(loss=lambda a, b, **kwargs: 0.0)
+
+        chunks = []
+        for start in range(0, len(corpus), chunk_size):
+            X = corpus.crop_batch(file_indicies[start:start + chunk_size],
+                                  params["max_code_length"], dataset.eos_id)
+            chunks.append(embedding_model.predict(
+                X, batch_size=params["batch_size"]))
+            logger.info(f"Embedded {start + X.shape[0]}/{len(corpus)} files")
+        embeddings = np.concatenate(chunks)
+
+        if use_cache:
+            save_cached_embeddings(cache_file, embeddings, logger)
+
+    return embeddings
 
 
-    # Save as list to avoid extra if statement
-    data = get_data(params, dataset, k_cross_val, data_file, return_file_indicies, max_authors)
-    X = data[0]
-    y = data[1]
+def subset_embeddings(params, dataset, max_authors, k_cross_val, data_file,
+                      split_embeddings, return_file_indicies=False):
+    """
+    Same samples and labels as get_embeddings, gathered from the output of
+    embed_split instead of running the encoder.
+    """
 
-    embedding_model = get_model(params,
-                                output_layer_name,
-                                normalize,
-                                combination,
-                                logger,
-                                logdir)
+    dataset = make_dataset(params, dataset, k_cross_val, data_file,
+                           max_authors)
+    file_indicies, y = dataset.get_indicies()
+    embeddings = split_embeddings[file_indicies]
 
-    embedding_model.compile(loss=lambda a, b, **kwargs: 0.0)
-    embeddings = embedding_model.predict(X, batch_size=params["batch_size"])
-    
     if return_file_indicies:
-        return embeddings, y, data[2]
+        return embeddings, y, file_indicies
     else:
         return embeddings, y
@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.spatial.distance import cdist
 import scipy
+import scipy.special
 import sklearn.metrics
 
 def indep_roll(arr, shifts, axis=1):
@@ -96,6 +97,94 @@ def calc_scores(X, y, num_authors, set_size, comparison_func,
     return scores, true
         
 
+def log_ratio_table(same_distribution, diff_distribution, small=.00000000001):
+    """Precompute log(same_pdf / diff_pdf) for two scipy rv_histograms.
+
+    Both pdfs are constant between consecutive edges of the union of the two
+    histograms, so the ratio only has to be evaluated once per interval.
+    Returns (edges, log_ratios) for use with lookup_log_ratio; pdfs are
+    floored at small exactly as in log_odds_same_*.
+    """
+    edges = np.union1d(same_distribution._histogram[1],
+                       diff_distribution._histogram[1])
+    # One representative point per interval: below the first edge, then
+    # the left end of each [edges[j], edges[j + 1])
+    points = np.concatenate([[edges[0] - 1], edges])
+    sames = np.maximum(same_distribution.pdf(points), small)
+    diffs = np.maximum(diff_distribution.pdf(points), small)
+    return edges, np.log(sames / diffs)
+
+
+def lookup_log_ratio(sims, table):
+    """log(same_pdf / diff_pdf) at every similarity in sims."""
+    edges, log_ratios = table
+    return log_ratios[np.searchsorted(edges, sims, side='right')]
+
+
+def set_similarities(X, num_authors, set_size, shift=0):
+    """Cosine similarities between every author's two sets of files.
+
+    Uses the calc_scores layout: set a of author i is rows
+    i, i + num_authors, ... of the first set_size * num_authors rows and set
+    b is the next set_size * num_authors rows, offset by shift (mod len(X))
+    to pair authors with someone else. Returns an
+    (num_authors, set_size, set_size) array, sims[i] being
+    1 - cdist(a_i, b_i, 'cosine').
+    """
+    X = X / np.linalg.norm(X, axis=1, keepdims=True)
+    block = set_size * num_authors
+    points_a = X[:block].reshape(set_size, num_authors, -1)
+    indices_b = (np.arange(block, 2 * block) + shift) % X.shape[0]
+    points_b = X[indices_b].reshape(set_size, num_authors, -1)
+    return np.einsum('sid,tid->ist', points_a, points_b)
+
+
+def batched_log_odds_same_independent(log_ratios, prior_same):
+    """log_odds_same_independent for a stack of (set_size, set_size)
+    log-ratio blocks."""
+    acc = np.log(prior_same / (1 - prior_same)) + log_ratios.sum(axis=(1, 2))
+    return scipy.special.expit(acc)
+
+
+def batched_log_odds_same_averaged(log_ratios, prior_same):
+    """log_odds_same_averaged for a stack of (set_size, set_size) log-ratio
+    blocks."""
+    set_size = log_ratios.shape[1]
+    # Same diagonal alignment as indep_roll: column c holds
+    # (r, (c + r) % set_size) for every row r
+    rows = np.arange(set_size)[:, np.newaxis]
+    cols = (np.arange(set_size)[np.newaxis, :] + rows) % set_size
+    accs = np.log(prior_same / (1 - prior_same)) + \
+        log_ratios[:, rows, cols].sum(axis=1)
+    return scipy.special.expit(accs).mean(axis=1)
+
+
+def calc_scores_batched(X, y, num_authors, set_size, comparison_func,
+                        same_distribution, diff_distribution, table=None):
+    """Batched calc_scores. comparison_func is
+    batched_log_odds_same_independent or batched_log_odds_same_averaged.
+
+    All same-author and shifted different-author blocks are scored at once
+    with a single bin lookup. Pass table (from log_ratio_table) to reuse it
+    across calls with the same distributions.
+
+    Matches calc_scores up to rounding, except that a similarity lying
+    exactly on a histogram edge may land in the neighbouring bin, which
+    only happens when scoring the data the pdfs were built from.
+    """
+    if table is None:
+        table = log_ratio_table(same_distribution, diff_distribution)
+
+    true = np.zeros(num_authors * 2)
+    true[0:num_authors] = 1
+
+    # shift by one to ensure non-match
+    sims = np.concatenate([set_similarities(X, num_authors, set_size, 0),
+                           set_similarities(X, num_authors, set_size, 1)])
+    scores = comparison_func(lookup_log_ratio(sims, table), .5)
+    return scores, true
+
+
 def create_pdfs(points, labels):
     same_dists = []
     for label in np.unique(labels):
@@ -123,3 +212,78 @@ def create_pdfs(points, labels):
 
     return same_distribution, diff_distribution
     
+
+def histogram_edges(bins=200, low=-1.0, high=1.0):
+    """Fixed bin edges for create_pdfs_streaming. bins may be a number of
+    uniform bins over [low, high] or an array of precomputed edges."""
+    if np.ndim(bins) == 0:
+        return np.linspace(low, high, int(bins) + 1)
+    return np.asarray(bins, dtype=np.float64)
+
+
+def _tril_block_counts(group, start, stop, edges):
+    """Histogram of cosine similarities between rows [start, stop) of group
+    and every earlier row, i.e. one row block of the lower triangle."""
+    sims = group[start:stop] @ group[:stop].T
+    rows = np.arange(start, stop)[:, np.newaxis]
+    below = np.arange(stop)[np.newaxis, :] < rows
+    return np.histogram(np.clip(sims[below], -1, 1), bins=edges)[0]
+
+
+def create_pdfs_streaming(points, labels, bins=200, block_rows=1024,
+                          num_threads=None):
+    """Streaming create_pdfs.
+
+    Accumulates the same and different author histograms tile by tile over
+    fixed bin edges (see histogram_edges), so memory stays at one
+    block_rows x group tile instead of every pairwise similarity. The pairs
+    counted are those of create_pdfs: every pair within a label, and every
+    pair within each strided group i, i + n, i + 2n, ... where n is the
+    number of points per label. num_threads > 1 spreads the tiles over a
+    thread pool.
+
+    Returns the same and different author scipy rv_histograms.
+    """
+    edges = histogram_edges(bins)
+    points = points / np.linalg.norm(points, axis=1, keepdims=True)
+
+    # Same author: labels with an equal number of points are stacked and
+    # done in one batched product
+    same_counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    order = np.argsort(labels, kind='stable')
+    _, starts, sizes = np.unique(labels[order], return_index=True,
+                                 return_counts=True)
+    for size in np.unique(sizes):
+        if size < 2:
+            continue
+        members = order[starts[sizes == size][:, np.newaxis] +
+                        np.arange(size)]
+        tril = np.tril_indices(size, -1)
+        # Bound the stack so the similarity block stays near block_rows^2
+        stack = max(1, block_rows * block_rows // (size * size))
+        for i in range(0, members.shape[0], stack):
+            group = points[members[i:i + stack]]
+            sims = np.einsum('aid,ajd->aij', group, group)[:, tril[0], tril[1]]
+            same_counts += np.histogram(np.clip(sims, -1, 1), bins=edges)[0]
+
+    # Different author: lower triangle of each strided group in row blocks
+    num_points_per_class = int(points.shape[0] / np.unique(labels).size)
+    tasks = []
+    for i in range(num_points_per_class):
+        group = points[i::num_points_per_class]
+        for start in range(0, group.shape[0], block_rows):
+            tasks.append((group, start, min(start + block_rows,
+                                            group.shape[0]), edges))
+
+    if num_threads is not None and num_threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(num_threads) as pool:
+            diff_counts = sum(pool.map(lambda task: _tril_block_counts(*task),
+                                       tasks))
+    else:
+        diff_counts = sum(_tril_block_counts(*task) for task in tasks)
+
+    same_distribution = scipy.stats.rv_histogram((same_counts, edges))
+    diff_distribution = scipy.stats.rv_histogram((diff_counts, edges))
+
+    return same_distribution, diff_distribution
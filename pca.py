@@ -1,6 +1,7 @@
 from auth_ident.datasets import ClosedDataset
 from auth_ident import GenericExecute, param_mapping
 from auth_ident.utils import get_embeddings
+from auth_ident.packed_corpus import read_frame
 from sklearn.decomposition import PCA
 from sklearn.decomposition import KernelPCA
 import seaborn as sns
@@ -29,11 +30,12 @@ class AuthorPCA(GenericExecute):
                                                                  combination=combination,
                                                                  logger=logger,
                                                                  logdir=self.logdir,
-                                                                 return_file_indicies=True)
+                                                                 return_file_indicies=True,
+                                                                 align_file_indicies=True)
 
 
         f = os.path.join("data/", self.data_file)
-        raw_data = pd.read_hdf(f)
+        raw_data = read_frame(f)
 
         authors_per_split = int(train_data.shape[0] / float(self.num_files))
         files = np.empty(
@@ -47,7 +49,7 @@ class AuthorPCA(GenericExecute):
 
             files[k_files_slice] = train_data[n_authors_per_split_slice]
             labels[k_files_slice] = train_labels[n_authors_per_split_slice]
-            filepaths[k_files_slice] = raw_data['filepath'][file_indicies[k_files_slice]].values
+            filepaths[k_files_slice] = raw_data['filepath'][file_indicies[n_authors_per_split_slice]].values
 
         labels = np.array([f"Author {i}" for i in labels])
         print(files.shape)
@@ -23,7 +23,8 @@ import seaborn as sns
 import scipy
 import sklearn.metrics
 
-from histogram_utils import indep_roll, log_odds_same_averaged, log_odds_same_independent, calc_scores, create_pdfs
+from histogram_utils import indep_roll, log_odds_same_averaged, log_odds_same_independent, calc_scores, create_pdfs, \
+    batched_log_odds_same_independent, calc_scores_batched, log_ratio_table, create_pdfs_streaming
 
 
 from sklearn.metrics import roc_curve
@@ -80,7 +81,7 @@ class TrainHistogramVerifier(GenericExecute):
         train_data, train_labels = get_embeddings(
             params=contrastive_params,
             dataset=ClosedDataset,
-            max_authors=1600,
+            max_authors=self.max_authors,
             k_cross_val=9,
             output_layer_name=output_layer_name,
             data_file=data_file,
@@ -114,7 +115,11 @@ class TrainHistogramVerifier(GenericExecute):
             # Hack... Manually set things up to create the distributions using
             # the validation split, then change the flag to use
             # distribution using the test split.
-            same_distribution, diff_distribution = create_pdfs(X, y)
+            if self.pdf_bins is None:
+                same_distribution, diff_distribution = create_pdfs(X, y)
+            else:
+                same_distribution, diff_distribution = create_pdfs_streaming(
+                    X, y, bins=self.pdf_bins, num_threads=os.cpu_count())
            
             pickle.dump(same_distribution, open(same_hist_path, "wb" ))
             pickle.dump(diff_distribution, open(diff_hist_path, "wb" ))
@@ -149,11 +154,13 @@ class TrainHistogramVerifier(GenericExecute):
 
         if self.mode == 'test':
 
+            table = log_ratio_table(same_distribution, diff_distribution)
             for set_size in range(1,5):
                 #set_size = self.params['model_params']['set_size']
-                scores, true = calc_scores(X, y, num_authors, set_size,
-                                           log_odds_same_independent,
-                                           same_distribution.pdf, diff_distribution.pdf)
+                scores, true = calc_scores_batched(X, y, num_authors, set_size,
+                                                   batched_log_odds_same_independent,
+                                                   same_distribution, diff_distribution,
+                                                   table=table)
                 fpr, tpr, _ = roc_curve(true, scores)
                 plt.figure(1, figsize=(2.5, 2.0), dpi=220)
                 auc = sklearn.metrics.auc(fpr, tpr)
@@ -189,6 +196,11 @@ class TrainHistogramVerifier(GenericExecute):
         super().make_arg_parser()
         self.parser.add_argument("-mode")
         self.parser.add_argument("-second_combs", nargs='+', type=int)
+        self.parser.add_argument("-max_authors", type=int, default=1600)
+        self.parser.add_argument("-pdf_bins", type=int,
+                                 help="Build the pdfs by streaming into this "
+                                 "many fixed bins over [-1, 1] instead of "
+                                 "bins='auto' over every distance")
 
     def get_args(self):
 
@@ -196,6 +208,8 @@ class TrainHistogramVerifier(GenericExecute):
 
         self.secondary_combs = self.args["second_combs"]
         self.mode = self.args["mode"]
+        self.max_authors = self.args["max_authors"]
+        self.pdf_bins = self.args["pdf_bins"]
         if self.mode is None:
             self.mode = "train"
 
@@ -25,10 +25,12 @@ class TrainContrastive(GenericExecute):
         training_dataset = param_mapping.map_dataset(
             model.dataset_type, contrastive_params,
             contrastive_params["train_data"])
+        train_source = contrastive_params['dataset']
 
         val_dataset = param_mapping.map_dataset(model.dataset_type,
                                                 contrastive_params,
                                                 contrastive_params["val_data"])
+        val_source = contrastive_params['dataset']
 
         param_mapping.map_params(contrastive_params)
 
@@ -46,6 +48,11 @@ class TrainContrastive(GenericExecute):
         
         es = EarlyStopping(monitor='val_loss', mode='min', patience=2)
 
+        # Generator callbacks first, so what they log reaches the others
+        callbacks = [tensorboard_callback, save_model_callback, es]
+        if hasattr(train_source, 'callbacks'):
+            callbacks = train_source.callbacks() + callbacks
+
         model.compile(optimizer=contrastive_params['optimizer'],
                       loss=contrastive_params['loss'],
                       metrics=[])
@@ -54,13 +61,24 @@ class TrainContrastive(GenericExecute):
 
         logger.info('Fit model on training data')
 
-        history = model.fit(
-            training_dataset,
-            validation_data=val_dataset,
-            epochs=contrastive_params['epochs'],
-            steps_per_epoch=TRAIN_LEN // contrastive_params['batch_size'],
-            validation_steps=VAL_LEN // contrastive_params['batch_size'],
-            callbacks=[tensorboard_callback, save_model_callback, es])
+        try:
+            history = model.fit(
+                training_dataset,
+                validation_data=val_dataset,
+                epochs=contrastive_params['epochs'],
+                steps_per_epoch=TRAIN_LEN // contrastive_params['batch_size'],
+                validation_steps=VAL_LEN // contrastive_params['batch_size'],
+                callbacks=callbacks)
+        finally:
+            # Worker processes and shared memory of the generators
+            for split, source in (("train", train_source),
+                                  ("val", val_source)):
+                if hasattr(source, 'loader_metrics'):
+                    metrics = source.loader_metrics()
+                    if metrics is not None:
+                        logger.info(f'{split} loader metrics: {metrics}')
+                if hasattr(source, 'close'):
+                    source.close()
 
         self.save_metrics(history.history, combination, curr_log_dir)
 
@@ -5,7 +5,8 @@ from auth_ident import GenericExecute
 from auth_ident import param_mapping
 import os
 import pandas as pd
-from auth_ident.utils import get_embeddings, get_data, get_model
+from auth_ident.utils import get_embeddings, get_data, get_model, \
+    embed_split, subset_embeddings
 import time
 
 
@@ -40,6 +41,9 @@ class TrainSecondaryClassifier(GenericExecute):
 
         curr_k_cross_val = None
         curr_max_authors = None
+        # Embeddings of the whole split, keyed by (data_file, layer) when
+        # running with -embed_once
+        split_embeddings = {}
         for secondary_comb, params in enumerate(secondary_params_to_iterate):
 
             logger.info(f"secondary comb: {secondary_comb}, params: {params}")
@@ -73,17 +77,39 @@ class TrainSecondaryClassifier(GenericExecute):
                 curr_max_authors = params['max_authors']
                 data_file = contrastive_params[file_param]
 
-                train_data, train_labels = get_embeddings(
-                    params=contrastive_params,
-                    dataset=self.model.dataset,
-                    max_authors=params["max_authors"],
-                    k_cross_val=params['k_cross_val'],
-                    output_layer_name=output_layer_name,
-                    data_file=data_file,
-                    combination=combination,
-                    logger=logger,
-                    logdir=self.logdir,
-                    normalize= output_layer_name == "output_embedding")
+                if self.embed_once:
+                    split_key = (data_file, output_layer_name)
+                    if split_key not in split_embeddings:
+                        split_embeddings[split_key] = embed_split(
+                            params=contrastive_params,
+                            dataset=self.model.dataset,
+                            output_layer_name=output_layer_name,
+                            data_file=data_file,
+                            combination=combination,
+                            logger=logger,
+                            logdir=self.logdir,
+                            normalize= output_layer_name == "output_embedding",
+                            use_cache=self.use_embedding_cache)
+                    train_data, train_labels = subset_embeddings(
+                        params=contrastive_params,
+                        dataset=self.model.dataset,
+                        max_authors=params["max_authors"],
+                        k_cross_val=params['k_cross_val'],
+                        data_file=data_file,
+                        split_embeddings=split_embeddings[split_key])
+                else:
+                    train_data, train_labels = get_embeddings(
+                        params=contrastive_params,
+                        dataset=self.model.dataset,
+                        max_authors=params["max_authors"],
+                        k_cross_val=params['k_cross_val'],
+                        output_layer_name=output_layer_name,
+                        data_file=data_file,
+                        combination=combination,
+                        logger=logger,
+                        logdir=self.logdir,
+                        normalize= output_layer_name == "output_embedding",
+                        use_cache=self.use_embedding_cache)
                 print("not end to end")
 
             elif self.model.name == "end_to_end_mlp":
@@ -165,6 +191,12 @@ class TrainSecondaryClassifier(GenericExecute):
         super().make_arg_parser()
         self.parser.add_argument("-mode")
         self.parser.add_argument("-second_combs", nargs='+', type=int)
+        self.parser.add_argument("-no_embedding_cache", action="store_true",
+                                 help="Always re-run the encoder instead of "
+                                 "reusing cached embeddings")
+        self.parser.add_argument("-embed_once", action="store_true",
+                                 help="Embed every file in the split once "
+                                 "and gather each secondary sample from it")
 
     def get_args(self):
 
@@ -172,6 +204,8 @@ class TrainSecondaryClassifier(GenericExecute):
 
         self.secondary_combs = self.args["second_combs"]
         self.mode = self.args["mode"]
+        self.use_embedding_cache = not self.args["no_embedding_cache"]
+        self.embed_once = self.args["embed_once"]
         if self.mode is None:
             self.mode = "train"
 